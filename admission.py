@@ -0,0 +1,650 @@
+"""
+Admission Control - Bounded tunnels, accept backlog and worker threads under connection storms
+"""
+import asyncio
+import queue
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from vpn_logging import get_logger
+
+
+log = get_logger('admission')
+
+OVERLOAD_POLICIES = ('queue', 'reject', 'shed-idle')
+
+# Listen backlog; the kernel caps it at net.core.somaxconn
+DEFAULT_BACKLOG = 1024
+
+# Tunnels served at once; further connections are handled by the policy
+DEFAULT_MAX_TUNNELS = 1024
+
+# Seconds a queued connection waits for a free slot before it is dropped
+QUEUE_TIMEOUT = 10.0
+
+# Tunnels that saw traffic this recently are never shed
+MIN_SHED_IDLE = 5.0
+
+# Seconds an idle worker thread waits for a job before it exits
+WORKER_IDLE_TIMEOUT = 60.0
+
+# Tunnels that moved no data for this long are closed by the IdleReaper
+DEFAULT_IDLE_TIMEOUT = 900.0
+
+# Seconds between IdleReaper scans (at most; shorter for short timeouts)
+REAP_INTERVAL = 10.0
+
+# TCP keepalive: the first probe goes out after this many idle seconds,
+# then one every KEEPALIVE_INTERVAL; after KEEPALIVE_COUNT unanswered
+# probes the kernel fails the socket, ending the tunnel of a vanished peer
+DEFAULT_KEEPALIVE = 60
+KEEPALIVE_INTERVAL = 15
+KEEPALIVE_COUNT = 4
+
+# Bytes of buffers all tunnels may hold together, 0 for no limit
+DEFAULT_MEMORY_BUDGET = 0
+
+# Stack reserved for each new thread, 0 for the platform default (8 MiB
+# on most Linux systems, of which only the pages touched become resident)
+DEFAULT_THREAD_STACK_SIZE = 0
+
+
+def set_reset_on_close(sock):
+    """Make closing sock send a TCP RST instead of a FIN"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    except OSError:
+        pass
+
+
+def reset_connection(sock):
+    """Close with a TCP RST so the application sees an error, not a clean EOF"""
+    set_reset_on_close(sock)
+    sock.close()
+
+
+def shutdown_connection(sock):
+    """Wake whatever thread or loop is relaying sock by shutting it down"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def half_close(sock):
+    """Tell the peer nothing more will be sent, keeping the receive side open"""
+    try:
+        sock.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
+
+def set_keepalive(sock, idle=DEFAULT_KEEPALIVE, interval=KEEPALIVE_INTERVAL, count=KEEPALIVE_COUNT):
+    """
+    Enable TCP keepalive on sock
+    
+    Args:
+        idle: Seconds of silence before the first probe, 0 leaves keepalive off
+        interval: Seconds between probes
+        count: Unanswered probes before the connection is dropped
+    
+    The timings are applied where the platform exposes them (Linux, macOS);
+    elsewhere the system defaults apply.
+    """
+    if not idle:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        elif hasattr(socket, 'TCP_KEEPALIVE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+        if hasattr(socket, 'TCP_KEEPINTVL'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        if hasattr(socket, 'TCP_KEEPCNT'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    except OSError:
+        pass
+
+
+class MemoryBudget:
+    """Bytes buffered by all tunnels together, optionally capped"""
+    
+    def __init__(self, limit=DEFAULT_MEMORY_BUDGET, on_available=None):
+        """
+        Initialize budget
+        
+        Args:
+            limit: Bytes the tunnels may buffer together, 0 for no limit
+            on_available: Called with no arguments, without the lock held,
+                          when freed memory takes the budget back below
+                          its limit (optional)
+        """
+        if limit < 0:
+            raise ValueError("Memory budget cannot be negative")
+        self.limit = limit
+        self.used = 0
+        self.denied = 0
+        self.on_available = on_available
+        self.lock = threading.Lock()
+    
+    def charge(self, size, slot=None):
+        """Count size bytes that are already allocated, also on slot if given"""
+        with self.lock:
+            was_exhausted = self.exhausted()
+            self.used += size
+            if slot is not None:
+                # Under the lock: a tunnel's buffers may change on a relay
+                # thread and a crypto thread at once
+                slot.buffered += size
+            available = was_exhausted and not self.exhausted()
+        if available and self.on_available is not None:
+            self.on_available()
+    
+    def reserve(self, size, slot=None) -> bool:
+        """
+        Count size more bytes if the budget has room for them
+        
+        Returns:
+            Whether the caller may allocate them
+        """
+        with self.lock:
+            if self.limit and self.used + size > self.limit:
+                self.denied += 1
+                return False
+            self.used += size
+            if slot is not None:
+                slot.buffered += size
+            return True
+    
+    def release(self, size, slot=None):
+        """Return size bytes to the budget"""
+        self.charge(-size, slot)
+    
+    def exhausted(self) -> bool:
+        """Whether the tunnels buffer as much as the budget allows"""
+        return bool(self.limit) and self.used >= self.limit
+    
+    def get_stats(self) -> dict:
+        """Return buffered bytes, the limit and how often the limit held a buffer back"""
+        with self.lock:
+            return {
+                'memory_buffered_bytes': self.used,
+                'memory_budget_bytes': self.limit,
+                'memory_budget_denials': self.denied,
+            }
+
+
+class Slot:
+    """
+    Record of an admitted tunnel: what it carries, its traffic and the
+    bytes it buffers. Relays count() data as it moves and charge buffers
+    to the slot, which passes them on to the server's MemoryBudget.
+    
+    The slot only keeps counters, so buffered is an estimate: the sizes
+    of the decoder and relay buffers and queued data as the relays report
+    them, plus an approximation of zlib state. Kernel socket buffers and
+    thread stacks are not included.
+    """
+    
+    # A server keeps one of these per tunnel, thousands of them
+    __slots__ = ('closers', 'closed', 'sheddable', 'peer', 'target', 'started', 'last_active',
+                 'bytes_up', 'bytes_down', 'buffered', 'budget')
+    
+    def __init__(self, close, budget=None, peer=None):
+        """
+        Initialize slot
+        
+        Args:
+            close: Called with no arguments to shed the connection
+            budget: MemoryBudget buffers are charged to (optional)
+            peer: Address of the client, for get_tunnels()
+        """
+        self.closers = [close]
+        self.closed = False
+        # Mux sessions and UDP associations multiplex many flows and are
+        # never shed or reaped as idle
+        self.sheddable = True
+        self.peer = peer
+        self.target = None
+        self.started = self.last_active = time.monotonic()
+        self.bytes_up = 0
+        self.bytes_down = 0
+        self.buffered = 0
+        self.budget = budget
+    
+    def touch(self):
+        """Record traffic on the connection"""
+        self.last_active = time.monotonic()
+    
+    def count(self, direction, amount):
+        """Record amount bytes moved 'upload' (client -> target) or 'download'"""
+        if direction == 'upload':
+            self.bytes_up += amount
+        else:
+            self.bytes_down += amount
+        self.last_active = time.monotonic()
+    
+    def charge(self, size):
+        """Count an allocated buffer of size bytes, or one that grew by size"""
+        if self.budget is not None:
+            self.budget.charge(size, self)
+        else:
+            self.buffered += size
+    
+    def reserve(self, size) -> bool:
+        """Count size more bytes of buffers if the budget has room, see MemoryBudget.reserve()"""
+        if self.budget is not None:
+            return self.budget.reserve(size, self)
+        self.buffered += size
+        return True
+    
+    def release(self, size):
+        """Count size bytes of buffers as freed"""
+        self.charge(-size)
+    
+    def over_budget(self) -> bool:
+        """Whether buffers should stop growing because all tunnels together hold too much"""
+        return self.budget is not None and self.budget.exhausted()
+    
+    def free(self):
+        """Return everything still charged to the budget once the tunnel has ended"""
+        budget, self.budget = self.budget, None
+        if budget is not None:
+            # Not on the slot: describe() still reports what it held
+            budget.charge(-self.buffered)
+    
+    def describe(self) -> dict:
+        """The record as plain values, see AdmissionControl.get_tunnels()"""
+        now = time.monotonic()
+        peer = self.peer
+        if isinstance(peer, tuple):
+            peer = f"{peer[0]}:{peer[1]}"
+        return {
+            'peer': peer,
+            'target': self.target,
+            'age': round(now - self.started, 1),
+            'idle': round(now - self.last_active, 1),
+            'bytes_up': self.bytes_up,
+            'bytes_down': self.bytes_down,
+            'buffered_bytes': self.buffered,
+        }
+    
+    def add_closer(self, close):
+        """Also call close when the connection is shed, e.g. for its target socket"""
+        self.closers.append(close)
+        if self.closed:
+            close()
+    
+    def close(self):
+        """Shed the connection, waking whatever relays it"""
+        self.closed = True
+        for close in list(self.closers):
+            close()
+
+
+class AdmissionControl:
+    """Limits concurrent tunnels and applies an overload policy to the rest"""
+    
+    def __init__(self, max_tunnels=DEFAULT_MAX_TUNNELS, policy='queue', queue_size=DEFAULT_BACKLOG,
+                 queue_timeout=QUEUE_TIMEOUT, min_shed_idle=MIN_SHED_IDLE,
+                 memory_budget=DEFAULT_MEMORY_BUDGET):
+        """
+        Initialize admission control
+        
+        Args:
+            max_tunnels: Connections served at once
+            policy: What happens to a connection arriving when all slots are
+                    taken: 'queue' waits up to queue_timeout for a slot,
+                    'reject' resets it at once, 'shed-idle' closes the
+                    tunnel that has been idle longest (at least
+                    min_shed_idle seconds) to make room, else rejects
+                    (default: 'queue')
+            queue_size: Connections waiting at most, beyond that they are rejected
+            queue_timeout: Seconds a queued connection waits
+            min_shed_idle: Seconds without traffic before a tunnel may be shed
+            memory_budget: Bytes the tunnels may buffer together, 0 for no
+                           limit; while they buffer that much, new
+                           connections get the overload policy as if all
+                           slots were taken
+        """
+        if max_tunnels < 1:
+            raise ValueError("max_tunnels must be at least 1")
+        if policy not in OVERLOAD_POLICIES:
+            raise ValueError(f"Unknown overload policy {policy}")
+        self.max_tunnels = max_tunnels
+        self.policy = policy
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.min_shed_idle = min_shed_idle
+        self.budget = MemoryBudget(memory_budget, self.admit_queued)
+        self.active = set()
+        # (deadline, start, reject, close, peer) of connections waiting for a slot
+        self.pending = deque()
+        self.expiry_timer = None
+        self.lock = threading.Lock()
+        self.counters = {
+            'overload_queued': 0,
+            'overload_rejected': 0,
+            'overload_shed': 0,
+            'overload_queue_timeouts': 0,
+            'idle_reaped': 0,
+        }
+    
+    def admit(self, start, reject, close, peer=None):
+        """
+        Admit a new connection now, later, or not at all
+        
+        Args:
+            start: Called as start(slot) once the connection has a slot,
+                   release() the slot when the connection ends
+            reject: Called with no arguments if the connection is turned away
+            close: Sheds the connection once admitted, see Slot
+            peer: Address of the client, recorded in the slot
+        """
+        now = time.monotonic()
+        victim = slot = None
+        queued = False
+        with self.lock:
+            expired = self._expire(now)
+            if self.policy == 'shed-idle' and not self._has_room():
+                victim = self._idle_victim(now)
+            if self._has_room():
+                slot = self._grant(close, peer)
+            elif self.policy == 'queue' and len(self.pending) < self.queue_size:
+                self.pending.append((now + self.queue_timeout, start, reject, close, peer))
+                self.counters['overload_queued'] += 1
+                self._schedule_expiry()
+                queued = True
+            elif victim is not None:
+                self.active.discard(victim)
+                self.counters['overload_shed'] += 1
+                slot = self._grant(close, peer)
+            else:
+                self.counters['overload_rejected'] += 1
+        
+        for expired_reject in expired:
+            expired_reject()
+        if victim is not None:
+            log.warning("Shedding a tunnel idle for %.0fs", now - victim.last_active)
+            victim.close()
+        if slot is not None:
+            start(slot)
+        elif not queued:
+            reject()
+    
+    def release(self, slot):
+        """A connection has ended; hand its slot to the next queued one"""
+        now = time.monotonic()
+        slot.free()
+        with self.lock:
+            if slot not in self.active:
+                # Already shed
+                return
+            self.active.discard(slot)
+            expired = self._expire(now)
+            admitted = None
+            if self.pending and self._has_room():
+                _, start, _, close, peer = self.pending.popleft()
+                admitted = (start, self._grant(close, peer))
+        
+        for expired_reject in expired:
+            expired_reject()
+        if admitted is not None:
+            start, next_slot = admitted
+            start(next_slot)
+    
+    def admit_queued(self):
+        """Hand slots to queued connections while there is room, e.g. after budget memory was freed"""
+        now = time.monotonic()
+        admitted = []
+        with self.lock:
+            expired = self._expire(now)
+            while self.pending and self._has_room():
+                _, start, _, close, peer = self.pending.popleft()
+                admitted.append((start, self._grant(close, peer)))
+        
+        for expired_reject in expired:
+            expired_reject()
+        for start, slot in admitted:
+            start(slot)
+    
+    def expire(self):
+        """Reject queued connections whose wait is over"""
+        with self.lock:
+            self.expiry_timer = None
+            expired = self._expire(time.monotonic())
+            self._schedule_expiry()
+        for expired_reject in expired:
+            expired_reject()
+    
+    def reap_idle(self, idle_timeout) -> int:
+        """
+        Close the sheddable connections that moved no data for idle_timeout seconds
+        
+        Their slots are freed by release() once their relays have ended.
+        
+        Returns:
+            Number of connections closed
+        """
+        now = time.monotonic()
+        with self.lock:
+            idle = [slot for slot in self.active if slot.sheddable and not slot.closed
+                    and now - slot.last_active >= idle_timeout]
+            self.counters['idle_reaped'] += len(idle)
+        for slot in idle:
+            slot.close()
+        return len(idle)
+    
+    def get_stats(self) -> dict:
+        """Return slot usage and overload counters"""
+        with self.lock:
+            stats = dict(self.counters)
+            stats['admission_active'] = len(self.active)
+            stats['admission_queued'] = len(self.pending)
+        stats.update(self.budget.get_stats())
+        return stats
+    
+    def get_tunnels(self) -> list:
+        """Return Slot.describe() of every active tunnel, largest buffers first"""
+        with self.lock:
+            slots = list(self.active)
+        tunnels = [slot.describe() for slot in slots]
+        tunnels.sort(key=lambda tunnel: tunnel['buffered_bytes'], reverse=True)
+        return tunnels
+    
+    def _has_room(self) -> bool:
+        """Whether a new connection may have a slot now (lock held)"""
+        return len(self.active) < self.max_tunnels and not self.budget.exhausted()
+    
+    def _grant(self, close, peer=None):
+        """Take a slot (lock held)"""
+        slot = Slot(close, self.budget, peer)
+        self.active.add(slot)
+        return slot
+    
+    def _expire(self, now) -> list:
+        """Drop queued connections past their deadline (lock held), returning their rejects"""
+        expired = []
+        while self.pending and self.pending[0][0] <= now:
+            expired.append(self.pending.popleft()[2])
+            self.counters['overload_queue_timeouts'] += 1
+        return expired
+    
+    def _schedule_expiry(self):
+        """Make sure a timer fires at the oldest queued connection's deadline (lock held)"""
+        if self.pending and self.expiry_timer is None:
+            delay = max(self.pending[0][0] - time.monotonic(), 0)
+            self.expiry_timer = threading.Timer(delay, self.expire)
+            self.expiry_timer.daemon = True
+            self.expiry_timer.start()
+    
+    def _idle_victim(self, now):
+        """The sheddable slot idle longest, if idle long enough (lock held)"""
+        candidates = [slot for slot in self.active
+                      if slot.sheddable and not slot.closed
+                      and now - slot.last_active >= self.min_shed_idle]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda slot: slot.last_active)
+
+
+async def admit_stream(admission, writer):
+    """
+    Wait for an admission slot for an asyncio connection
+    
+    Returns:
+        The Slot, or None if the connection was turned away (it has then
+        been reset)
+    """
+    loop = asyncio.get_running_loop()
+    admitted = loop.create_future()
+    
+    def settle(slot):
+        if not admitted.done():
+            admitted.set_result(slot)
+        elif slot is not None:
+            # The connection went away while queued
+            admission.release(slot)
+    
+    # Callbacks may run on other threads (release, queue expiry)
+    admission.admit(
+        lambda slot: loop.call_soon_threadsafe(settle, slot),
+        lambda: loop.call_soon_threadsafe(settle, None),
+        lambda: loop.call_soon_threadsafe(writer.transport.abort),
+        writer.get_extra_info('peername')
+    )
+    slot = await admitted
+    if slot is None:
+        set_reset_on_close(writer.get_extra_info('socket'))
+        writer.transport.abort()
+    return slot
+
+
+class IdleReaper:
+    """Background thread closing tunnels that stopped moving data"""
+    
+    def __init__(self, admission, idle_timeout=DEFAULT_IDLE_TIMEOUT):
+        """
+        Initialize reaper
+        
+        Args:
+            admission: AdmissionControl whose connections are watched
+            idle_timeout: Seconds without traffic before a tunnel is closed
+        """
+        self.admission = admission
+        self.idle_timeout = idle_timeout
+        self.interval = min(REAP_INTERVAL, idle_timeout / 2)
+        self.stopped = threading.Event()
+    
+    def start(self):
+        """Start scanning in a daemon thread"""
+        threading.Thread(target=self._run, name='idle-reaper', daemon=True).start()
+    
+    def stop(self):
+        """Stop scanning"""
+        self.stopped.set()
+    
+    def _run(self):
+        """Scan every interval until stopped"""
+        while not self.stopped.wait(self.interval):
+            reaped = self.admission.reap_idle(self.idle_timeout)
+            if reaped:
+                log.info("Closed %s tunnel(s) idle for %.0fs", reaped, self.idle_timeout)
+
+
+def create_reaper(admission, idle_timeout):
+    """Return a started IdleReaper, or None if idle_timeout is 0"""
+    if not idle_timeout:
+        return None
+    reaper = IdleReaper(admission, idle_timeout)
+    reaper.start()
+    return reaper
+
+
+def set_thread_stack_size(size):
+    """
+    Reserve size bytes of stack for every thread started from now on
+    
+    Relay threads need little stack, so a few hundred KiB instead of the
+    platform default keeps thousands of tunnel threads within the address
+    space and overcommit limits of a small machine. The setting is process
+    wide and inherited by forked workers.
+    
+    Args:
+        size: Bytes, at least 32 KiB; 0 restores the platform default
+    
+    Raises:
+        ValueError: if the platform refuses the size
+    """
+    try:
+        threading.stack_size(size)
+    except (ValueError, RuntimeError) as e:
+        raise ValueError(f"Unsupported thread stack size {size}: {e}") from None
+
+
+class WorkerPool:
+    """At most max_workers handler threads, started on demand and retired when idle"""
+    
+    def __init__(self, max_workers, name='worker', idle_timeout=WORKER_IDLE_TIMEOUT):
+        """
+        Initialize pool
+        
+        Args:
+            max_workers: Upper bound on threads
+            name: Thread name prefix
+            idle_timeout: Seconds an idle thread lingers before exiting
+        """
+        self.max_workers = max_workers
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self.jobs = queue.SimpleQueue()
+        self.workers = 0
+        self.idle = 0
+        # Jobs no worker has claimed yet. A worker that took a job from the
+        # queue but has not claimed it still counts as idle, so submit()
+        # compares claims, not the queue length, or it could skip starting
+        # a thread the next job needs.
+        self.queued = 0
+        self.lock = threading.Lock()
+    
+    def submit(self, func, *args):
+        """Run func(*args) on a worker thread"""
+        with self.lock:
+            self.jobs.put((func, args))
+            self.queued += 1
+            if self.idle < self.queued and self.workers < self.max_workers:
+                self.workers += 1
+                self.idle += 1
+                threading.Thread(target=self._run, name=f"{self.name}-{self.workers}",
+                                 daemon=True).start()
+    
+    def get_stats(self) -> dict:
+        """Return thread counts"""
+        with self.lock:
+            return {'workers': self.workers, 'workers_busy': self.workers - self.idle}
+    
+    def _run(self):
+        """Worker thread: run jobs until idle for idle_timeout"""
+        while True:
+            try:
+                func, args = self.jobs.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self.lock:
+                    if not self.queued:
+                        self.workers -= 1
+                        self.idle -= 1
+                        return
+                continue
+            
+            with self.lock:
+                self.queued -= 1
+                self.idle -= 1
+            try:
+                func(*args)
+            except Exception as e:
+                get_logger(self.name).error("Unhandled error: %s", e)
+            with self.lock:
+                self.idle += 1
@@ -0,0 +1,314 @@
+"""
+Async SOCKS5 Proxy - asyncio front-end serving all local clients on one event loop
+"""
+import asyncio
+import socket
+import struct
+import time
+from functools import partial
+from async_server import read_records, relay_records
+from compression import client_handshake
+from connect_status import CONNECT_REQUEST, STATUS_FAILURE, STATUS_SUCCEEDED, parse_status, socks_reply, status_message
+from crypto_utils import VPNCrypto
+from load_balancer import MAX_CONNECT_ATTEMPTS
+from metrics import CONNECT_SECONDS, HANDSHAKE_SECONDS, count_error
+from socks5_proxy import EARLY_DATA_WAIT, MAX_EARLY_DATA, SOCKS5Proxy
+from admission import admit_stream, set_keepalive, set_reset_on_close
+from vpn_logging import get_logger
+
+
+log = get_logger('proxy')
+
+SOCKS_REPLY_SUCCESS = b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00'
+SOCKS_REPLY_FAILURE = b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00'
+SOCKS_REPLY_UNSUPPORTED = b'\x05\x07\x00\x01\x00\x00\x00\x00\x00\x00'
+
+# Deadline for TCP connect plus key exchange with the VPN server
+SERVER_CONNECT_TIMEOUT = 10
+
+
+class AsyncSOCKS5Proxy(SOCKS5Proxy):
+    """SOCKS5 proxy parsing and tunneling every client on a single asyncio event loop"""
+    
+    def start(self):
+        """Start the SOCKS5 proxy server and block until it stops"""
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            log.error("Error: %s", e)
+        finally:
+            self.stop()
+    
+    async def serve(self):
+        """Accept local clients until stop() is called"""
+        self.loop = asyncio.get_running_loop()
+        self.async_server = await asyncio.start_server(
+            self.handle_connection, '127.0.0.1', self.local_port, reuse_address=True,
+            backlog=self.backlog
+        )
+        self.running = True
+        self.start_metrics()
+        self.start_reaper()
+        
+        log.info("SOCKS5 proxy listening on 127.0.0.1:%s (asyncio engine)", self.local_port)
+        log.info("Configure your applications to use this proxy")
+        log.info("Server: 127.0.0.1, Port: %s", self.local_port)
+        log.info("Routing all traffic through VPN server: %s", self.describe_servers())
+        
+        async with self.async_server:
+            try:
+                await self.async_server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+    
+    async def handle_connection(self, reader, writer):
+        """Handle SOCKS5 client connection"""
+        slot = await admit_stream(self.admission, writer)
+        if slot is None:
+            log.warning("Overloaded, rejecting %s", writer.get_extra_info('peername'))
+            return
+        set_keepalive(writer.get_extra_info('socket'), self.keepalive)
+        
+        # The VPN server is known up front, so connect and key the upstream
+        # connection while the SOCKS handshake is still being parsed
+        endpoint = self.balancer.choose()
+        upstream = asyncio.ensure_future(self.open_upstream(endpoint))
+        self.count('connections_total')
+        self.count('connections_active')
+        try:
+            request = await self.read_request(reader, writer)
+            if request is None:
+                return
+            addr, port = request
+            log.info("Client wants to connect to %s:%s", addr, port)
+            
+            early_data = self.connect_mode == 'early-data'
+            if early_data:
+                # Let the application start sending while the upstream connection is set up
+                writer.write(SOCKS_REPLY_SUCCESS)
+            
+            try:
+                connection, endpoint = await self.failover(upstream, endpoint)
+            except Exception as e:
+                endpoint = None
+                log.warning("Failed to connect to VPN server: %s", e)
+                self.count('server_connect_failures')
+                count_error('server_connect')
+                if early_data:
+                    self.reset(writer)
+                    return
+                writer.write(SOCKS_REPLY_FAILURE)
+                await writer.drain()
+                return
+            server_reader, server_writer, encoder, decoder = connection
+            
+            offer = b''
+            if self.compression:
+                offer, encoder, decoder = client_handshake(
+                    encoder, decoder, self.compression, self.compression_level)
+            request = f"{addr}:{port}".encode()
+            
+            if self.connect_mode == 'optimistic':
+                # Target request and SOCKS reply go out together
+                server_writer.write(offer + encoder.encode(request))
+                writer.write(SOCKS_REPLY_SUCCESS)
+            elif not await self.confirm_target(reader, writer, server_reader, server_writer,
+                                               encoder, decoder, offer + encoder.encode(CONNECT_REQUEST + request),
+                                               addr, port):
+                server_writer.close()
+                return
+            
+            # A half-closed tunnel only ends once the server side ends too
+            slot.add_closer(partial(self.loop.call_soon_threadsafe, server_writer.transport.abort))
+            try:
+                await relay_records(server_reader, server_writer, reader, writer, encoder, decoder,
+                                    slot=slot)
+            except Exception as e:
+                log.warning("Tunneling error: %s", e)
+                count_error('tunnel')
+            finally:
+                server_writer.close()
+                self.report_compression(addr, port, encoder, decoder)
+        
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            log.warning("Error handling client: %s", e)
+            count_error('client')
+        finally:
+            self.discard_upstream(upstream)
+            if endpoint is not None:
+                self.balancer.release(endpoint)
+            writer.close()
+            self.count('connections_active', -1)
+            self.admission.release(slot)
+    
+    async def read_request(self, reader, writer):
+        """
+        Parse the SOCKS5 greeting and CONNECT request
+        
+        Returns:
+            (addr, port), or None if the client was rejected
+        """
+        version, nmethods = await reader.readexactly(2)
+        if version != 5:
+            return None
+        await reader.readexactly(nmethods)
+        
+        # Send no authentication required
+        writer.write(b'\x05\x00')
+        
+        version, cmd, _, addr_type = await reader.readexactly(4)
+        if version != 5:
+            return None
+        if cmd != 1:  # Only support CONNECT
+            writer.write(SOCKS_REPLY_UNSUPPORTED)
+            await writer.drain()
+            return None
+        
+        if addr_type == 1:  # IPv4
+            addr = socket.inet_ntoa(await reader.readexactly(4))
+        elif addr_type == 3:  # Domain name
+            addr_len = (await reader.readexactly(1))[0]
+            addr = (await reader.readexactly(addr_len)).decode()
+        elif addr_type == 4:  # IPv6
+            addr = socket.inet_ntop(socket.AF_INET6, await reader.readexactly(16))
+        else:
+            return None
+        
+        port = struct.unpack('>H', await reader.readexactly(2))[0]
+        return addr, port
+    
+    async def confirm_target(self, reader, writer, server_reader, server_writer, encoder, decoder,
+                             request, addr, port):
+        """
+        Send a status request (with early data in early-data mode) and
+        answer the SOCKS client according to the server's connect status
+        
+        Returns:
+            True if the target is connected and the tunnel can be relayed
+        """
+        early_data = b''
+        if self.connect_mode == 'early-data':
+            try:
+                early_data = await asyncio.wait_for(reader.read(MAX_EARLY_DATA), EARLY_DATA_WAIT)
+            except asyncio.TimeoutError:
+                pass
+        server_writer.write(request + (encoder.encode(early_data) if early_data else b''))
+        
+        try:
+            records = await read_records(server_reader, decoder)
+            if records is None:
+                raise ConnectionError("Connection closed by server")
+            code = parse_status(records[0])
+        except Exception as e:
+            log.warning("No connect status from VPN server: %s", e)
+            code = STATUS_FAILURE
+        if code != STATUS_SUCCEEDED:
+            log.warning("VPN server could not connect to %s:%s: %s", addr, port, status_message(code))
+            self.count('target_failures')
+            if self.connect_mode == 'confirmed':
+                writer.write(socks_reply(code))
+                await writer.drain()
+            else:
+                self.reset(writer)
+            return False
+        
+        if self.connect_mode == 'confirmed':
+            writer.write(SOCKS_REPLY_SUCCESS)
+        for payload in records[1:]:
+            writer.write(payload)
+        return True
+    
+    def reset(self, writer):
+        """Abort a client connection with a TCP RST"""
+        set_reset_on_close(writer.get_extra_info('socket'))
+        writer.transport.abort()
+    
+    async def failover(self, upstream, endpoint):
+        """
+        Await the speculative upstream connection, trying other endpoints
+        while it cannot be established
+        
+        Returns:
+            (connection, endpoint) of the attempt that succeeded
+        
+        Raises:
+            The last connect error; every tried endpoint is released by then
+        """
+        tried = [endpoint]
+        attempts = min(MAX_CONNECT_ATTEMPTS, len(self.balancer.endpoints))
+        while True:
+            try:
+                connection = await upstream
+            except Exception:
+                self.balancer.report_failure(endpoint)
+                self.balancer.release(endpoint)
+                endpoint = self.balancer.choose(exclude=tried) if len(tried) < attempts else None
+                if endpoint is None:
+                    raise
+                self.count('server_failovers')
+                tried.append(endpoint)
+                upstream = asyncio.ensure_future(self.open_upstream(endpoint))
+                continue
+            self.balancer.report_success(endpoint)
+            return connection, endpoint
+    
+    async def open_upstream(self, endpoint):
+        """Connect to a VPN server endpoint and receive the session key"""
+        return await asyncio.wait_for(self._open_upstream(endpoint), SERVER_CONNECT_TIMEOUT)
+    
+    async def _open_upstream(self, endpoint):
+        """Connect and key without a deadline, see open_upstream()"""
+        started = time.perf_counter()
+        server_reader, server_writer = await asyncio.open_connection(
+            sock=await self.connect_socket(endpoint))
+        set_keepalive(server_writer.get_extra_info('socket'), self.keepalive)
+        connected = time.perf_counter()
+        CONNECT_SECONDS.observe(connected - started)
+        try:
+            key_length = int.from_bytes(await server_reader.readexactly(4), 'big')
+            key = await server_reader.readexactly(key_length)
+        except BaseException:
+            server_writer.close()
+            raise
+        HANDSHAKE_SECONDS.observe(time.perf_counter() - connected)
+        
+        crypto = VPNCrypto(deferred=True)
+        crypto.set_key(key)
+        return server_reader, server_writer, crypto.new_record_encoder(), crypto.new_record_decoder()
+    
+    async def connect_socket(self, endpoint):
+        """Connect a socket to an endpoint, tuned before the handshake like VPNClient's"""
+        loop = asyncio.get_running_loop()
+        addresses = await loop.getaddrinfo(endpoint.host, endpoint.port, type=socket.SOCK_STREAM)
+        family, _, _, _, sockaddr = addresses[0]
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            self.tuner.tune(sock, 'server')
+            await loop.sock_connect(sock, sockaddr)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+    
+    def discard_upstream(self, upstream):
+        """Cancel or close an upstream connection that was not handed to a tunnel"""
+        if not upstream.done():
+            upstream.cancel()
+        elif not upstream.cancelled() and upstream.exception() is None:
+            upstream.result()[1].close()
+    
+    def stop(self):
+        """Stop the proxy server"""
+        self.running = False
+        loop = getattr(self, 'loop', None)
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self.async_server.close)
+            except RuntimeError:
+                pass
+        if self.reaper is not None:
+            self.reaper.stop()
+        log.info("Proxy stopped")
@@ -0,0 +1,711 @@
+"""
+Async VPN Server - asyncio engine serving all tunnels on one event loop
+"""
+import asyncio
+import socket
+import time
+from functools import partial
+from compression import is_offer, server_handshake, state_size
+from crypto_utils import MAX_RECORD_PAYLOAD
+from metrics import CONNECT_SECONDS, HANDSHAKE_SECONDS, count_error
+from tunnel_mux import (
+    MUX_HELLO, FRAME_HEADER, FRAME_OPEN, FRAME_DATA, FRAME_CLOSE, FRAME_WINDOW,
+    CLOSE_WRITE, MAX_FRAME_PAYLOAD, MAX_SESSION_STREAMS, WINDOW_INCREMENT, STREAM_WINDOW
+)
+from resolver import connect_error
+from connect_status import (
+    CONNECT_REQUEST, STATUS_SUCCEEDED, is_connect_request, make_status, status_for_error
+)
+from udp_relay import MAX_FRAMED_DATAGRAM, UDP_HELLO, build_datagram, parse_datagram
+from vpn_server import VPNServer
+from admission import REAP_INTERVAL, admit_stream, set_keepalive
+from vpn_logging import get_logger
+
+
+log = get_logger('server')
+
+# Bytes read from a socket per iteration
+READ_SIZE = 64 * 1024
+
+# Chunks at least this large are encrypted/decrypted in the default executor
+# so one bulk transfer cannot stall the other tunnels on the loop
+CRYPTO_OFFLOAD_THRESHOLD = 64 * 1024
+
+# Datagrams for a client with this much unsent data are dropped rather than
+# queued, as a congested UDP path would
+UDP_BUFFER_LIMIT = 256 * 1024
+
+
+class AsyncVPNServer(VPNServer):
+    """VPN Server speaking the same wire protocol on a single asyncio event loop"""
+    
+    def start(self):
+        """Start the VPN server and block until it stops"""
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            log.error("Error: %s", e)
+        finally:
+            self.stop()
+    
+    async def serve(self):
+        """Accept clients until stop() is called"""
+        self.loop = asyncio.get_running_loop()
+        self.async_server = await asyncio.start_server(
+            self.handle_connection, self.host, self.port, reuse_address=True,
+            reuse_port=self.reuse_port or None, backlog=self.backlog
+        )
+        for listener in self.async_server.sockets:
+            self.tuner.tune_listener(listener)
+        self.running = True
+        self.start_metrics()
+        self.start_reaper()
+        
+        log.info("Listening on %s:%s (asyncio engine)", self.host, self.port)
+        log.info("Waiting for client connections...")
+        
+        async with self.async_server:
+            try:
+                await self.async_server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+    
+    async def handle_connection(self, reader, writer):
+        """Handle a client connection"""
+        client_address = writer.get_extra_info('peername')
+        log.info("New client connected from %s", client_address)
+        set_keepalive(writer.get_extra_info('socket'), self.keepalive)
+        self.tuner.tune(writer.get_extra_info('socket'), 'client')
+        slot = await admit_stream(self.admission, writer)
+        if slot is None:
+            log.warning("Overloaded, rejecting %s", client_address)
+            return
+        self.count('connections_total')
+        self.count('connections_active')
+        started = time.perf_counter()
+        limits = self.client_limits(client_address)
+        
+        try:
+            # Send encryption key to client
+            key = self.crypto.get_key()
+            writer.write(len(key).to_bytes(4, 'big') + key)
+            await writer.drain()
+            
+            # Receive target connection info from client
+            encoder = self.crypto.new_record_encoder(self.crypto_pool)
+            decoder = self.crypto.new_record_decoder(self.crypto_pool)
+            decoder.set_account(slot)
+            records = await read_records(reader, decoder)
+            if records is None:
+                return
+            
+            if is_offer(records[0]):
+                # Compression offer, the actual request follows
+                reply, encoder, decoder = server_handshake(
+                    records[0], encoder, decoder, self.compression)
+                slot.charge(state_size(encoder, decoder))
+                writer.write(reply)
+                records = decoder.unwrap(records[1:]) or await read_records(reader, decoder)
+                if records is None:
+                    return
+            
+            HANDSHAKE_SECONDS.observe(time.perf_counter() - started)
+            if records[0] == MUX_HELLO:
+                log.info("Client %s switched to multiplexed mode", client_address)
+                slot.sheddable = False
+                slot.target = 'mux'
+                session = AsyncMuxSession(self, reader, writer, encoder, decoder, limits)
+                try:
+                    await session.run(records[1:])
+                finally:
+                    self.report_compression(client_address, encoder, decoder)
+                return
+            
+            if records[0] == UDP_HELLO:
+                log.info("Client %s opened a UDP association", client_address)
+                self.count('udp_associations_total')
+                slot.sheddable = False
+                slot.target = 'udp'
+                association = AsyncUDPAssociation(self, reader, writer, encoder, decoder, limits)
+                try:
+                    await association.run(records[1:])
+                finally:
+                    self.report_compression(client_address, encoder, decoder)
+                return
+            
+            # Clients asking for a connect status get one before any data
+            request = records[0]
+            want_status = is_connect_request(request)
+            if want_status:
+                request = request[len(CONNECT_REQUEST):]
+            
+            target_host, target_port = bytes(request).decode().rsplit(':', 1)
+            target_port = int(target_port)
+            log.info("Client wants to connect to %s:%s", target_host, target_port)
+            slot.target = f"{target_host}:{target_port}"
+            
+            try:
+                target_reader, target_writer = await self.open_target(target_host, target_port)
+            except Exception as e:
+                log.warning("Failed to connect to target: %s", e)
+                if want_status:
+                    writer.write(encoder.encode(make_status(status_for_error(e))))
+                    await writer.drain()
+                return
+            
+            if want_status:
+                writer.write(encoder.encode(make_status(STATUS_SUCCEEDED)))
+            slot.add_closer(partial(self.loop.call_soon_threadsafe, target_writer.transport.abort))
+            
+            # Forward any data the client sent along with the request
+            for payload in records[1:]:
+                target_writer.write(payload)
+            
+            await self.tunnel_streams(reader, writer, target_reader, target_writer,
+                                      encoder, decoder, limits, slot)
+            self.report_compression(client_address, encoder, decoder)
+        
+        except Exception as e:
+            log.warning("Error handling client: %s", e)
+            count_error('client')
+        finally:
+            writer.close()
+            self.release_limits(limits)
+            self.admission.release(slot)
+            self.count('connections_active', -1)
+            log.info("Client %s disconnected", client_address)
+    
+    async def open_target(self, target_host, target_port):
+        """Open a connection to the target without blocking the loop"""
+        resolver = self.resolver
+        started = time.perf_counter()
+        try:
+            # Cached answers skip the executor round trip entirely
+            addresses = resolver.cached(target_host, target_port)
+            if addresses is None:
+                loop = asyncio.get_running_loop()
+                addresses = await loop.run_in_executor(
+                    None, resolver.resolve, target_host, target_port)
+            target_socket = await asyncio.wait_for(
+                connect_racing(addresses, resolver.happy_eyeballs_delay,
+                               partial(self.tuner.tune, role='target')),
+                resolver.connect_timeout
+            )
+            set_keepalive(target_socket, self.keepalive)
+            target_reader, target_writer = await asyncio.open_connection(sock=target_socket)
+        except Exception:
+            self.count('target_failures')
+            count_error('target_connect')
+            raise
+        CONNECT_SECONDS.observe(time.perf_counter() - started)
+        log.info("Connected to target %s:%s", target_host, target_port)
+        return target_reader, target_writer
+    
+    async def tunnel_streams(self, reader, writer, target_reader, target_writer, encoder, decoder,
+                             limits=None, slot=None):
+        """Tunnel traffic between client and target until both sides are done"""
+        try:
+            await relay_records(reader, writer, target_reader, target_writer, encoder, decoder,
+                                limits, slot)
+        except Exception as e:
+            log.warning("Tunneling error: %s", e)
+            count_error('tunnel')
+    
+    def stop(self):
+        """Stop the VPN server"""
+        self.running = False
+        loop = getattr(self, 'loop', None)
+        if loop is not None and not loop.is_closed():
+            try:
+                loop.call_soon_threadsafe(self.async_server.close)
+            except RuntimeError:
+                pass
+        if self.crypto_pool is not None:
+            self.crypto_pool.shutdown()
+        if self.reaper is not None:
+            self.reaper.stop()
+        log.info("Server stopped")
+
+
+class AsyncMuxStream:
+    """Server side of one multiplexed stream"""
+    
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        # Client data; b'' once the client half-closed, None when the stream ends
+        self.inbound = asyncio.Queue()
+        self.send_window = STREAM_WINDOW
+        # Bytes the client may still send before it needs credit, so a
+        # client ignoring WINDOW frames cannot grow inbound without bound
+        self.recv_window = STREAM_WINDOW
+        self.window_open = asyncio.Event()
+        self.target_writer = None
+        self.task = None
+        self.closed = False
+        self.last_active = time.monotonic()
+        # Half-closes passed on: client -> target and target -> client
+        self.client_shut = False
+        self.target_shut = False
+
+
+class AsyncMuxSession:
+    """Serves the mux protocol of tunnel_mux on the event loop"""
+    
+    def __init__(self, server, reader, writer, encoder, decoder, limits=None,
+                 max_streams=MAX_SESSION_STREAMS):
+        """
+        Initialize session
+        
+        Args:
+            server: Owning AsyncVPNServer, used to open targets
+            reader: Stream reader for the client connection
+            writer: Stream writer for the client connection
+            encoder: Record encoder for outgoing frames
+            decoder: Record decoder for incoming frames
+            limits: Client's rate_limit.ClientLimits (optional)
+            max_streams: Streams the client may have open at once
+        """
+        self.server = server
+        self.limits = limits
+        self.max_streams = max_streams
+        self.reader = reader
+        self.writer = writer
+        self.encoder = encoder
+        self.decoder = decoder
+        self.streams = {}
+        self.drain_lock = asyncio.Lock()
+    
+    async def run(self, initial_records=()):
+        """Read frames until the client disconnects"""
+        reaper = None
+        if self.server.idle_timeout:
+            reaper = asyncio.ensure_future(self.close_idle(self.server.idle_timeout))
+        try:
+            for record in initial_records:
+                self.dispatch(record)
+            while True:
+                data = await self.reader.read(READ_SIZE)
+                if not data:
+                    break
+                for record in await run_crypto(self.decoder.feed, data):
+                    self.dispatch(record)
+        finally:
+            if reaper is not None:
+                reaper.cancel()
+            for stream in list(self.streams.values()):
+                self.finish(stream, notify=False)
+    
+    async def close_idle(self, idle_timeout):
+        """Close streams that moved no data for idle_timeout seconds, as IdleReaper does tunnels"""
+        interval = min(REAP_INTERVAL, idle_timeout / 2)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            idle = [stream for stream in self.streams.values()
+                    if now - stream.last_active >= idle_timeout]
+            for stream in idle:
+                self.finish(stream)
+            if idle:
+                log.info("Closed %s stream(s) idle for %.0fs", len(idle), idle_timeout)
+    
+    async def send_frame(self, frame_type, stream_id, payload):
+        """Encrypt and send one frame, waiting for the client to keep up"""
+        header = FRAME_HEADER.pack(frame_type, stream_id)
+        self.writer.write(self.encoder.encode(header + payload))
+        async with self.drain_lock:
+            await self.writer.drain()
+    
+    def dispatch(self, record):
+        """Handle one received frame"""
+        frame_type, stream_id = FRAME_HEADER.unpack_from(record)
+        payload = record[FRAME_HEADER.size:]
+        
+        if frame_type == FRAME_OPEN:
+            self.accept_stream(stream_id, payload)
+            return
+        
+        stream = self.streams.get(stream_id)
+        if stream is None:
+            return
+        
+        if frame_type == FRAME_DATA:
+            if len(payload) > stream.recv_window:
+                raise ValueError(f"Stream {stream_id} exceeded its flow-control window")
+            stream.recv_window -= len(payload)
+            stream.inbound.put_nowait(payload)
+        elif frame_type == FRAME_WINDOW:
+            stream.send_window += WINDOW_INCREMENT.unpack(payload)[0]
+            stream.window_open.set()
+        elif frame_type == FRAME_CLOSE:
+            stream.inbound.put_nowait(b'' if payload == CLOSE_WRITE else None)
+        else:
+            raise ValueError(f"Unknown frame type {frame_type}")
+    
+    def accept_stream(self, stream_id, target_info):
+        """Handle an OPEN frame, see MuxSession._accept_stream()"""
+        if stream_id in self.streams:
+            raise ValueError(f"Duplicate stream id {stream_id}")
+        try:
+            target_host, target_port = bytes(target_info).decode().rsplit(':', 1)
+            target_port = int(target_port)
+        except ValueError:
+            # Only this stream is refused, the others keep going
+            log.warning("Invalid target for stream %s: %r", stream_id, bytes(target_info[:100]))
+            self.refuse(stream_id)
+            return
+        if len(self.streams) >= self.max_streams:
+            log.warning("Session has %s streams open, refusing stream %s",
+                        self.max_streams, stream_id)
+            self.refuse(stream_id)
+            return
+        
+        stream = AsyncMuxStream(stream_id)
+        self.streams[stream_id] = stream
+        stream.task = asyncio.ensure_future(self.serve_stream(stream, target_host, target_port))
+    
+    def refuse(self, stream_id):
+        """Close a stream the client asked for without serving it"""
+        self.writer.write(self.encoder.encode(FRAME_HEADER.pack(FRAME_CLOSE, stream_id)))
+    
+    async def serve_stream(self, stream, target_host, target_port):
+        """Connect a stream to its target and relay both directions"""
+        log.info("Stream %s wants to connect to %s:%s", stream.stream_id, target_host, target_port)
+        try:
+            target_reader, stream.target_writer = await self.server.open_target(
+                target_host, target_port)
+        except Exception as e:
+            log.warning("Failed to connect to target: %s", e)
+            self.finish(stream)
+            return
+        
+        pump = asyncio.ensure_future(self.pump_target(stream, target_reader))
+        try:
+            # Client -> target, granting credit once data has been written
+            unacked = 0
+            while True:
+                data = await stream.inbound.get()
+                if data is None:
+                    break
+                stream.recv_window += len(data)
+                if not data:
+                    # The client is done sending; the target may still answer
+                    stream.client_shut = True
+                    if stream.target_writer.can_write_eof():
+                        stream.target_writer.write_eof()
+                    if stream.target_shut:
+                        break
+                    continue
+                stream.target_writer.write(data)
+                await stream.target_writer.drain()
+                stream.last_active = time.monotonic()
+                await throttle(self.limits, 'upload', len(data))
+                unacked += len(data)
+                if unacked >= STREAM_WINDOW // 2:
+                    await self.send_frame(FRAME_WINDOW, stream.stream_id,
+                                          WINDOW_INCREMENT.pack(unacked))
+                    unacked = 0
+        except Exception:
+            pass
+        finally:
+            pump.cancel()
+            self.finish(stream)
+    
+    async def pump_target(self, stream, target_reader):
+        """Relay target -> client within the stream's flow-control window"""
+        try:
+            while True:
+                while stream.send_window <= 0:
+                    stream.window_open.clear()
+                    await stream.window_open.wait()
+                data = await target_reader.read(min(stream.send_window, MAX_FRAME_PAYLOAD))
+                if not data:
+                    break
+                stream.send_window -= len(data)
+                stream.last_active = time.monotonic()
+                await self.send_frame(FRAME_DATA, stream.stream_id, data)
+                await throttle(self.limits, 'download', len(data))
+            # The target is done sending; keep relaying the client's data
+            # until it is done as well
+            await self.send_frame(FRAME_CLOSE, stream.stream_id, CLOSE_WRITE)
+            stream.target_shut = True
+            if not stream.client_shut:
+                return
+        except Exception:
+            pass
+        stream.inbound.put_nowait(None)
+    
+    def finish(self, stream, notify=True):
+        """Close a stream's target and tell the client"""
+        if stream.closed:
+            return
+        stream.closed = True
+        self.streams.pop(stream.stream_id, None)
+        if stream.target_writer is not None:
+            stream.target_writer.close()
+        if stream.task is not None and stream.task is not asyncio.current_task():
+            stream.task.cancel()
+        if notify:
+            header = FRAME_HEADER.pack(FRAME_CLOSE, stream.stream_id)
+            try:
+                self.writer.write(self.encoder.encode(header))
+            except Exception:
+                pass
+
+
+class AsyncUDPAssociation(asyncio.DatagramProtocol):
+    """Serves a UDP association (see udp_relay) on the event loop"""
+    
+    def __init__(self, server, reader, writer, encoder, decoder, limits=None):
+        """
+        Initialize association
+        
+        Args:
+            server: Owning AsyncVPNServer, used to resolve destinations
+            reader: Stream reader for the client connection
+            writer: Stream writer for the client connection
+            encoder: Record encoder for datagrams to the client
+            decoder: Record decoder for datagrams from the client
+            limits: Client's rate_limit.ClientLimits (optional)
+        """
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.encoder = encoder
+        self.decoder = decoder
+        self.limits = limits
+        # One unconnected datagram transport per address family
+        self.transports = {}
+        # Destination transports stop reading while the client is over its
+        # download rate
+        self.download_paused = False
+        self.last_activity = time.monotonic()
+        self.datagrams_sent = 0
+        self.datagrams_received = 0
+        self.datagrams_dropped = 0
+    
+    async def run(self, initial_records=()):
+        """Relay until the client disconnects or the association is idle"""
+        try:
+            for record in initial_records:
+                await self.forward(record)
+            while True:
+                timeout = self.server.udp_idle_timeout - (time.monotonic() - self.last_activity)
+                if timeout <= 0:
+                    log.info("UDP association idle, closing")
+                    return
+                try:
+                    data = await asyncio.wait_for(self.reader.read(READ_SIZE), timeout)
+                except asyncio.TimeoutError:
+                    continue
+                if not data:
+                    return
+                self.last_activity = time.monotonic()
+                records = self.decoder.feed(data)
+                for record in records:
+                    await self.forward(record)
+                await throttle(self.limits, 'upload', sum(len(record) for record in records))
+        finally:
+            for transport in self.transports.values():
+                transport.close()
+            log.info("UDP association closed: %s sent, %s received, %s dropped",
+                     self.datagrams_sent, self.datagrams_received, self.datagrams_dropped)
+    
+    async def forward(self, record):
+        """Send one datagram record to its destination, dropping it on any error"""
+        resolver = self.server.resolver
+        try:
+            host, port, data = parse_datagram(record)
+            addresses = resolver.cached(host, port)
+            if addresses is None:
+                loop = asyncio.get_running_loop()
+                addresses = await loop.run_in_executor(None, resolver.resolve, host, port)
+            family, sockaddr = addresses[0]
+            transport = self.transports.get(family)
+            if transport is None:
+                loop = asyncio.get_running_loop()
+                transport, _ = await loop.create_datagram_endpoint(lambda: self, family=family)
+                self.transports[family] = transport
+                if self.download_paused:
+                    transport.pause_reading()
+            transport.sendto(data, sockaddr)
+            self.datagrams_sent += 1
+        except (ValueError, OSError, IndexError):
+            self.datagrams_dropped += 1
+    
+    def datagram_received(self, data, addr):
+        """Frame a datagram from a destination and send it to the client"""
+        framed = build_datagram(addr[0], addr[1], data)
+        if (len(framed) > MAX_FRAMED_DATAGRAM or self.writer.is_closing()
+                or self.writer.transport.get_write_buffer_size() > UDP_BUFFER_LIMIT):
+            self.datagrams_dropped += 1
+            return
+        self.last_activity = time.monotonic()
+        self.datagrams_received += 1
+        self.writer.write(self.encoder.encode(framed))
+        if self.limits is not None:
+            delay = self.limits.consume('download', len(framed))
+            if delay and not self.download_paused:
+                self.pause_download(delay)
+    
+    def pause_download(self, delay):
+        """Stop reading datagrams from destinations for delay seconds"""
+        self.download_paused = True
+        for transport in self.transports.values():
+            transport.pause_reading()
+        asyncio.get_running_loop().call_later(delay, self.resume_download)
+    
+    def resume_download(self):
+        """Read from destinations again after pause_download()"""
+        self.download_paused = False
+        for transport in self.transports.values():
+            if not transport.is_closing():
+                transport.resume_reading()
+
+
+async def relay_records(record_reader, record_writer, plain_reader, plain_writer,
+                        encoder, decoder, limits=None, slot=None):
+    """
+    Relay between a record-encrypted connection and a plain one
+    
+    A side that stops sending is passed on as a half-close to the other,
+    and the relay returns once both directions have ended, closing the
+    plain side. Errors from either direction are re-raised at once.
+    limits (a rate_limit.ClientLimits) is charged 'upload' for record ->
+    plain and 'download' for plain -> record; slot (an admission.Slot)
+    counts the data and is charged for each chunk until it has been sent.
+    """
+    def read_size():
+        # Smaller chunks while all tunnels together buffer too much
+        return MAX_RECORD_PAYLOAD if slot is not None and slot.over_budget() else READ_SIZE
+    
+    async def records_to_plain():
+        while True:
+            data = await record_reader.read(read_size())
+            if not data:
+                end_stream(plain_writer)
+                return
+            if slot is not None:
+                slot.charge(len(data))
+            payloads = await run_crypto(decoder.feed, data)
+            for payload in payloads:
+                plain_writer.write(payload)
+            await plain_writer.drain()
+            amount = sum(len(payload) for payload in payloads)
+            if slot is not None:
+                slot.release(len(data))
+                slot.count('upload', amount)
+            if limits is not None:
+                await throttle(limits, 'upload', amount)
+    
+    async def plain_to_records():
+        while True:
+            data = await plain_reader.read(read_size())
+            if not data:
+                end_stream(record_writer)
+                return
+            if slot is not None:
+                slot.charge(len(data))
+            record_writer.write(await run_crypto(encoder.encode, data))
+            await record_writer.drain()
+            if slot is not None:
+                slot.release(len(data))
+                slot.count('download', len(data))
+            if limits is not None:
+                await throttle(limits, 'download', len(data))
+    
+    tasks = [
+        asyncio.ensure_future(records_to_plain()),
+        asyncio.ensure_future(plain_to_records()),
+    ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+    finally:
+        for task in tasks:
+            task.cancel()
+        plain_writer.close()
+
+
+def end_stream(writer):
+    """Half-close a stream once its buffered data is sent"""
+    try:
+        if writer.can_write_eof():
+            writer.write_eof()
+    except (OSError, RuntimeError):
+        pass
+
+
+async def connect_racing(addresses, delay, prepare=None):
+    """
+    Event loop version of resolver.happy_eyeballs_connect()
+    
+    Returns:
+        The connected non-blocking socket of the first attempt to succeed
+    """
+    loop = asyncio.get_running_loop()
+    
+    async def attempt(family, sockaddr):
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            if prepare is not None:
+                prepare(sock)
+            await loop.sock_connect(sock, sockaddr)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
+    
+    candidates = list(addresses)
+    attempts = set()
+    errors = []
+    try:
+        while candidates or attempts:
+            if candidates:
+                attempts.add(asyncio.ensure_future(attempt(*candidates.pop(0))))
+            # Start the next attempt after delay, or at once if one fails
+            done, attempts = await asyncio.wait(
+                attempts, timeout=delay if candidates else None,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            winners = [task for task in done if task.exception() is None]
+            if winners:
+                # Losers that also connected are closed below
+                attempts |= done - {winners[0]}
+                return winners[0].result()
+            errors.extend(task.exception() for task in done)
+    finally:
+        for task in attempts:
+            if not task.cancel() and task.exception() is None:
+                task.result().close()
+    raise connect_error(errors)
+
+
+async def read_records(reader, decoder):
+    """Read until at least one record has arrived, None on EOF"""
+    records = []
+    while not records:
+        data = await reader.read(MAX_RECORD_PAYLOAD)
+        if not data:
+            return None
+        records = decoder.feed(data)
+    return records
+
+
+async def throttle(limits, direction, amount):
+    """Charge a client's rate limits and sleep while it is over them"""
+    if limits is None:
+        return
+    delay = limits.consume(direction, amount)
+    if delay:
+        await asyncio.sleep(delay)
+
+
+async def run_crypto(func, data):
+    """Run a record encode/decode, off the loop when the chunk is large"""
+    if len(data) < CRYPTO_OFFLOAD_THRESHOLD:
+        return func(data)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, data)
@@ -0,0 +1,350 @@
+"""
+Benchmark - Loopback microbenchmarks for the crypto and relay hot paths
+"""
+import json
+import os
+import platform
+import socket
+import statistics
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from crypto_utils import VPNCrypto, clear_key_cache, derive_password_key
+
+
+PAYLOAD_SIZES = (64, 1024, 16384, 65536)
+RELAY_ENGINES = ('threads', 'selectors', 'asyncio')
+
+# A result more than this fraction worse than the baseline is a regression
+DEFAULT_THRESHOLD = 0.10
+
+BENCH_PASSWORD = 'benchmark-password'
+
+
+class BenchmarkResults:
+    """Named measurements plus the direction that counts as better"""
+    
+    def __init__(self):
+        self.results = {}
+    
+    def add(self, name, value, unit, higher_is_better=True):
+        """Record one measurement"""
+        self.results[name] = {
+            'value': round(value, 3),
+            'unit': unit,
+            'higher_is_better': higher_is_better,
+        }
+        log(f"{name}: {value:,.3f} {unit}")
+    
+    def to_json(self) -> dict:
+        """Return the report written to disk"""
+        return {
+            'meta': {
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+            },
+            'results': self.results,
+        }
+
+
+def log(message):
+    """Progress output; stdout may carry the JSON report"""
+    print(f"[BENCH] {message}", file=sys.stderr)
+
+
+def time_loop(func, min_time):
+    """
+    Call func repeatedly for at least min_time seconds
+    
+    Returns:
+        Seconds per call
+    """
+    iterations = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        iterations += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / iterations
+
+
+def free_port() -> int:
+    """Return a currently unused loopback port"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_echo_server() -> int:
+    """Run an echo target on loopback and return its port"""
+    listener = socket.socket()
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(128)
+    
+    def echo(conn):
+        with conn:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    return
+                conn.sendall(data)
+    
+    def accept_loop():
+        while True:
+            conn, _ = listener.accept()
+            threading.Thread(target=echo, args=(conn,), daemon=True).start()
+    
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return listener.getsockname()[1]
+
+
+def wait_for_port(port, timeout=5):
+    """Block until something accepts connections on port"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Nothing listening on port {port}")
+
+
+def start_server(engine) -> int:
+    """Start a VPN server for an engine from RELAY_ENGINES and return its port"""
+    from vpn_server import create_server
+    
+    port = free_port()
+    if engine == 'asyncio':
+        server = create_server('asyncio', host='127.0.0.1', port=port, password=BENCH_PASSWORD)
+    else:
+        server = create_server('threads', host='127.0.0.1', port=port, password=BENCH_PASSWORD,
+                               relay=engine)
+    threading.Thread(target=server.start, daemon=True).start()
+    wait_for_port(port)
+    return port
+
+
+def bench_crypto(results, min_time):
+    """Per-record AES-GCM encode/decode and legacy Fernet cost across payload sizes"""
+    crypto = VPNCrypto(BENCH_PASSWORD)
+    for size in PAYLOAD_SIZES:
+        payload = os.urandom(size)
+        
+        encoder = crypto.new_record_encoder()
+        encoder.encode(b'')  # Emit the nonce prefix outside the loop
+        seconds = time_loop(lambda: encoder.encode(payload), min_time)
+        results.add(f"record_encrypt_{size}", seconds * 1e6, 'us/op', higher_is_better=False)
+        results.add(f"record_encrypt_{size}_throughput", size / seconds / 1e6, 'MB/s')
+        
+        # Decode a pre-encoded stream one record at a time
+        encoder = crypto.new_record_encoder()
+        records = [encoder.encode(payload) for _ in range(max(200, (8 * 1024 * 1024) // size))]
+        decoder = crypto.new_record_decoder()
+        start = time.perf_counter()
+        for record in records:
+            decoder.feed(record)
+        seconds = (time.perf_counter() - start) / len(records)
+        results.add(f"record_decrypt_{size}", seconds * 1e6, 'us/op', higher_is_better=False)
+        
+        token = crypto.encrypt(payload)
+        seconds = time_loop(lambda: crypto.encrypt(payload), min_time)
+        results.add(f"fernet_encrypt_{size}", seconds * 1e6, 'us/op', higher_is_better=False)
+        seconds = time_loop(lambda: crypto.decrypt(token), min_time)
+        results.add(f"fernet_decrypt_{size}", seconds * 1e6, 'us/op', higher_is_better=False)
+
+
+def bench_kdf(results, min_time):
+    """PBKDF2 key derivation, uncached and through the process-wide cache"""
+    def derive_uncached():
+        clear_key_cache()
+        derive_password_key(BENCH_PASSWORD)
+    
+    seconds = time_loop(derive_uncached, min_time)
+    results.add('kdf_uncached', seconds * 1e3, 'ms/op', higher_is_better=False)
+    
+    derive_password_key(BENCH_PASSWORD)
+    seconds = time_loop(lambda: derive_password_key(BENCH_PASSWORD), min_time)
+    results.add('kdf_cached', seconds * 1e6, 'us/op', higher_is_better=False)
+
+
+def bench_relay(results, engines, megabytes):
+    """Bulk echo throughput of one tunnel through each server relay engine"""
+    from vpn_client import VPNClient
+    
+    echo_port = start_echo_server()
+    total = megabytes * 1024 * 1024
+    chunk = os.urandom(64 * 1024)
+    
+    for engine in engines:
+        server_port = start_server(engine)
+        client = VPNClient('127.0.0.1', server_port, BENCH_PASSWORD)
+        if not client.connect_to_server():
+            raise RuntimeError("Could not connect to the benchmark server")
+        client.request_target('127.0.0.1', echo_port)
+        sock = client.server_socket
+        
+        def send_all():
+            sent = 0
+            while sent < total:
+                sock.sendall(client.encoder.encode(chunk))
+                sent += len(chunk)
+        
+        start = time.perf_counter()
+        sender = threading.Thread(target=send_all, daemon=True)
+        sender.start()
+        received = 0
+        while received < total:
+            payloads = client.decoder.recv_from(sock)
+            if payloads is None:
+                raise RuntimeError("Tunnel closed during relay benchmark")
+            received += sum(len(p) for p in payloads)
+        elapsed = time.perf_counter() - start
+        sender.join()
+        sock.close()
+        
+        # Every byte crosses the server twice (up and back)
+        results.add(f"relay_{engine}_throughput", 2 * total / elapsed / 1e6, 'MB/s')
+
+
+def socks_connect(proxy_port, target_port) -> socket.socket:
+    """Open a SOCKS5 CONNECT to a loopback target and wait for the reply"""
+    sock = socket.create_connection(('127.0.0.1', proxy_port))
+    sock.sendall(b'\x05\x01\x00')
+    sock.recv(2)
+    sock.sendall(b'\x05\x01\x00\x01' + socket.inet_aton('127.0.0.1') + struct.pack('>H', target_port))
+    reply = b''
+    while len(reply) < 10:
+        data = sock.recv(10 - len(reply))
+        if not data:
+            raise ConnectionError("Proxy closed the connection")
+        reply += data
+    if reply[1] != 0:
+        raise ConnectionError(f"SOCKS reply {reply[1]}")
+    return sock
+
+
+def bench_socks_setup(results, connections, concurrency, pool_min_idle):
+    """SOCKS5 connection setup rate and latency, first byte echoed included"""
+    from socks5_proxy import SOCKS5Proxy
+    
+    echo_port = start_echo_server()
+    server_port = start_server('threads')
+    proxy_port = free_port()
+    proxy = SOCKS5Proxy('127.0.0.1', server_port, proxy_port, BENCH_PASSWORD,
+                        pool_min_idle=pool_min_idle)
+    threading.Thread(target=proxy.start, daemon=True).start()
+    wait_for_port(proxy_port)
+    if pool_min_idle:
+        time.sleep(1)
+    
+    def one_connection():
+        start = time.perf_counter()
+        with socks_connect(proxy_port, echo_port) as sock:
+            sock.sendall(b'x')
+            sock.recv(1)
+        return time.perf_counter() - start
+    
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        latencies = sorted(executor.map(lambda _: one_connection(), range(connections)))
+    elapsed = time.perf_counter() - start
+    
+    name = 'socks_setup_pooled' if pool_min_idle else 'socks_setup'
+    results.add(f"{name}_rate", connections / elapsed, 'conn/s')
+    results.add(f"{name}_p50", statistics.median(latencies) * 1e3, 'ms', higher_is_better=False)
+    results.add(f"{name}_p99", latencies[int(len(latencies) * 0.99) - 1] * 1e3, 'ms',
+                higher_is_better=False)
+    proxy.stop()
+
+
+def compare(report, baseline, threshold) -> list:
+    """
+    Compare a report against a baseline report
+    
+    Returns:
+        List of (name, baseline value, current value, change) for every
+        result that got worse by more than threshold
+    """
+    regressions = []
+    for name, current in report['results'].items():
+        previous = baseline.get('results', {}).get(name)
+        if previous is None or not previous['value']:
+            continue
+        change = (current['value'] - previous['value']) / previous['value']
+        worse = -change if current['higher_is_better'] else change
+        marker = 'REGRESSION' if worse > threshold else 'ok'
+        log(f"{name}: {previous['value']} -> {current['value']} {current['unit']} "
+            f"({change:+.1%}) {marker}")
+        if worse > threshold:
+            regressions.append((name, previous['value'], current['value'], change))
+    return regressions
+
+
+def main():
+    """Main function to run the benchmarks"""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='VPN microbenchmarks (loopback only)')
+    parser.add_argument('--suite', action='append',
+                        choices=['crypto', 'kdf', 'relay', 'socks'],
+                        help='Benchmark group to run, repeatable (default: all)')
+    parser.add_argument('--output', help='Write the JSON report to this file (default: stdout)')
+    parser.add_argument('--baseline', help='JSON report to compare against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f'Relative slowdown reported as a regression (default: {DEFAULT_THRESHOLD})')
+    parser.add_argument('--min-time', type=float, default=0.5,
+                        help='Seconds spent on each micro measurement (default: 0.5)')
+    parser.add_argument('--relay-mb', type=int, default=64,
+                        help='Megabytes echoed through each relay engine (default: 64)')
+    parser.add_argument('--connections', type=int, default=500,
+                        help='SOCKS connections opened by the setup benchmark (default: 500)')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='Concurrent SOCKS connection attempts (default: 16)')
+    
+    args = parser.parse_args()
+    suites = args.suite or ['crypto', 'kdf', 'relay', 'socks']
+    
+    # The servers and proxies under test print per connection; keep that
+    # out of both the timings' way and the JSON report
+    report_stream = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    
+    results = BenchmarkResults()
+    if 'crypto' in suites:
+        bench_crypto(results, args.min_time)
+    if 'kdf' in suites:
+        bench_kdf(results, args.min_time)
+    if 'relay' in suites:
+        bench_relay(results, RELAY_ENGINES, args.relay_mb)
+    if 'socks' in suites:
+        bench_socks_setup(results, args.connections, args.concurrency, pool_min_idle=0)
+        bench_socks_setup(results, args.connections, args.concurrency, pool_min_idle=args.concurrency)
+    
+    report = results.to_json()
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+        log(f"Report written to {args.output}")
+    else:
+        print(text, file=report_stream)
+    
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            log(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}")
+            sys.exit(1)
+        log("No regressions")
+
+
+if __name__ == '__main__':
+    main()
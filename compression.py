@@ -0,0 +1,270 @@
+"""
+Compression - Optional per-tunnel compression applied before record encryption
+"""
+import zlib
+from crypto_utils import MAX_RECORD_PAYLOAD
+
+
+# Handshake records start with a NUL byte so they can never be mistaken
+# for a "host:port" target request:
+#   offer := COMPRESS_HELLO algorithm ":" level     (client, first record)
+#   reply := COMPRESS_HELLO algorithm ":" level     (server, first record)
+# Every later record in both directions starts with a FLAG_* byte.
+COMPRESS_HELLO = b'\x00COMPRESS/1 '
+ALGORITHMS = ('zlib',)
+DEFAULT_LEVEL = 6
+
+FLAG_RAW = 0
+FLAG_DEFLATE = 1
+
+# Plain bytes per record, leaving room for the flag byte and deflate's
+# worst-case expansion of incompressible input
+MAX_CHUNK = MAX_RECORD_PAYLOAD - 64
+
+# Chunks smaller than this are not worth a deflate call
+MIN_COMPRESS_SIZE = 64
+
+# A chunk that shrinks by less than this fraction counts as incompressible;
+# after INCOMPRESSIBLE_STREAK such chunks in a row compression is bypassed
+# for PROBE_INTERVAL bytes, doubling up to MAX_PROBE_INTERVAL while the
+# data stays incompressible
+INCOMPRESSIBLE_RATIO = 0.95
+INCOMPRESSIBLE_STREAK = 3
+PROBE_INTERVAL = 256 * 1024
+MAX_PROBE_INTERVAL = 8 * 1024 * 1024
+
+# A single record may not inflate to more than this (decompression bombs)
+MAX_EXPANSION = 1024 * 1024
+
+# Memory zlib holds per stream with the default window (15 bits) and
+# memLevel (8), after zconf.h: deflate takes (1 << (windowBits + 2)) +
+# (1 << (memLevel + 9)) bytes, inflate 1 << windowBits, plus a few KiB of
+# state each
+COMPRESSOR_STATE_SIZE = (1 << 17) + (1 << 17) + 6 * 1024
+DECOMPRESSOR_STATE_SIZE = (1 << 15) + 7 * 1024
+
+
+def looks_like_tls(data) -> bool:
+    """Whether data starts with a TLS record header (encrypted, so incompressible)"""
+    return len(data) >= 3 and data[0] in (0x14, 0x15, 0x16, 0x17) and data[1] == 0x03
+
+
+class CompressingEncoder:
+    """Wraps a RecordEncoder, deflating chunks that compress and passing others through"""
+    
+    def __init__(self, encoder, level=DEFAULT_LEVEL):
+        """
+        Initialize encoder
+        
+        Args:
+            encoder: RecordEncoder that encrypts the flagged payloads
+            level: zlib level, 0 never compresses
+        """
+        self.encoder = encoder
+        self.level = level
+        self.compressor = zlib.compressobj(level) if level > 0 else None
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.streak = 0
+        self.bypass_bytes = 0
+        self.probe_interval = PROBE_INTERVAL
+    
+    def encode(self, data: bytes) -> bytes:
+        """Compress and encrypt data into one or more records"""
+        return b''.join(self.encode_parts(data))
+    
+    def encode_parts(self, data) -> list:
+        """Compress and encrypt data, see RecordEncoder.encode_parts()"""
+        payloads = []
+        view = memoryview(data)
+        for offset in range(0, len(view), MAX_CHUNK):
+            chunk = view[offset:offset + MAX_CHUNK]
+            payload = self._compress(chunk)
+            self.raw_bytes += len(chunk)
+            self.wire_bytes += len(payload)
+            payloads.append(payload)
+        # Compression is sequential, the encryption of its output need not be
+        return self.encoder.encode_records(payloads)
+    
+    def _compress(self, chunk) -> bytes:
+        """Return the flagged payload for one chunk"""
+        if self.bypass_bytes <= 0 and looks_like_tls(chunk):
+            self._bypass()
+        
+        if self.compressor is None or len(chunk) < MIN_COMPRESS_SIZE:
+            return bytes((FLAG_RAW,)) + chunk
+        if self.bypass_bytes > 0:
+            self.bypass_bytes -= len(chunk)
+            return bytes((FLAG_RAW,)) + chunk
+        
+        # The compressor's history now includes this chunk, so its output
+        # must be sent even if it did not shrink
+        compressed = self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if len(compressed) > len(chunk) * INCOMPRESSIBLE_RATIO:
+            self.streak += 1
+            if self.streak >= INCOMPRESSIBLE_STREAK:
+                self._bypass()
+        else:
+            self.streak = 0
+            self.probe_interval = PROBE_INTERVAL
+        return bytes((FLAG_DEFLATE,)) + compressed
+    
+    def _bypass(self):
+        """Stop compressing for a while, backing off if data stays incompressible"""
+        self.streak = 0
+        self.bypass_bytes = self.probe_interval
+        self.probe_interval = min(self.probe_interval * 2, MAX_PROBE_INTERVAL)
+    
+    def ratio(self) -> float:
+        """Bytes sent per byte of input (1.0 before any data)"""
+        return self.wire_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+
+class DecompressingDecoder:
+    """Wraps a RecordDecoder, inflating payloads produced by a CompressingEncoder"""
+    
+    def __init__(self, decoder, expect_reply=False):
+        """
+        Initialize decoder
+        
+        Args:
+            decoder: RecordDecoder that decrypts the records
+            expect_reply: The first record is the server's handshake reply
+                          (client side)
+        """
+        self.decoder = decoder
+        self.decompressor = zlib.decompressobj()
+        self.expect_reply = expect_reply
+        self.peer_algorithm = None
+        self.peer_level = None
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+    
+    def feed(self, data: bytes) -> list:
+        """Add received bytes, see RecordDecoder.feed()"""
+        return self.unwrap(self.decoder.feed(data))
+    
+    def recv_from(self, sock):
+        """Receive and decode, see RecordDecoder.recv_from()"""
+        payloads = self.decoder.recv_from(sock)
+        if payloads is None:
+            return None
+        return self.unwrap(payloads)
+    
+    def unwrap(self, payloads) -> list:
+        """
+        Turn decrypted flagged payloads into plain data
+        
+        Raises:
+            ValueError: if a payload is malformed or inflates too far
+        """
+        plain = []
+        for payload in payloads:
+            if self.expect_reply:
+                self.expect_reply = False
+                self.peer_algorithm, self.peer_level = parse_hello(payload)
+                continue
+            if not payload:
+                raise ValueError("Missing compression flag")
+            
+            self.wire_bytes += len(payload)
+            flag = payload[0]
+            if flag == FLAG_RAW:
+                data = payload[1:]
+            elif flag == FLAG_DEFLATE:
+                data = self.decompressor.decompress(payload[1:], MAX_EXPANSION)
+                if self.decompressor.unconsumed_tail:
+                    raise ValueError("Compressed record expands too far")
+            else:
+                raise ValueError(f"Unknown compression flag {flag}")
+            
+            self.raw_bytes += len(data)
+            if data:
+                plain.append(data)
+        return plain
+    
+    def ratio(self) -> float:
+        """Bytes received per byte of output (1.0 before any data)"""
+        return self.wire_bytes / self.raw_bytes if self.raw_bytes else 1.0
+
+
+def make_hello(algorithm, level) -> bytes:
+    """Build an offer or reply record"""
+    return COMPRESS_HELLO + f"{algorithm}:{level}".encode()
+
+
+def parse_hello(record):
+    """
+    Parse an offer or reply record
+    
+    Returns:
+        (algorithm, level)
+    
+    Raises:
+        ValueError: if the record is not a valid hello
+    """
+    if not record.startswith(COMPRESS_HELLO):
+        raise ValueError("Peer did not negotiate compression")
+    algorithm, level = bytes(record[len(COMPRESS_HELLO):]).decode().split(':', 1)
+    level = int(level)
+    if algorithm not in ALGORITHMS or not 0 <= level <= 9:
+        raise ValueError(f"Unsupported compression {algorithm}:{level}")
+    return algorithm, level
+
+
+def is_offer(record) -> bool:
+    """Whether a client's first record is a compression offer"""
+    return record.startswith(COMPRESS_HELLO)
+
+
+def client_handshake(encoder, decoder, algorithm='zlib', level=DEFAULT_LEVEL):
+    """
+    Start compression on a client connection
+    
+    Returns:
+        (offer, encoder, decoder): the offer must be sent as the first
+        record, followed by everything the wrapped encoder produces
+    """
+    if algorithm not in ALGORITHMS:
+        raise ValueError(f"Unsupported compression algorithm {algorithm}")
+    offer = encoder.encode(make_hello(algorithm, level))
+    return offer, CompressingEncoder(encoder, level), DecompressingDecoder(decoder, expect_reply=True)
+
+
+def server_handshake(offer, encoder, decoder, enabled=True):
+    """
+    Answer a client's compression offer
+    
+    Args:
+        offer: The client's first record
+        encoder: RecordEncoder for the server -> client direction
+        decoder: RecordDecoder for the client -> server direction
+        enabled: Whether the server compresses its own direction
+    
+    Returns:
+        (reply, encoder, decoder): the reply must be sent before anything
+        the wrapped encoder produces
+    """
+    algorithm, level = parse_hello(offer)
+    if not enabled:
+        level = 0
+    reply = encoder.encode(make_hello(algorithm, level))
+    return reply, CompressingEncoder(encoder, level), DecompressingDecoder(decoder)
+
+
+def state_size(encoder, decoder) -> int:
+    """Approximate bytes of zlib state a tunnel's compression layers hold"""
+    size = 0
+    if isinstance(encoder, CompressingEncoder) and encoder.compressor is not None:
+        size += COMPRESSOR_STATE_SIZE
+    if isinstance(decoder, DecompressingDecoder):
+        size += DECOMPRESSOR_STATE_SIZE
+    return size
+
+
+def compression_summary(encoder, decoder):
+    """Describe the compression ratios of a tunnel, or None if it is not compressed"""
+    if not isinstance(encoder, CompressingEncoder):
+        return None
+    return (f"sent {encoder.raw_bytes} -> {encoder.wire_bytes} bytes ({encoder.ratio():.2f}), "
+            f"received {decoder.wire_bytes} -> {decoder.raw_bytes} bytes ({decoder.ratio():.2f})")
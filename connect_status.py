@@ -0,0 +1,81 @@
+"""
+Connect Status - Target connect results reported back through the tunnel
+"""
+import errno
+import socket
+
+
+# A client that wants to know whether the target connect succeeded sends
+#   request := CONNECT_REQUEST "host:port"
+# instead of the bare "host:port", optionally followed by data records in
+# the same write (early data, forwarded once the target is connected).
+# Before any target data the server answers with one record
+#   status := CONNECT_STATUS code(1)
+# where code is a SOCKS5 reply code (RFC 1928), so a proxy can pass it on.
+CONNECT_REQUEST = b'\x00CONNECT/1 '
+CONNECT_STATUS = b'\x00STATUS/1 '
+
+STATUS_SUCCEEDED = 0x00
+STATUS_FAILURE = 0x01
+STATUS_NETWORK_UNREACHABLE = 0x03
+STATUS_HOST_UNREACHABLE = 0x04
+STATUS_CONNECTION_REFUSED = 0x05
+
+STATUS_MESSAGES = {
+    STATUS_SUCCEEDED: 'succeeded',
+    STATUS_FAILURE: 'general failure',
+    STATUS_NETWORK_UNREACHABLE: 'network unreachable',
+    STATUS_HOST_UNREACHABLE: 'host unreachable',
+    STATUS_CONNECTION_REFUSED: 'connection refused',
+}
+
+ERRNO_STATUS = {
+    errno.ECONNREFUSED: STATUS_CONNECTION_REFUSED,
+    errno.ENETUNREACH: STATUS_NETWORK_UNREACHABLE,
+    errno.EHOSTUNREACH: STATUS_HOST_UNREACHABLE,
+    errno.EHOSTDOWN: STATUS_HOST_UNREACHABLE,
+    errno.ETIMEDOUT: STATUS_HOST_UNREACHABLE,
+}
+
+
+def status_for_error(error) -> int:
+    """Map a target connect exception to a SOCKS5 reply code"""
+    if isinstance(error, socket.gaierror):
+        return STATUS_HOST_UNREACHABLE
+    if isinstance(error, (socket.timeout, TimeoutError)):
+        return STATUS_HOST_UNREACHABLE
+    if isinstance(error, OSError):
+        return ERRNO_STATUS.get(error.errno, STATUS_FAILURE)
+    return STATUS_FAILURE
+
+
+def is_connect_request(record) -> bool:
+    """Whether a client's request asks for a connect status"""
+    return record.startswith(CONNECT_REQUEST)
+
+
+def make_status(code) -> bytes:
+    """Build a status record payload"""
+    return CONNECT_STATUS + bytes((code,))
+
+
+def parse_status(record) -> int:
+    """
+    Parse a status record
+    
+    Raises:
+        ValueError: if the record is not a status
+    """
+    if not record.startswith(CONNECT_STATUS) or len(record) != len(CONNECT_STATUS) + 1:
+        raise ValueError("Server did not send a connect status")
+    return record[-1]
+
+
+def status_message(code) -> str:
+    """Describe a status code"""
+    return STATUS_MESSAGES.get(code, f"error {code}")
+
+
+def socks_reply(code) -> bytes:
+    """SOCKS5 reply with a status code and an empty IPv4 bound address"""
+    return b'\x05' + bytes((code,)) + b'\x00\x01\x00\x00\x00\x00\x00\x00'
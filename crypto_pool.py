@@ -0,0 +1,114 @@
+"""
+Crypto Pool - Spreads the records of bulk transfers over several cores
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Helper threads; the relay thread seals a share of every batch itself, so
+# a single-core machine gets none and keeps all crypto inline
+DEFAULT_CRYPTO_THREADS = min((os.cpu_count() or 1) - 1, 8)
+
+# Records handed to a thread per task, so the per-task overhead is paid
+# once per ~64 KiB rather than once per record
+BATCH_RECORDS = 4
+
+# A tunnel is in bulk-transfer mode when one read carries at least this
+# many bytes (two batches), which the adaptive relay buffers only reach
+# while data keeps arriving faster than it is relayed. Smaller
+# (interactive) chunks are always encrypted inline on the relay thread.
+BULK_THRESHOLD = 128 * 1024
+
+# Largest read a record decoder grows to while a tunnel stays in bulk mode
+BULK_READ_SIZE = 256 * 1024
+
+
+class CryptoPool:
+    """Runs AEAD seal/open of a run of records on a shared thread pool, keeping their order"""
+    
+    def __init__(self, threads=DEFAULT_CRYPTO_THREADS, threshold=BULK_THRESHOLD,
+                 batch_records=BATCH_RECORDS):
+        """
+        Initialize pool
+        
+        Args:
+            threads: Helper threads shared by all tunnels (at least 1)
+            threshold: Bytes in one call before records are spread over
+                       the threads
+            batch_records: Records per task
+        
+        The pool relies on the cryptography backend releasing the GIL while
+        it encrypts, so helper threads run truly in parallel.
+        """
+        if threads < 1:
+            raise ValueError("A crypto pool needs at least one thread")
+        self.threads = threads
+        self.threshold = threshold
+        self.batch_records = batch_records
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='crypto')
+        self.lock = threading.Lock()
+        self.counters = {
+            'crypto_offload_calls': 0,
+            'crypto_offload_records': 0,
+            'crypto_offload_bytes': 0,
+        }
+    
+    def wants(self, size) -> bool:
+        """Whether a call covering size bytes is large enough to spread out"""
+        return size >= self.threshold
+    
+    def map_records(self, func, records, size) -> list:
+        """
+        Apply an AEAD method to every record
+        
+        Args:
+            func: aead.encrypt or aead.decrypt
+            records: (nonce, data, associated_data) tuples, nonces already
+                     assigned in stream order
+            size: Total bytes in records, for the stats
+        
+        Returns:
+            func's results in the order of records
+        
+        Raises:
+            Whatever func raises for the first failing record, e.g.
+            cryptography.exceptions.InvalidTag
+        """
+        batches = [records[start:start + self.batch_records]
+                   for start in range(0, len(records), self.batch_records)]
+        if len(batches) < 2:
+            return _apply(func, records)
+        
+        # The caller works on the first batch while helpers take the rest
+        futures = [self.executor.submit(_apply, func, batch) for batch in batches[1:]]
+        results = _apply(func, batches[0])
+        for future in futures:
+            results.extend(future.result())
+        
+        with self.lock:
+            self.counters['crypto_offload_calls'] += 1
+            self.counters['crypto_offload_records'] += len(records)
+            self.counters['crypto_offload_bytes'] += size
+        return results
+    
+    def get_stats(self) -> dict:
+        """Return offload counters"""
+        with self.lock:
+            return dict(self.counters)
+    
+    def shutdown(self):
+        """Stop the helper threads once queued work is done"""
+        self.executor.shutdown(wait=False)
+
+
+def _apply(func, batch) -> list:
+    """Run func over one batch of (nonce, data, associated_data) records"""
+    return [func(nonce, data, associated_data) for nonce, data, associated_data in batch]
+
+
+def create_crypto_pool(threads):
+    """Return a CryptoPool with threads helpers, or None if threads is 0"""
+    if not threads:
+        return None
+    return CryptoPool(threads)
@@ -3,22 +3,123 @@ Encryption utilities for VPN communication
 """
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.backends import default_backend
+from collections import OrderedDict
 import base64
+import hashlib
+import hmac
 import os
+import struct
+import threading
+import time
+import metrics
+from crypto_pool import BULK_READ_SIZE
+
+
+# Record layer wire format:
+#   stream := nonce_prefix(8) record*
+#   record := length(2, big endian) ciphertext(length)
+# The ciphertext is AES-256-GCM over the payload with a 16 byte tag; the
+# nonce is nonce_prefix || record counter and the length header is the AAD.
+RECORD_HEADER = struct.Struct('>H')
+RECORD_NONCE_PREFIX_SIZE = 8
+RECORD_TAG_SIZE = 16
+MAX_RECORD_PAYLOAD = 16384
+MAX_RECORD_COUNTER = 2 ** 32 - 1
+
+# Bytes of one full record on the wire
+MAX_RECORD_SIZE = RECORD_HEADER.size + MAX_RECORD_PAYLOAD + RECORD_TAG_SIZE
+
+# Initial receive buffer of a RecordDecoder, room for a few full records
+DECODER_BUFFER_SIZE = 4 * MAX_RECORD_SIZE
+
+KDF_SALT = b'vpn_salt_12345'  # In production, use random salt
+KDF_ITERATIONS = 100000
+
+# Process-wide cache of PBKDF2 results. Entries are indexed by an HMAC of
+# (salt, password) under a per-process secret so plaintext passwords are
+# never kept, and evicted keys are zeroed in place.
+KEY_CACHE_SIZE = 32
+_key_cache = OrderedDict()
+_key_cache_lock = threading.Lock()
+_key_cache_secret = os.urandom(32)
+
+
+def derive_password_key(password: str, salt: bytes = KDF_SALT) -> bytes:
+    """
+    Derive a Fernet key from a password, reusing earlier derivations
+    
+    Args:
+        password: Password to derive the key from
+        salt: PBKDF2 salt
+    
+    Returns:
+        URL-safe base64 encoded 32 byte key
+    """
+    password_bytes = password.encode()
+    cache_id = hmac.new(
+        _key_cache_secret,
+        len(salt).to_bytes(4, 'big') + salt + password_bytes,
+        hashlib.sha256
+    ).digest()
+    
+    # Derive under the lock so a burst of connections runs PBKDF2 once
+    with _key_cache_lock:
+        cached = _key_cache.get(cache_id)
+        if cached is not None:
+            _key_cache.move_to_end(cache_id)
+            return bytes(cached)
+        
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=salt,
+            iterations=KDF_ITERATIONS,
+            backend=default_backend()
+        )
+        key = base64.urlsafe_b64encode(kdf.derive(password_bytes))
+        
+        _key_cache[cache_id] = bytearray(key)
+        while len(_key_cache) > KEY_CACHE_SIZE:
+            _, evicted = _key_cache.popitem(last=False)
+            _wipe(evicted)
+        return key
+
+
+def clear_key_cache():
+    """Zero and drop every cached derived key"""
+    with _key_cache_lock:
+        for cached in _key_cache.values():
+            _wipe(cached)
+        _key_cache.clear()
+
+
+def _wipe(buffer: bytearray):
+    """Overwrite a mutable key buffer with zeros"""
+    buffer[:] = bytes(len(buffer))
 
 
 class VPNCrypto:
     """Handles encryption and decryption for VPN traffic"""
     
-    def __init__(self, password: str = None):
+    def __init__(self, password: str = None, deferred: bool = False):
         """
         Initialize encryption with a password
         
         Args:
             password: Password for key derivation. If None, generates a random key.
+            deferred: Skip key setup entirely because the key will arrive in
+                      the handshake via set_key(). password is ignored.
         """
+        if deferred:
+            self.key = None
+            self.cipher = None
+            self.record_key = None
+            return
+        
         if password:
             self.key = self._derive_key(password)
         else:
@@ -26,21 +127,22 @@ class VPNCrypto:
             self.key = Fernet.generate_key()
         
         self.cipher = Fernet(self.key)
+        self.record_key = self._derive_record_key(self.key)
     
     def _derive_key(self, password: str) -> bytes:
         """Derive encryption key from password"""
-        password_bytes = password.encode()
-        salt = b'vpn_salt_12345'  # In production, use random salt
-        
-        kdf = PBKDF2HMAC(
+        return derive_password_key(password)
+    
+    def _derive_record_key(self, key: bytes) -> bytes:
+        """Derive the AEAD record key from the shared session key"""
+        hkdf = HKDF(
             algorithm=hashes.SHA256(),
             length=32,
-            salt=salt,
-            iterations=100000,
+            salt=None,
+            info=b'vpn-record-layer-v1',
             backend=default_backend()
         )
-        key = base64.urlsafe_b64encode(kdf.derive(password_bytes))
-        return key
+        return hkdf.derive(base64.urlsafe_b64decode(key))
     
     def encrypt(self, data: bytes) -> bytes:
         """Encrypt data"""
@@ -58,4 +160,242 @@ class VPNCrypto:
         """Set encryption key from bytes"""
         self.key = key
         self.cipher = Fernet(key)
+        self.record_key = self._derive_record_key(key)
+    
+    def new_record_encoder(self, pool=None) -> 'RecordEncoder':
+        """Create an encoder for one direction of a tunnel, see RecordEncoder"""
+        return RecordEncoder(self.record_key, pool)
+    
+    def new_record_decoder(self, pool=None) -> 'RecordDecoder':
+        """Create a decoder for one direction of a tunnel, see RecordDecoder"""
+        return RecordDecoder(self.record_key, pool)
+
+
+class RecordEncoder:
+    """Turns a byte stream into length-prefixed AEAD records"""
+    
+    def __init__(self, record_key: bytes, pool=None):
+        """
+        Initialize record encoder
+        
+        Args:
+            record_key: 32 byte AES-GCM key shared with the peer
+            pool: crypto_pool.CryptoPool that seals bulk chunks on several
+                  threads (optional)
+        """
+        self.aead = AESGCM(record_key)
+        self.pool = pool
+        self.nonce_prefix = os.urandom(RECORD_NONCE_PREFIX_SIZE)
+        self.counter = 0
+        self.started = False
+    
+    def encode(self, data: bytes) -> bytes:
+        """
+        Encrypt data into one or more records
+        
+        The first call also emits the nonce prefix, so the output of every
+        call must be sent to the peer in order.
+        """
+        return b''.join(self.encode_parts(data))
+    
+    def encode_parts(self, data) -> list:
+        """
+        Encrypt data into records without joining them
+        
+        Returns:
+            List of buffers (nonce prefix, headers and ciphertexts) to be
+            sent in order, e.g. with relay_buffers.send_buffers()
+        """
+        view = memoryview(data)
+        return self.encode_records([view[offset:offset + MAX_RECORD_PAYLOAD]
+                                    for offset in range(0, len(view), MAX_RECORD_PAYLOAD)])
+    
+    def encode_records(self, payloads) -> list:
+        """
+        Encrypt each payload (at most MAX_RECORD_PAYLOAD bytes) into one record
+        
+        Returns:
+            List of buffers to be sent in order, see encode_parts()
+        """
+        parts = []
+        if not self.started:
+            parts.append(self.nonce_prefix)
+            self.started = True
+        
+        instrumented = metrics.REGISTRY.enabled
+        if instrumented:
+            started = time.perf_counter()
+        
+        size = sum(len(payload) for payload in payloads)
+        if self.pool is not None and self.pool.wants(size):
+            # Nonces are assigned here in order, so the records may be
+            # sealed in any order and still form a valid stream
+            records = []
+            for payload in payloads:
+                header = RECORD_HEADER.pack(len(payload) + RECORD_TAG_SIZE)
+                records.append((self._next_nonce(), payload, header))
+            ciphertexts = self.pool.map_records(self.aead.encrypt, records, size)
+            for (_, _, header), ciphertext in zip(records, ciphertexts):
+                parts.append(header)
+                parts.append(ciphertext)
+        else:
+            for payload in payloads:
+                header = RECORD_HEADER.pack(len(payload) + RECORD_TAG_SIZE)
+                parts.append(header)
+                parts.append(self.aead.encrypt(self._next_nonce(), payload, header))
+        
+        if instrumented:
+            metrics.ENCRYPT_SECONDS.observe(time.perf_counter() - started)
+            metrics.BYTES_SENT.inc(size)
+        return parts
+    
+    def _next_nonce(self) -> bytes:
+        """Return the nonce for the next record"""
+        if self.counter > MAX_RECORD_COUNTER:
+            raise ValueError("Record counter exhausted, tunnel must be re-keyed")
+        nonce = self.nonce_prefix + self.counter.to_bytes(4, 'big')
+        self.counter += 1
+        return nonce
+
+
+class RecordDecoder:
+    """Reassembles and decrypts records from arbitrarily split reads"""
+    
+    def __init__(self, record_key: bytes, pool=None):
+        """
+        Initialize record decoder
+        
+        Args:
+            record_key: 32 byte AES-GCM key shared with the peer
+            pool: crypto_pool.CryptoPool that opens bulk reads on several
+                  threads (optional)
+        """
+        self.aead = AESGCM(record_key)
+        self.pool = pool
+        # Free space guaranteed to recv_from(); grows while reads fill it so
+        # a bulk upload delivers enough records at once to spread out
+        self.read_size = MAX_RECORD_SIZE
+        self.nonce_prefix = None
+        self.counter = 0
+        # Received bytes live in buffer[start:end]; the buffer is reused
+        # across reads and only compacted or grown when space runs out
+        self.buffer = bytearray(DECODER_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        # admission.Slot the buffer is charged to, set with set_account()
+        self.account = None
+    
+    def set_account(self, account):
+        """Charge the buffer, and from now on its growth, to an admission.Slot"""
+        self.account = account
+        account.charge(len(self.buffer))
+    
+    def feed(self, data: bytes) -> list:
+        """
+        Add received bytes and return the payloads of all complete records
+        
+        Raises:
+            cryptography.exceptions.InvalidTag: if a record was tampered with
+            ValueError: if the stream is malformed
+        """
+        self._reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        return self._drain()
+    
+    def recv_from(self, sock):
+        """
+        Receive straight into the decoder's buffer and decode
+        
+        Returns:
+            List of payloads of all complete records (possibly empty), or
+            None if the peer closed the connection
+        """
+        self._reserve(self.read_size)
+        space = len(self.buffer) - self.end
+        received = sock.recv_into(self.view[self.end:])
+        if not received:
+            return None
+        self.end += received
+        if self.pool is not None:
+            if received == space and (self.account is None or not self.account.over_budget()):
+                self.read_size = min(self.read_size * 2, BULK_READ_SIZE)
+            elif received < MAX_RECORD_SIZE:
+                self.read_size = MAX_RECORD_SIZE
+        return self._drain()
+    
+    def _reserve(self, size):
+        """Make room for size more bytes after end"""
+        if len(self.buffer) - self.end >= size:
+            return
+        
+        pending = self.end - self.start
+        if pending + size > len(self.buffer):
+            capacity = len(self.buffer)
+            while pending + size > capacity:
+                capacity *= 2
+            if self.account is not None:
+                self.account.charge(capacity - len(self.buffer))
+            buffer = bytearray(capacity)
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        else:
+            # Move the partial record to the front
+            self.view[:pending] = self.view[self.start:self.end]
+        self.start = 0
+        self.end = pending
+    
+    def _drain(self) -> list:
+        """Decrypt every complete record in the buffer"""
+        payloads = []
+        view = self.view
+        
+        if self.nonce_prefix is None:
+            if self.end - self.start < RECORD_NONCE_PREFIX_SIZE:
+                return payloads
+            self.nonce_prefix = bytes(view[self.start:self.start + RECORD_NONCE_PREFIX_SIZE])
+            self.start += RECORD_NONCE_PREFIX_SIZE
+        
+        instrumented = metrics.REGISTRY.enabled
+        if instrumented:
+            started = time.perf_counter()
+        
+        offset = self.start
+        records = []
+        while self.end - offset >= RECORD_HEADER.size:
+            (length,) = RECORD_HEADER.unpack_from(self.buffer, offset)
+            if length < RECORD_TAG_SIZE or length > MAX_RECORD_PAYLOAD + RECORD_TAG_SIZE:
+                raise ValueError(f"Invalid record length {length}")
+            body = offset + RECORD_HEADER.size
+            if body + length > self.end:
+                break
+            
+            records.append((self._next_nonce(), view[body:body + length], view[offset:body]))
+            offset = body + length
+        
+        # The records are views into the buffer, opened before it is reused
+        size = offset - self.start
+        if self.pool is not None and self.pool.wants(size):
+            payloads = self.pool.map_records(self.aead.decrypt, records, size)
+        else:
+            payloads = [self.aead.decrypt(*record) for record in records]
+        
+        self.start = offset
+        if self.start == self.end:
+            self.start = self.end = 0
+        
+        if instrumented and payloads:
+            metrics.DECRYPT_SECONDS.observe(time.perf_counter() - started)
+            metrics.BYTES_RECEIVED.inc(sum(len(payload) for payload in payloads))
+        return payloads
+    
+    def _next_nonce(self) -> bytes:
+        """Return the nonce expected for the next record"""
+        if self.counter > MAX_RECORD_COUNTER:
+            raise ValueError("Record counter exhausted")
+        nonce = self.nonce_prefix + self.counter.to_bytes(4, 'big')
+        self.counter += 1
+        return nonce
 
@@ -0,0 +1,188 @@
+"""
+Load Balancer - Spreads tunnels over several VPN servers of one country
+"""
+import threading
+import time
+from vpn_logging import get_logger
+
+
+log = get_logger('balancer')
+
+BALANCE_POLICIES = ('least_conn', 'round_robin')
+
+# A failing endpoint is ejected for EJECTION_BASE seconds, doubling with
+# every consecutive failure up to EJECTION_MAX
+EJECTION_BASE = 1.0
+EJECTION_MAX = 60.0
+
+# Endpoints tried for one tunnel before the client gets a SOCKS failure
+MAX_CONNECT_ATTEMPTS = 3
+
+
+class Endpoint:
+    """One VPN server behind a LoadBalancer"""
+    
+    def __init__(self, host, port, weight=1):
+        """
+        Initialize endpoint
+        
+        Args:
+            host: VPN server host
+            port: VPN server port
+            weight: Relative share of new tunnels (default: 1)
+        """
+        self.host = host
+        self.port = port
+        self.weight = max(int(weight), 1)
+        self.active = 0
+        self.total = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.current_weight = 0
+    
+    def __repr__(self):
+        return f"{self.host}:{self.port}"
+    
+    def ejected(self, now) -> bool:
+        """Whether the endpoint is sitting out a backoff period"""
+        return now < self.ejected_until
+
+
+class LoadBalancer:
+    """Chooses a VPN server endpoint for each new tunnel"""
+    
+    def __init__(self, endpoints, policy='least_conn', ejection_base=EJECTION_BASE,
+                 ejection_max=EJECTION_MAX):
+        """
+        Initialize load balancer
+        
+        Args:
+            endpoints: List of Endpoint
+            policy: 'least_conn' picks the endpoint with the fewest active
+                    tunnels per unit of weight, 'round_robin' rotates by
+                    weight (default: 'least_conn')
+            ejection_base: Seconds a failing endpoint is skipped at first
+            ejection_max: Upper bound for the doubling ejection time
+        """
+        if not endpoints:
+            raise ValueError("At least one endpoint is required")
+        if policy not in BALANCE_POLICIES:
+            raise ValueError(f"Unknown balancing policy {policy}")
+        self.endpoints = list(endpoints)
+        self.policy = policy
+        self.ejection_base = ejection_base
+        self.ejection_max = ejection_max
+        self.lock = threading.Lock()
+    
+    def choose(self, exclude=()):
+        """
+        Pick the endpoint for a new tunnel and count it as active
+        
+        Ejected endpoints are only used when every endpoint is ejected, so
+        traffic keeps flowing to the one that recovers first.
+        
+        Args:
+            exclude: Endpoints already tried for this tunnel
+        
+        Returns:
+            An Endpoint (release() it when the tunnel ends), or None if all
+            endpoints are excluded
+        """
+        now = time.monotonic()
+        with self.lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                return None
+            healthy = [e for e in candidates if not e.ejected(now)]
+            if healthy:
+                endpoint = self._pick(healthy)
+            else:
+                endpoint = min(candidates, key=lambda e: e.ejected_until)
+            endpoint.active += 1
+            endpoint.total += 1
+            return endpoint
+    
+    def release(self, endpoint):
+        """A tunnel on endpoint has ended"""
+        with self.lock:
+            endpoint.active -= 1
+    
+    def report_success(self, endpoint):
+        """The endpoint accepted a connection; end any backoff"""
+        with self.lock:
+            endpoint.failures = 0
+            endpoint.ejected_until = 0.0
+    
+    def report_failure(self, endpoint):
+        """The endpoint could not be reached; eject it with exponential backoff"""
+        with self.lock:
+            endpoint.failures += 1
+            ejection = min(self.ejection_base * 2 ** (endpoint.failures - 1), self.ejection_max)
+            endpoint.ejected_until = time.monotonic() + ejection
+        if len(self.endpoints) > 1:
+            log.warning("Ejecting %s for %.0fs after %s failure(s)",
+                        endpoint, ejection, endpoint.failures)
+    
+    def stats(self) -> dict:
+        """Return per-endpoint counters keyed by host:port"""
+        now = time.monotonic()
+        with self.lock:
+            return {
+                repr(e): {
+                    'weight': e.weight,
+                    'active': e.active,
+                    'total': e.total,
+                    'failures': e.failures,
+                    'ejected': e.ejected(now),
+                }
+                for e in self.endpoints
+            }
+    
+    def _pick(self, endpoints):
+        """Apply the policy to healthy endpoints (lock held)"""
+        if len(endpoints) == 1:
+            return endpoints[0]
+        if self.policy == 'least_conn':
+            # Ties go to the endpoint that has served fewer tunnels overall
+            return min(endpoints, key=lambda e: (e.active / e.weight, e.total / e.weight))
+        
+        # Smooth weighted round robin: spreads picks evenly instead of
+        # sending runs of tunnels to the heaviest endpoint
+        total = sum(e.weight for e in endpoints)
+        for e in endpoints:
+            e.current_weight += e.weight
+        endpoint = max(endpoints, key=lambda e: e.current_weight)
+        endpoint.current_weight -= total
+        return endpoint
+
+
+def parse_endpoints(spec, default_port=8888) -> list:
+    """
+    Parse "host[:port[:weight]],..." into Endpoints
+    
+    IPv6 addresses are written in brackets, "[2001:db8::1]:8888:2"; a bare
+    IPv6 address is accepted without a port.
+    
+    Raises:
+        ValueError: if a port or weight is not a number, or a bracket is unclosed
+    """
+    endpoints = []
+    for item in spec.split(','):
+        item = item.strip()
+        if item.startswith('['):
+            host, bracket, rest = item[1:].partition(']')
+            if not bracket or (rest and not rest.startswith(':')):
+                raise ValueError(f"Invalid server {item!r}, expected [address]:port")
+            parts = [host] + rest[1:].split(':') if rest else [host]
+        elif item.count(':') > 2 or '::' in item:
+            parts = [item]
+        else:
+            parts = item.split(':')
+        if not parts[0]:
+            continue
+        port = int(parts[1]) if len(parts) > 1 and parts[1] else default_port
+        weight = int(parts[2]) if len(parts) > 2 else 1
+        endpoints.append(Endpoint(parts[0], port, weight))
+    if not endpoints:
+        raise ValueError(f"No server in {spec!r}")
+    return endpoints
@@ -0,0 +1,338 @@
+"""
+Metrics - Counters, gauges and histograms exported in Prometheus text format
+"""
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Histogram buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CRYPTO_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+
+def escape_label(value) -> str:
+    """Escape a label value for the text format"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labelnames, labelvalues, extra=()) -> str:
+    """Render a label set as {a="1",b="2"}, or '' when there are none"""
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+
+def format_value(value) -> str:
+    """Render a sample value"""
+    if isinstance(value, float) and value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base class of a metric family, optionally split by labels"""
+    
+    kind = None
+    
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Initialize metric
+        
+        Args:
+            name: Metric name
+            documentation: Help text
+            labelnames: Label names; without labels the metric itself is
+                        updated, with labels use labels(...) first
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            self.children[()] = self._new_child()
+    
+    def labels(self, *labelvalues):
+        """Return the child for one combination of label values"""
+        key = tuple(str(value) for value in labelvalues)
+        child = self.children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}")
+            with self.lock:
+                child = self.children.setdefault(key, self._new_child())
+        return child
+    
+    def __getattr__(self, name):
+        """Unlabelled metrics forward inc()/observe()/... to their only child"""
+        children = self.__dict__.get('children', {})
+        if () not in children:
+            raise AttributeError(name)
+        return getattr(children[()], name)
+    
+    def render(self) -> list:
+        """Return the exposition lines of this family"""
+        with self.lock:
+            children = sorted(self.children.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for labelvalues, child in children:
+            lines.extend(self._render_child(labelvalues, child))
+        return lines
+    
+    def _new_child(self):
+        """Create the value holder of one label combination"""
+        return Value()
+    
+    def _render_child(self, labelvalues, child) -> list:
+        """Return the sample lines of one child"""
+        labels = format_labels(self.labelnames, labelvalues)
+        return [f"{self.name}{labels} {format_value(child.get())}"]
+
+
+class Value:
+    """Number behind one counter or gauge child"""
+    
+    def __init__(self):
+        self.value = 0
+        self.function = None
+        self.lock = threading.Lock()
+    
+    def inc(self, amount=1):
+        """Add amount"""
+        with self.lock:
+            self.value += amount
+    
+    def dec(self, amount=1):
+        """Subtract amount (gauges only)"""
+        with self.lock:
+            self.value -= amount
+    
+    def set(self, value):
+        """Replace the value (gauges only)"""
+        with self.lock:
+            self.value = value
+    
+    def set_function(self, function):
+        """Read the value from function() at scrape time instead"""
+        self.function = function
+    
+    def get(self):
+        """Current value"""
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+    
+    kind = 'counter'
+
+
+class Gauge(Metric):
+    """Value that can go up and down"""
+    
+    kind = 'gauge'
+
+
+class Buckets:
+    """Bucket counts and sum behind one histogram child"""
+    
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+    
+    def observe(self, value):
+        """Record one observation"""
+        index = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+    
+    @contextmanager
+    def time(self):
+        """Observe the duration of a with block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets"""
+    
+    kind = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        """
+        Initialize histogram
+        
+        Args:
+            buckets: Upper bounds of the buckets; +Inf is added implicitly
+        """
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+    
+    def _new_child(self):
+        """Create the buckets of one label combination"""
+        return Buckets(self.buckets)
+    
+    def _render_child(self, labelvalues, child) -> list:
+        """Return the cumulative bucket, sum and count lines of one child"""
+        with child.lock:
+            counts = list(child.counts)
+            total = child.sum
+        
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            labels = format_labels(self.labelnames, labelvalues, [('le', format_value(float(bound)))])
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labelnames, labelvalues)
+        lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together"""
+    
+    def __init__(self):
+        self.metrics = {}
+        # path -> callable returning data served as JSON, see export_page()
+        self.pages = {}
+        self.lock = threading.Lock()
+        # Hot-path instrumentation (record layer) only runs once an
+        # endpoint is serving, so unmonitored processes pay nothing
+        self.enabled = False
+    
+    def register(self, metric):
+        """Add a metric, or return the already registered one of that name"""
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+    
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        """Register and return a counter, or the existing metric of that name"""
+        return self.register(Counter(name, documentation, labelnames))
+    
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        """Register and return a gauge, or the existing metric of that name"""
+        return self.register(Gauge(name, documentation, labelnames))
+    
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        """Register and return a histogram, or the existing metric of that name"""
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+    
+    def render(self) -> str:
+        """Return all metrics in Prometheus text exposition format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+# Metrics shared by the server and the proxy. "sent" and "received" count
+# record payload bytes (after compression) encrypted and decrypted by this
+# process; tunnel counts come from each component's get_stats().
+TUNNEL_BYTES = REGISTRY.counter('vpn_tunnel_bytes_total', 'Record payload bytes carried by tunnels',
+                                ['direction'])
+CONNECT_SECONDS = REGISTRY.histogram('vpn_connect_seconds',
+                                     'Time to connect to a target (server) or VPN server (proxy)')
+HANDSHAKE_SECONDS = REGISTRY.histogram('vpn_handshake_seconds',
+                                       'Time from connect until the tunnel request is exchanged')
+CRYPTO_SECONDS = REGISTRY.histogram('vpn_crypto_seconds', 'Time spent per record batch in AES-GCM',
+                                    ['operation'], buckets=CRYPTO_BUCKETS)
+ERRORS = REGISTRY.counter('vpn_errors_total', 'Errors by type', ['type'])
+
+BYTES_SENT = TUNNEL_BYTES.labels('sent')
+BYTES_RECEIVED = TUNNEL_BYTES.labels('received')
+ENCRYPT_SECONDS = CRYPTO_SECONDS.labels('encrypt')
+DECRYPT_SECONDS = CRYPTO_SECONDS.labels('decrypt')
+
+
+def count_error(error_type):
+    """Count one error of the given type"""
+    ERRORS.labels(error_type).inc()
+
+
+def export_stats(get_stats, prefix, gauges=(), registry=REGISTRY):
+    """
+    Expose a get_stats() dict (e.g. VPNServer.get_stats) as metrics read at scrape time
+    
+    Args:
+        get_stats: Callable returning {name: number}
+        prefix: Prepended to every metric name
+        gauges: Names that can go down; all others are exported as counters
+    """
+    for name in get_stats():
+        metric_name = f"{prefix}_{name}"
+        if name in gauges:
+            metric = registry.gauge(metric_name, f"{name} from {prefix} stats")
+        else:
+            metric = registry.counter(metric_name, f"{name} from {prefix} stats")
+        metric.set_function(lambda name=name: get_stats().get(name, 0))
+
+
+def export_page(path, get_data, registry=REGISTRY):
+    """
+    Serve get_data() as JSON next to the metrics, for detail that does not
+    fit a metric (e.g. VPNServer.get_tunnels on /tunnels)
+    """
+    registry.pages[path] = get_data
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves the registry on GET /metrics and pages added by export_page()"""
+    
+    registry = REGISTRY
+    
+    def do_GET(self):
+        """Return the metrics page or a JSON page"""
+        path = self.path.split('?', 1)[0]
+        if path in self.registry.pages:
+            body = json.dumps(self.registry.pages[path](), indent=1).encode()
+            content_type = 'application/json'
+        elif path in ('/metrics', '/'):
+            body = self.registry.render().encode()
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        """Keep scrapes out of the console"""
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1', registry=REGISTRY):
+    """
+    Serve registry over HTTP in a background thread and enable hot-path metrics
+    
+    Returns:
+        The running ThreadingHTTPServer
+    """
+    handler = type('BoundMetricsHandler', (MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    registry.enabled = True
+    print(f"[METRICS] Serving Prometheus metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,475 @@
+"""
+Profiling - On-demand sampling profiler for running servers and proxies
+"""
+import atexit
+import itertools
+import linecache
+import os
+import pstats
+import re
+import signal
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from io import StringIO
+from vpn_logging import get_logger
+
+
+log = get_logger('profile')
+
+# Seconds between stack samples of all threads
+SAMPLE_INTERVAL = 0.01
+
+# Functions and allocation sites listed in the text report
+TOP_N = 25
+
+# Stack frames recorded per allocation while profiling; more frames cost
+# more memory and time on every allocation
+TRACEMALLOC_FRAMES = 1
+
+# Subsystem of a sample: the innermost frame matching a (file, function) or
+# a file decides. Frames are matched by file name, so this module does not
+# import the code it profiles.
+SUBSYSTEM_FUNCTIONS = {
+    ('vpn_server.py', 'start'): 'accept',
+    ('socks5_proxy.py', 'start'): 'accept',
+    ('vpn_server.py', 'tunnel_traffic'): 'relay',
+    ('socks5_proxy.py', 'tunnel_traffic'): 'relay',
+    ('vpn_client.py', 'tunnel_traffic'): 'relay',
+    ('async_server.py', 'relay_records'): 'relay',
+    ('async_server.py', 'records_to_plain'): 'relay',
+    ('async_server.py', 'plain_to_records'): 'relay',
+    ('async_server.py', 'tunnel_streams'): 'relay',
+    ('vpn_server.py', 'handle_client'): 'handshake',
+    ('vpn_server.py', 'connect_target'): 'handshake',
+    ('async_server.py', 'handle_connection'): 'handshake',
+    ('async_server.py', 'open_target'): 'handshake',
+    ('socks5_proxy.py', 'handle_client'): 'handshake',
+    ('socks5_proxy.py', 'connect_server'): 'handshake',
+    ('socks5_proxy.py', 'start_tunnel'): 'handshake',
+    ('async_proxy.py', 'handle_connection'): 'handshake',
+    ('async_proxy.py', 'open_upstream'): 'handshake',
+    ('vpn_client.py', 'connect_to_server'): 'handshake',
+}
+SUBSYSTEM_FILES = {
+    'crypto_utils.py': 'crypto',
+    'crypto_pool.py': 'crypto',
+    'compression.py': 'compression',
+    'resolver.py': 'dns',
+    'relay_core.py': 'relay',
+    'relay_buffers.py': 'relay',
+    'tunnel_mux.py': 'relay',
+    'udp_relay.py': 'relay',
+    'admission.py': 'accept',
+    'vpn_logging.py': 'logging',
+    'metrics.py': 'metrics',
+}
+
+# Innermost frames of a thread waiting for work; such samples are counted
+# as idle and left out of the profile
+WAIT_FUNCTIONS = {
+    ('relay_buffers.py', 'wait_readable'),
+    ('selectors.py', 'select'),
+    ('threading.py', 'wait'),
+    ('queue.py', 'get'),
+    ('socket.py', 'accept'),
+    ('admission.py', '_run'),
+    ('thread.py', '_worker'),
+    # Sleeps between reports to the supervisor
+    ('server_supervisor.py', 'report_stats'),
+}
+
+# Any other innermost frame whose current line calls one of these is
+# blocked in the kernel, e.g. a handshake reading a socket or a record
+# decoder waiting for its next record, and counts as idle too
+BLOCKING_CALL = re.compile(r'\.(recv|recv_into|recvfrom|recvfrom_into|accept|connect'
+                           r'|select|poll|sleep|acquire)\(')
+
+
+class SamplingProfiler:
+    """Samples the stacks of all threads from a background thread"""
+    
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        """
+        Initialize profiler
+        
+        Args:
+            interval: Seconds between samples
+        
+        Sampling needs no cooperation from the profiled threads and costs
+        them nothing; the sampler thread itself takes the GIL briefly on
+        every sample.
+        """
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self._reset()
+        # code object -> (waits for work, subsystem or None)
+        self.codes = {}
+        # (code object, line) -> whether the line makes a BLOCKING_CALL
+        self.lines = {}
+    
+    @property
+    def running(self) -> bool:
+        """Whether samples are being taken"""
+        return self.thread is not None
+    
+    def start(self):
+        """Start sampling from scratch"""
+        self._reset()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self.thread.start()
+    
+    def stop(self):
+        """Stop sampling, keeping the samples for snapshot()"""
+        if self.thread is None:
+            return
+        self.stopped.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+        self.duration = time.monotonic() - self.started
+    
+    def snapshot(self) -> dict:
+        """
+        Return the samples so far
+        
+        Returns:
+            {'stacks': Counter of (subsystem, code objects outermost first),
+             'idle': samples of waiting threads, 'duration': seconds sampled,
+             'interval': seconds per sample}
+        """
+        with self.lock:
+            return {
+                'stacks': Counter(self.stacks),
+                'idle': self.idle,
+                'duration': self.duration if self.thread is None else time.monotonic() - self.started,
+                'interval': self.interval,
+            }
+    
+    def _reset(self):
+        """Forget all samples"""
+        with self.lock:
+            self.stacks = Counter()
+            self.idle = 0
+            self.started = time.monotonic()
+            self.duration = 0.0
+    
+    def _run(self):
+        """Sampler thread"""
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self.lock:
+                for ident, frame in frames.items():
+                    if ident != own:
+                        self._record(frame)
+            # Frames keep locals alive, do not hold on to them
+            del frames
+    
+    def _record(self, frame):
+        """Count one thread's stack (lock held)"""
+        if self._classify(frame.f_code)[0] or self._blocks(frame.f_code, frame.f_lineno):
+            self.idle += 1
+            return
+        
+        codes = []
+        subsystem = None
+        while frame is not None:
+            code = frame.f_code
+            codes.append(code)
+            if subsystem is None:
+                subsystem = self._classify(code)[1]
+            frame = frame.f_back
+        codes.reverse()
+        self.stacks[(subsystem or 'other', tuple(codes))] += 1
+    
+    def _classify(self, code):
+        """(waits for work, subsystem) of a code object, cached"""
+        try:
+            return self.codes[code]
+        except KeyError:
+            pass
+        key = (os.path.basename(code.co_filename), code.co_name)
+        result = self.codes[code] = (key in WAIT_FUNCTIONS,
+                                     SUBSYSTEM_FUNCTIONS.get(key) or SUBSYSTEM_FILES.get(key[0]))
+        return result
+    
+    def _blocks(self, code, lineno):
+        """Whether a line of code makes a BLOCKING_CALL, cached"""
+        if lineno is None:
+            return False
+        try:
+            return self.lines[(code, lineno)]
+        except KeyError:
+            pass
+        line = linecache.getline(code.co_filename, lineno)
+        result = self.lines[(code, lineno)] = BLOCKING_CALL.search(line) is not None
+        return result
+
+
+class SampledStats:
+    """Samples converted to the profile data of cProfile, for pstats.Stats()"""
+    
+    def __init__(self, stacks, interval):
+        """
+        Convert samples
+        
+        Args:
+            stacks: Counter of (subsystem, code objects outermost first)
+            interval: Seconds each sample stands for
+        """
+        # (file, line, function) -> [calls, calls, own time, total time, callers]
+        entries = {}
+        for (_, codes), count in stacks.items():
+            seconds = count * interval
+            functions = [(code.co_filename, code.co_firstlineno, code.co_name) for code in codes]
+            seen = set()
+            for position, function in enumerate(functions):
+                entry = entries.setdefault(function, [0, 0, 0.0, 0.0, {}])
+                # Recursion counts once towards the total
+                if function not in seen:
+                    seen.add(function)
+                    entry[0] += count
+                    entry[1] += count
+                    entry[3] += seconds
+                if position:
+                    caller = functions[position - 1]
+                    calls, primitive, own, total = entry[4].get(caller, (0, 0, 0.0, 0.0))
+                    innermost = position == len(functions) - 1
+                    entry[4][caller] = (calls + count, primitive + count,
+                                        own + (seconds if innermost else 0.0), total + seconds)
+            entries[functions[-1]][2] += seconds
+        self.stats = {function: (calls, primitive, own, total, callers)
+                      for function, (calls, primitive, own, total, callers) in entries.items()}
+    
+    def create_stats(self):
+        """pstats.Stats calls this to finish collecting; sampling is already done"""
+
+
+class ProfileSession:
+    """Starts, stops and writes out the profiler of this process"""
+    
+    def __init__(self, name, output_dir='.', interval=SAMPLE_INTERVAL, top=TOP_N):
+        """
+        Initialize session
+        
+        Args:
+            name: Prefix of the report files, e.g. 'server'
+            output_dir: Directory the reports are written to
+            interval: Seconds between samples
+            top: Functions and allocation sites listed in the text report
+        """
+        self.name = name
+        self.output_dir = output_dir
+        self.top = top
+        self.profiler = SamplingProfiler(interval)
+        self.started_tracemalloc = False
+        self.lock = threading.Lock()
+        # Numbers the reports, which may be written within the same second
+        self.reports = itertools.count(1)
+    
+    @property
+    def running(self) -> bool:
+        """Whether the profiler is on"""
+        return self.profiler.running
+    
+    def start(self):
+        """Start sampling and tracing allocations"""
+        with self.lock:
+            if self.profiler.running:
+                return
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+                self.started_tracemalloc = True
+            self.profiler.start()
+        log.info("Profiling started, sampling all threads every %.0f ms",
+                 self.profiler.interval * 1000)
+    
+    def stop(self) -> list:
+        """
+        Stop profiling and write the reports
+        
+        Returns:
+            Paths of the files written
+        """
+        with self.lock:
+            if not self.profiler.running:
+                return []
+            self.profiler.stop()
+            paths = self._write()
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+                self.started_tracemalloc = False
+        log.info("Profiling stopped")
+        return paths
+    
+    def toggle(self) -> list:
+        """Start if stopped, else stop and write the reports"""
+        if self.running:
+            return self.stop()
+        self.start()
+        return []
+    
+    def dump(self) -> list:
+        """
+        Write the reports of the samples so far and keep profiling
+        
+        Returns:
+            Paths of the files written, none if profiling is off
+        """
+        with self.lock:
+            if not self.profiler.running:
+                log.warning("Profiling is off, nothing to dump")
+                return []
+            return self._write()
+    
+    def restart_in_child(self):
+        """A forked worker has no sampler thread; give it its own profile"""
+        self.lock = threading.Lock()
+        if self.profiler.running:
+            self.profiler = SamplingProfiler(self.profiler.interval)
+            self.profiler.start()
+    
+    def _write(self) -> list:
+        """Write the .pstats and .txt reports (lock held)"""
+        snapshot = self.profiler.snapshot()
+        memory = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        base = os.path.join(self.output_dir,
+                            f"{self.name}-{os.getpid()}-{stamp}-{next(self.reports)}")
+        
+        paths = []
+        stats = None
+        # pstats cannot hold an empty profile, which an idle process has
+        if snapshot['stacks']:
+            stats = pstats.Stats(SampledStats(snapshot['stacks'], snapshot['interval']),
+                                 stream=StringIO())
+            stats.dump_stats(base + '.pstats')
+            paths.append(base + '.pstats')
+        with open(base + '.txt', 'w') as f:
+            f.write(format_report(snapshot, stats, memory, self.top))
+        paths.append(base + '.txt')
+        
+        log.info("Profile written to %s", ' and '.join(paths))
+        return paths
+
+
+def format_report(snapshot, stats, memory=None, top=TOP_N) -> str:
+    """
+    Text report of a profile
+    
+    Args:
+        snapshot: SamplingProfiler.snapshot()
+        stats: pstats.Stats of the same samples, None if all were idle
+        memory: tracemalloc.Snapshot (optional)
+        top: Entries per list
+    """
+    stacks = snapshot['stacks']
+    busy = sum(stacks.values())
+    interval = snapshot['interval']
+    lines = [
+        f"Profile of pid {os.getpid()}: {snapshot['duration']:.1f}s sampled every "
+        f"{interval * 1000:.0f} ms, {busy} busy and {snapshot['idle']} idle thread samples",
+        "",
+        "Busy time by subsystem:",
+    ]
+    subsystems = Counter()
+    for (subsystem, _), count in stacks.items():
+        subsystems[subsystem] += count
+    for subsystem, count in subsystems.most_common():
+        lines.append(f"  {subsystem:<12} {count * interval:8.2f}s  {count / busy:6.1%}")
+    
+    if stats is not None:
+        output = StringIO()
+        stats.stream = output
+        stats.sort_stats('tottime').print_stats(top)
+        stats.sort_stats('cumulative').print_stats(top)
+        lines += ["", "Time is estimated from samples; call counts are sample counts.",
+                  output.getvalue()]
+    else:
+        lines += ["  (all threads idle)", ""]
+    
+    if memory is not None:
+        memory = memory.filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+        current, peak = tracemalloc.get_traced_memory()
+        lines += [f"Memory allocated since profiling started: {current / 1024:.0f} KiB "
+                  f"(peak {peak / 1024:.0f} KiB), top {top} sites:"]
+        lines += [f"  {statistic}" for statistic in memory.statistics('lineno')[:top]]
+    return '\n'.join(lines) + '\n'
+
+
+_session = None
+
+
+def configure_profiling(name, output_dir='.', interval=SAMPLE_INTERVAL, top=TOP_N):
+    """
+    Set up this process's profiler and let SIGUSR1 and SIGUSR2 control it
+    
+    SIGUSR1 starts profiling, or stops it and writes the reports; SIGUSR2
+    writes the reports so far and keeps profiling. Signals are only
+    available on POSIX systems and must be set up from the main thread.
+    
+    Returns:
+        The ProfileSession
+    """
+    global _session
+    _session = ProfileSession(name, output_dir, interval, top)
+    if hasattr(signal, 'SIGUSR1') and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, _on_signal)
+        signal.signal(signal.SIGUSR2, _on_signal)
+    return _session
+
+
+def get_session():
+    """Return the ProfileSession, None if profiling was not configured"""
+    return _session
+
+
+def add_profiling_arguments(parser):
+    """Add the --profile* options to an argparse parser"""
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile from startup and write the report on exit; SIGUSR1 '
+                             'toggles profiling at any time, SIGUSR2 writes a report')
+    parser.add_argument('--profile-dir', default='.',
+                        help='Directory profile reports are written to (default: .)')
+    parser.add_argument('--profile-interval', type=float, default=SAMPLE_INTERVAL,
+                        help=f'Seconds between stack samples (default: {SAMPLE_INTERVAL})')
+
+
+def profile_from_args(parser, args, name):
+    """Apply the options added by add_profiling_arguments(), exiting on bad values"""
+    if args.profile_interval <= 0:
+        parser.error('--profile-interval must be positive')
+    if not os.path.isdir(args.profile_dir):
+        parser.error(f'--profile-dir: {args.profile_dir} is not a directory')
+    session = configure_profiling(name, args.profile_dir, args.profile_interval)
+    if args.profile:
+        session.start()
+
+
+def _on_signal(signum, frame):
+    """Act on SIGUSR1/SIGUSR2 in a thread; writing reports and logging must not run in a handler"""
+    action = _session.toggle if signum == signal.SIGUSR1 else _session.dump
+    threading.Thread(target=action, name='profile-signal', daemon=True).start()
+
+
+def _stop_at_exit():
+    """Write the report of a profile still running when the process exits"""
+    if _session is not None:
+        _session.stop()
+
+
+def _restart_in_child():
+    """Keep profiling in forked workers if the parent was"""
+    if _session is not None:
+        _session.restart_in_child()
+
+
+atexit.register(_stop_at_exit)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_in_child)
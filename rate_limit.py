@@ -0,0 +1,363 @@
+"""
+Rate Limit - Per-client token buckets and fair sharing of the server's bandwidth
+"""
+import ipaddress
+import json
+import threading
+import time
+
+
+# Directions of a tunnel as seen by the server: download is target -> client,
+# upload is client -> target
+DIRECTIONS = ('download', 'upload')
+
+# A bucket holds this many seconds of its rate, but never less than
+# MIN_BURST bytes so a full record or read always fits
+BURST_SECONDS = 0.5
+MIN_BURST = 64 * 1024
+
+# Seconds between recomputing the fair shares of the total rate
+REBALANCE_INTERVAL = 0.5
+
+# A client counts as active in a direction while it sent data this recently
+ACTIVE_WINDOW = 2.0
+
+# A client that was not held back gets this multiple of its recent rate as
+# its share, so it can speed up before the next rebalance
+SHARE_HEADROOM = 2.0
+
+RATE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_rate(value):
+    """
+    Parse a rate in bytes per second, e.g. 500000, "512K", "10M"
+    
+    Returns:
+        Bytes per second, or None for no limit (None, 0, "0", "unlimited")
+    
+    Raises:
+        ValueError: if the rate is not a number with an optional K/M/G suffix
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        rate = float(value)
+    else:
+        text = str(value).strip().upper()
+        if text in ('', 'UNLIMITED', 'NONE'):
+            return None
+        unit = text[-1] if text[-1] in RATE_UNITS else ''
+        try:
+            rate = float(text[:len(text) - len(unit)]) * RATE_UNITS[unit]
+        except ValueError:
+            raise ValueError(f"Invalid rate {value!r}") from None
+    if rate < 0:
+        raise ValueError(f"Invalid rate {value!r}")
+    return rate or None
+
+
+class TokenBucket:
+    """Token bucket that lets callers go into debt and tells them how long to pause"""
+    
+    def __init__(self, rate, now=None):
+        """
+        Initialize bucket
+        
+        Args:
+            rate: Bytes per second
+            now: Current time.monotonic() (optional)
+        """
+        self.rate = rate
+        self.burst = max(rate * BURST_SECONDS, MIN_BURST)
+        self.tokens = self.burst
+        self.updated = time.monotonic() if now is None else now
+    
+    def refill(self, now):
+        """Add the tokens earned since the last update"""
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+        self.updated = now
+    
+    def set_rate(self, rate, now):
+        """Change the rate, keeping the tokens already earned"""
+        self.refill(now)
+        self.rate = rate
+        self.burst = max(rate * BURST_SECONDS, MIN_BURST)
+        self.tokens = min(self.tokens, self.burst)
+    
+    def consume(self, amount, now) -> float:
+        """
+        Take amount tokens
+        
+        Returns:
+            Seconds until the bucket is out of debt, 0.0 if it is not in debt
+        """
+        self.refill(now)
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RateClass:
+    """Limits shared by all clients whose address is in one of the networks"""
+    
+    def __init__(self, name, networks=(), download=None, upload=None):
+        """
+        Initialize class
+        
+        Args:
+            name: Name used in logs
+            networks: CIDR strings the class applies to (empty matches all)
+            download: Per-client target -> client rate, see parse_rate()
+            upload: Per-client client -> target rate, see parse_rate()
+        """
+        self.name = name
+        self.networks = [ipaddress.ip_network(network, strict=False) for network in networks]
+        self.rates = {'download': parse_rate(download), 'upload': parse_rate(upload)}
+    
+    def matches(self, address) -> bool:
+        """Whether a client address belongs to this class"""
+        if not self.networks:
+            return True
+        return any(address in network for network in self.networks
+                   if network.version == address.version)
+
+
+class ClientLimits:
+    """Buckets of one client address, shared by all of its tunnels"""
+    
+    def __init__(self, limiter, key, rate_class, now):
+        """
+        Initialize limits
+        
+        Args:
+            limiter: Owning RateLimiter, which also applies the total rate
+            key: Normalized client address
+            rate_class: RateClass the address matched
+            now: time.monotonic() the buckets start filling at
+        """
+        self.limiter = limiter
+        self.key = key
+        self.rate_class = rate_class
+        self.references = 0
+        self.buckets = {direction: TokenBucket(rate, now) if rate else None
+                        for direction, rate in rate_class.rates.items()}
+        # Fair share of the total rate, managed by the RateLimiter
+        self.shares = dict.fromkeys(DIRECTIONS)
+        self.usage = dict.fromkeys(DIRECTIONS, 0)
+        self.held_back = dict.fromkeys(DIRECTIONS, False)
+        self.last_active = dict.fromkeys(DIRECTIONS, 0.0)
+    
+    def consume(self, direction, amount) -> float:
+        """
+        Charge amount bytes relayed in direction
+        
+        Returns:
+            Seconds the caller should stop reading in that direction
+        """
+        return self.limiter.consume(self, direction, amount)
+
+
+class RateLimiter:
+    """Per-client rate limits plus a max-min fair split of the server's total rate"""
+    
+    def __init__(self, classes=(), default=None, total_download=None, total_upload=None):
+        """
+        Initialize rate limiter
+        
+        Args:
+            classes: RateClasses, the first one matching a client applies
+            default: RateClass for clients no class matches (default: unlimited)
+            total_download: Server-wide target -> client rate shared fairly
+                            between active clients, see parse_rate()
+            total_upload: Server-wide client -> target rate, likewise
+        """
+        self.classes = list(classes)
+        self.default = default or RateClass('default')
+        self.totals = {'download': parse_rate(total_download), 'upload': parse_rate(total_upload)}
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.rebalanced = time.monotonic()
+        self.throttle_events = 0
+    
+    @classmethod
+    def from_config(cls, config):
+        """
+        Build a limiter from a config dict:
+            
+            {"total": {"download": "100M", "upload": "20M"},
+             "default": {"download": "10M", "upload": "2M"},
+             "classes": [{"name": "guests", "networks": ["192.168.50.0/24"],
+                          "download": "1M", "upload": "256K"}]}
+        
+        Returns:
+            A RateLimiter, or None if the config sets no limit at all
+        """
+        total = config.get('total') or {}
+        default = config.get('default') or {}
+        classes = [RateClass(entry.get('name', f"class{number}"), entry.get('networks', ()),
+                             entry.get('download'), entry.get('upload'))
+                   for number, entry in enumerate(config.get('classes') or [], 1)]
+        limiter = cls(classes, RateClass('default', (), default.get('download'), default.get('upload')),
+                      total.get('download'), total.get('upload'))
+        if not limiter.enabled():
+            return None
+        return limiter
+    
+    def enabled(self) -> bool:
+        """Whether any limit is configured"""
+        rate_classes = self.classes + [self.default]
+        return (any(self.totals.values())
+                or any(rate for rate_class in rate_classes for rate in rate_class.rates.values()))
+    
+    def describe(self) -> str:
+        """One-line summary for the startup log"""
+        def rates(values):
+            return f"down {format_rate(values['download'])} up {format_rate(values['upload'])}"
+        parts = [f"total {rates(self.totals)}", f"per client {rates(self.default.rates)}"]
+        parts += [f"{rate_class.name} {rates(rate_class.rates)}" for rate_class in self.classes]
+        return '; '.join(parts)
+    
+    def client(self, address):
+        """
+        Return the shared limits of a client address; release() them when
+        the tunnel ends
+        """
+        ip = ipaddress.ip_address(address.split('%', 1)[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        key = str(ip)
+        with self.lock:
+            limits = self.clients.get(key)
+            if limits is None:
+                rate_class = next((c for c in self.classes if c.matches(ip)), self.default)
+                limits = self.clients[key] = ClientLimits(self, key, rate_class, time.monotonic())
+            limits.references += 1
+            return limits
+    
+    def release(self, limits):
+        """A tunnel of the client has ended"""
+        with self.lock:
+            limits.references -= 1
+            if limits.references <= 0:
+                self.clients.pop(limits.key, None)
+    
+    def consume(self, limits, direction, amount) -> float:
+        """Charge a client's buckets, see ClientLimits.consume()"""
+        now = time.monotonic()
+        with self.lock:
+            total = self.totals[direction]
+            # Clients joining the share (or coming back) get one at once
+            if total and (limits.shares[direction] is None
+                          or now - limits.last_active[direction] >= ACTIVE_WINDOW):
+                limits.last_active[direction] = now
+                self._rebalance(now)
+            elif now - self.rebalanced >= REBALANCE_INTERVAL:
+                self._rebalance(now)
+            
+            limits.last_active[direction] = now
+            limits.usage[direction] += amount
+            delay = 0.0
+            bucket = limits.buckets[direction]
+            if bucket is not None:
+                delay = bucket.consume(amount, now)
+            share = limits.shares[direction]
+            if share is not None:
+                share_delay = share.consume(amount, now)
+                if share_delay > delay:
+                    limits.held_back[direction] = True
+                    delay = share_delay
+            if delay:
+                self.throttle_events += 1
+            return delay
+    
+    def get_stats(self) -> dict:
+        """Return limiter counters"""
+        with self.lock:
+            return {
+                'rate_limited_clients': len(self.clients),
+                'rate_throttle_events': self.throttle_events,
+            }
+    
+    def _rebalance(self, now):
+        """
+        Split each total rate between the active clients (lock held)
+        
+        Clients that were not held back by their share need little more than
+        what they recently used; whatever they leave is split equally among
+        the clients that want more, so one bulk transfer cannot starve the
+        others and idle bandwidth is not wasted.
+        """
+        elapsed = max(now - self.rebalanced, REBALANCE_INTERVAL)
+        self.rebalanced = now
+        for direction, total in self.totals.items():
+            if not total:
+                continue
+            active = [limits for limits in self.clients.values()
+                      if now - limits.last_active[direction] < ACTIVE_WINDOW]
+            demands = {}
+            for limits in active:
+                if limits.held_back[direction]:
+                    demand = total
+                else:
+                    demand = max(limits.usage[direction] / elapsed * SHARE_HEADROOM, MIN_BURST)
+                rate = limits.rate_class.rates[direction]
+                demands[limits] = min(demand, rate) if rate else demand
+                limits.usage[direction] = 0
+                limits.held_back[direction] = False
+            
+            # Max-min fairness: satisfy the smallest demands first
+            remaining = total
+            allocation = {}
+            pending = sorted(active, key=lambda limits: demands[limits])
+            for index, limits in enumerate(pending):
+                allocation[limits] = min(demands[limits], remaining / (len(pending) - index))
+                remaining -= allocation[limits]
+            
+            for limits in active:
+                # Leftovers go to everyone so the total is always handed out
+                rate = allocation[limits] + remaining / len(active)
+                share = limits.shares[direction]
+                if share is None:
+                    limits.shares[direction] = TokenBucket(rate, now)
+                else:
+                    share.set_rate(rate, now)
+
+
+def format_rate(rate) -> str:
+    """Human-readable bytes per second"""
+    if not rate:
+        return 'unlimited'
+    for unit in ('G', 'M', 'K'):
+        if rate >= RATE_UNITS[unit]:
+            return f"{rate / RATE_UNITS[unit]:g}{unit}B/s"
+    return f"{rate:g}B/s"
+
+
+def load_rate_config(path=None, client_rate=None, total_rate=None) -> dict:
+    """
+    Read a rate limit config file and apply command line overrides
+    
+    Args:
+        path: JSON file in the format of RateLimiter.from_config() (optional)
+        client_rate: Default per-client rate for both directions (optional)
+        total_rate: Server-wide rate for both directions (optional)
+    
+    Raises:
+        ValueError: if the file or a rate is invalid
+    """
+    config = {}
+    if path:
+        try:
+            with open(path, 'r') as f:
+                config = json.load(f)
+        except (OSError, ValueError) as e:
+            raise ValueError(f"Cannot read rate limit config {path}: {e}") from None
+    if client_rate is not None:
+        parse_rate(client_rate)
+        config['default'] = {'download': client_rate, 'upload': client_rate}
+    if total_rate is not None:
+        parse_rate(total_rate)
+        config['total'] = {'download': total_rate, 'upload': total_rate}
+    return config
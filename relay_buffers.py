@@ -0,0 +1,181 @@
+"""
+Relay buffers - Preallocated receive buffers and scatter-gather sends for relay loops
+"""
+import select
+import socket
+import time
+from collections import deque
+
+
+# Adaptive receive buffer bounds
+MIN_BUFFER_SIZE = 4096
+DEFAULT_BUFFER_SIZE = 16384
+MAX_BUFFER_SIZE = 256 * 1024
+
+# Consecutive small reads before the buffer shrinks
+SHRINK_AFTER_READS = 16
+
+# Upper bound on buffers passed to one sendmsg() call (IOV_MAX is >= 1024 on Linux)
+MAX_IOVECS = 512
+
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# select() cannot watch descriptors above FD_SETSIZE (1024), which a busy
+# server reaches; poll() has no such limit but is missing on Windows
+HAS_POLL = hasattr(select, 'poll')
+POLL_READABLE = (select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP) if HAS_POLL else 0
+
+
+class AdaptiveBuffer:
+    """Reusable receive buffer that grows for bulk flows and shrinks for idle ones"""
+    
+    __slots__ = ('min_size', 'max_size', 'small_reads', 'account', 'size', 'buffer', 'view')
+    
+    def __init__(self, size=DEFAULT_BUFFER_SIZE, min_size=MIN_BUFFER_SIZE, max_size=MAX_BUFFER_SIZE,
+                 account=None):
+        """
+        Initialize buffer
+        
+        Args:
+            size: Initial buffer size in bytes
+            min_size: Smallest size the buffer shrinks to
+            max_size: Largest size the buffer grows to
+            account: admission.Slot the buffer's size is charged to; the
+                     buffer only grows while the memory budget has room
+        """
+        self.min_size = min_size
+        self.max_size = max_size
+        self.small_reads = 0
+        self.account = account
+        self._allocate(size)
+        if account is not None:
+            account.charge(size)
+    
+    def _allocate(self, size):
+        """Replace the backing storage with a buffer of the given size"""
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+    
+    def recv_into(self, sock) -> memoryview:
+        """
+        Receive into the buffer
+        
+        Returns:
+            A view of the received bytes, valid until the next call. An
+            empty view means the peer closed the connection.
+        """
+        received = sock.recv_into(self.view)
+        data = self.view[:received]
+        
+        if received == self.size and self.size < self.max_size:
+            # The socket had more queued than we could take
+            self._grow()
+            self.small_reads = 0
+        elif received < self.size // 4 and self.size > self.min_size:
+            self.small_reads += 1
+            if self.small_reads >= SHRINK_AFTER_READS:
+                self.small_reads = 0
+                self._shrink()
+        else:
+            self.small_reads = 0
+        return data
+    
+    def _grow(self):
+        """Double the buffer, keeping the view handed out by recv_into() valid"""
+        size = min(self.size * 2, self.max_size)
+        if self.account is not None and not self.account.reserve(size - self.size):
+            return
+        self._allocate(size)
+    
+    def _shrink(self):
+        """Halve the buffer"""
+        size = max(self.size // 2, self.min_size)
+        if self.account is not None:
+            self.account.release(self.size - size)
+        self._allocate(size)
+
+
+def wait_readable(sockets, timeout):
+    """
+    Wait until some of the sockets are readable (or failed)
+    
+    Args:
+        sockets: Sockets to watch, may be empty
+        timeout: Seconds to wait at most
+    
+    Returns:
+        List of the readable sockets, empty on timeout
+    """
+    if not sockets:
+        time.sleep(timeout)
+        return []
+    if not HAS_POLL:
+        return select.select(sockets, [], [], timeout)[0]
+    
+    poller = select.poll()
+    for sock in sockets:
+        poller.register(sock, POLL_READABLE)
+    ready = {fd for fd, _ in poller.poll(timeout * 1000)}
+    return [sock for sock in sockets if sock.fileno() in ready]
+
+
+def send_buffers(sock, buffers):
+    """
+    Send several buffers in order without concatenating them
+    
+    Uses sendmsg() scatter-gather where the platform has it and falls back
+    to one sendall() of the joined buffers otherwise (e.g. Windows).
+    """
+    if not HAS_SENDMSG:
+        sock.sendall(b''.join(buffers))
+        return
+    
+    pending = deque(memoryview(b).cast('B') for b in buffers if len(b))
+    while pending:
+        batch = [pending[i] for i in range(min(len(pending), MAX_IOVECS))]
+        sent = sock.sendmsg(batch)
+        
+        # Drop fully sent buffers and trim a partially sent one
+        while sent:
+            head = pending[0]
+            if sent >= head.nbytes:
+                sent -= head.nbytes
+                pending.popleft()
+            else:
+                pending[0] = head[sent:]
+                sent = 0
+
+
+def flush_buffers(sock, pending) -> int:
+    """
+    Send as much of a deque of buffers as a non-blocking socket accepts
+    
+    Fully sent buffers are removed from pending and a partially sent one is
+    trimmed in place.
+    
+    Returns:
+        Number of bytes sent
+    """
+    total = 0
+    while pending:
+        try:
+            if HAS_SENDMSG:
+                batch = [pending[i] for i in range(min(len(pending), MAX_IOVECS))]
+                sent = sock.sendmsg(batch)
+            else:
+                sent = sock.send(pending[0])
+        except (BlockingIOError, InterruptedError):
+            break
+        
+        total += sent
+        while sent:
+            head = pending[0]
+            size = memoryview(head).nbytes
+            if sent >= size:
+                sent -= size
+                pending.popleft()
+            else:
+                pending[0] = memoryview(head).cast('B')[sent:]
+                sent = 0
+    return total
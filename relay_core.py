@@ -0,0 +1,307 @@
+"""
+Relay Core - Relays many tunnels from one thread with selectors and non-blocking sockets
+"""
+import heapq
+import itertools
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from admission import half_close
+from relay_buffers import AdaptiveBuffer, flush_buffers
+from vpn_logging import get_logger
+
+
+log = get_logger('relay')
+
+# Bytes queued for one side before we stop reading from the other side;
+# reading resumes once the queue has drained to half of this
+MAX_PENDING_BYTES = 256 * 1024
+
+
+class RelayEndpoint:
+    """One socket of a tunnel and the data queued for it"""
+    
+    __slots__ = ('sock', 'pending', 'pending_bytes', 'peer', 'paused', 'eof', 'shut', 'events',
+                 'throttled_until')
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = deque()
+        self.pending_bytes = 0
+        self.peer = None
+        self.paused = False
+        # Nothing more will be read from / written to this socket
+        self.eof = False
+        self.shut = False
+        self.events = 0
+        # Not read again before this time.monotonic() (rate limiting)
+        self.throttled_until = 0.0
+    
+    def queue(self, buffers) -> int:
+        """Queue data to be written to this endpoint, returning the bytes queued"""
+        queued = 0
+        for buffer in buffers:
+            size = memoryview(buffer).nbytes
+            if size:
+                self.pending.append(buffer)
+                queued += size
+        self.pending_bytes += queued
+        return queued
+
+
+class RelayTunnel:
+    """A record-encrypted socket paired with a plain socket"""
+    
+    __slots__ = ('record', 'plain', 'encoder', 'decoder', 'plain_buffer', 'on_close', 'limits',
+                 'slot', 'closed')
+    
+    def __init__(self, record_sock, plain_sock, encoder, decoder, on_close=None, limits=None,
+                 slot=None):
+        """
+        Initialize tunnel
+        
+        Args:
+            record_sock: Socket carrying records (VPN client or server side)
+            plain_sock: Socket carrying plain data (target or local application)
+            encoder: Record encoder for data read from plain_sock
+            decoder: Record decoder for data read from record_sock
+            on_close: Called with no arguments once the tunnel is closed
+            limits: rate_limit.ClientLimits charged for data read from
+                    record_sock ('upload') and plain_sock ('download')
+            slot: admission.Slot counting the data read and charged for
+                  the data queued
+        """
+        self.record = RelayEndpoint(record_sock)
+        self.plain = RelayEndpoint(plain_sock)
+        self.record.peer = self.plain
+        self.plain.peer = self.record
+        self.encoder = encoder
+        self.decoder = decoder
+        self.plain_buffer = AdaptiveBuffer(account=slot)
+        self.on_close = on_close
+        self.limits = limits
+        self.slot = slot
+        self.closed = False
+
+
+class RelayLoop:
+    """Event loop relaying any number of tunnels from a single thread"""
+    
+    def __init__(self, max_pending=MAX_PENDING_BYTES):
+        """
+        Initialize relay loop
+        
+        Args:
+            max_pending: Bytes queued per direction before reading pauses
+        """
+        self.max_pending = max_pending
+        self.resume_pending = max_pending // 2
+        self.selector = selectors.DefaultSelector()
+        self.incoming = deque()
+        self.tunnels = set()
+        self.running = False
+        # Heap of (resume time, sequence, tunnel) for rate-limited endpoints
+        self.throttled = []
+        self.sequence = itertools.count()
+        
+        # Wakes the selector when tunnels are added from other threads
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ, None)
+    
+    def start(self):
+        """Run the loop in a background thread"""
+        self.running = True
+        threading.Thread(target=self.run, name='relay-loop', daemon=True).start()
+    
+    def add_tunnel(self, record_sock, plain_sock, encoder, decoder, on_close=None, limits=None,
+                   slot=None):
+        """Hand a connected tunnel over to the loop (thread-safe)"""
+        tunnel = RelayTunnel(record_sock, plain_sock, encoder, decoder, on_close, limits, slot)
+        self.incoming.append(tunnel)
+        try:
+            self.wake_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+        return tunnel
+    
+    def active_tunnels(self) -> int:
+        """Number of tunnels currently relayed"""
+        return len(self.tunnels)
+    
+    def run(self):
+        """Relay until stop() is called"""
+        while self.running:
+            timeout = 1
+            if self.throttled:
+                timeout = min(max(self.throttled[0][0] - time.monotonic(), 0), timeout)
+            for key, events in self.selector.select(timeout=timeout):
+                if key.data is None:
+                    self._accept_incoming()
+                    continue
+                tunnel, endpoint = key.data
+                if tunnel.closed:
+                    continue
+                try:
+                    if events & selectors.EVENT_WRITE:
+                        self._write(tunnel, endpoint)
+                    if events & selectors.EVENT_READ and not tunnel.closed:
+                        self._read(tunnel, endpoint)
+                except OSError:
+                    self._close(tunnel)
+                except Exception as e:
+                    log.warning("Tunnel error: %s", e)
+                    self._close(tunnel)
+                if not tunnel.closed:
+                    self._update_interest(tunnel)
+            self._resume_throttled()
+        
+        for tunnel in list(self.tunnels):
+            self._close(tunnel)
+    
+    def stop(self):
+        """Stop the loop and close every tunnel"""
+        self.running = False
+        try:
+            self.wake_writer.send(b'\0')
+        except OSError:
+            pass
+    
+    def _accept_incoming(self):
+        """Register tunnels queued by add_tunnel()"""
+        try:
+            while self.wake_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        
+        while self.incoming:
+            tunnel = self.incoming.popleft()
+            self.tunnels.add(tunnel)
+            for endpoint in (tunnel.record, tunnel.plain):
+                endpoint.sock.setblocking(False)
+                endpoint.events = selectors.EVENT_READ
+                self.selector.register(endpoint.sock, endpoint.events, (tunnel, endpoint))
+    
+    def _read(self, tunnel, endpoint):
+        """Read from one side and queue the result for the other"""
+        if endpoint is tunnel.record:
+            try:
+                payloads = tunnel.decoder.recv_from(endpoint.sock)
+            except (BlockingIOError, InterruptedError):
+                return
+            if payloads is None:
+                endpoint.eof = True
+            else:
+                queued = endpoint.peer.queue(payloads)
+                self._charge(tunnel, endpoint, 'upload', sum(len(payload) for payload in payloads),
+                             queued)
+        else:
+            try:
+                data = tunnel.plain_buffer.recv_into(endpoint.sock)
+            except (BlockingIOError, InterruptedError):
+                return
+            if not data:
+                endpoint.eof = True
+            else:
+                queued = endpoint.peer.queue(tunnel.encoder.encode_parts(data))
+                self._charge(tunnel, endpoint, 'download', len(data), queued)
+        
+        self._write(tunnel, endpoint.peer)
+    
+    def _charge(self, tunnel, endpoint, direction, amount, queued):
+        """Count data read on the tunnel's slot and against its rate limits, pausing the endpoint if over"""
+        if tunnel.slot is not None:
+            tunnel.slot.count(direction, amount)
+            tunnel.slot.charge(queued)
+        if tunnel.limits is None or not amount:
+            return
+        delay = tunnel.limits.consume(direction, amount)
+        if delay:
+            endpoint.throttled_until = time.monotonic() + delay
+            heapq.heappush(self.throttled, (endpoint.throttled_until, next(self.sequence), tunnel))
+    
+    def _resume_throttled(self):
+        """Read again from endpoints whose rate limit pause is over"""
+        now = time.monotonic()
+        while self.throttled and self.throttled[0][0] <= now:
+            _, _, tunnel = heapq.heappop(self.throttled)
+            if not tunnel.closed:
+                self._update_interest(tunnel)
+    
+    def _write(self, tunnel, endpoint):
+        """Flush queued data to an endpoint"""
+        if endpoint.pending:
+            sent = flush_buffers(endpoint.sock, endpoint.pending)
+            endpoint.pending_bytes -= sent
+            if tunnel.slot is not None:
+                tunnel.slot.release(sent)
+        
+        # Once everything the peer sent before its EOF is delivered, pass the
+        # half-close on; the tunnel ends when both directions are done
+        if endpoint.peer.eof and not endpoint.pending and not endpoint.shut:
+            endpoint.shut = True
+            half_close(endpoint.sock)
+        if tunnel.record.shut and tunnel.plain.shut:
+            self._close(tunnel)
+    
+    def _update_interest(self, tunnel):
+        """Pause reads behind full queues and watch for writability"""
+        # Over the memory budget a side may only read again once the data it
+        # queued before has been sent
+        over_budget = tunnel.slot is not None and tunnel.slot.over_budget()
+        for endpoint in (tunnel.record, tunnel.plain):
+            peer = endpoint.peer
+            if peer.pending_bytes >= self.max_pending or (over_budget and peer.pending_bytes):
+                endpoint.paused = True
+            elif peer.pending_bytes <= self.resume_pending:
+                endpoint.paused = False
+        
+        now = time.monotonic() if tunnel.limits is not None else 0.0
+        for endpoint in (tunnel.record, tunnel.plain):
+            events = 0
+            if not endpoint.paused and not endpoint.eof and endpoint.throttled_until <= now:
+                events |= selectors.EVENT_READ
+            if endpoint.pending:
+                events |= selectors.EVENT_WRITE
+            
+            if events != endpoint.events:
+                if endpoint.events and events:
+                    self.selector.modify(endpoint.sock, events, (tunnel, endpoint))
+                elif events:
+                    self.selector.register(endpoint.sock, events, (tunnel, endpoint))
+                else:
+                    self.selector.unregister(endpoint.sock)
+                endpoint.events = events
+    
+    def _close(self, tunnel):
+        """Close both sockets of a tunnel"""
+        if tunnel.closed:
+            return
+        tunnel.closed = True
+        self.tunnels.discard(tunnel)
+        
+        for endpoint in (tunnel.record, tunnel.plain):
+            if endpoint.events:
+                try:
+                    self.selector.unregister(endpoint.sock)
+                except (KeyError, ValueError):
+                    pass
+                endpoint.events = 0
+            try:
+                endpoint.sock.close()
+            except OSError:
+                pass
+            endpoint.pending.clear()
+            if tunnel.slot is not None:
+                tunnel.slot.release(endpoint.pending_bytes)
+            endpoint.pending_bytes = 0
+        
+        if tunnel.on_close is not None:
+            try:
+                tunnel.on_close()
+            except Exception as e:
+                log.warning("Close callback error: %s", e)
@@ -0,0 +1,293 @@
+"""
+Resolver - Cached DNS lookups and Happy Eyeballs (RFC 8305) dual-stack connects for targets
+"""
+import errno
+import ipaddress
+import os
+import selectors
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+# getaddrinfo() does not expose record TTLs, so answers are kept for a fixed
+# time; failed lookups are remembered for a shorter time
+DNS_CACHE_SIZE = 1024
+DNS_TTL = 300
+DNS_NEGATIVE_TTL = 30
+
+# Seconds to wait for a connection attempt before racing the next address
+HAPPY_EYEBALLS_DELAY = 0.25
+
+# Deadline for the whole connect, all addresses included
+CONNECT_TIMEOUT = 10
+
+CONNECT_IN_PROGRESS = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN, errno.EALREADY}
+
+
+class Resolver:
+    """Resolves target hosts through a bounded TTL cache and connects to them"""
+    
+    def __init__(self, cache_size=DNS_CACHE_SIZE, ttl=DNS_TTL, negative_ttl=DNS_NEGATIVE_TTL,
+                 connect_timeout=CONNECT_TIMEOUT, happy_eyeballs_delay=HAPPY_EYEBALLS_DELAY):
+        """
+        Initialize resolver
+        
+        Args:
+            cache_size: Maximum number of cached hosts, 0 disables the cache
+            ttl: Seconds a successful lookup is reused
+            negative_ttl: Seconds a failed lookup is reused
+            connect_timeout: Deadline for connect() over all addresses
+            happy_eyeballs_delay: Seconds before the next address is tried
+                                  while an attempt is still pending
+        """
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.connect_timeout = connect_timeout
+        self.happy_eyeballs_delay = happy_eyeballs_delay
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.lookups = {}
+        self.stats = {
+            'dns_cache_hits': 0,
+            'dns_cache_misses': 0,
+            'dns_failures': 0,
+        }
+    
+    def resolve(self, host, port) -> list:
+        """
+        Resolve a host to connect() candidates
+        
+        Concurrent lookups of the same host share one getaddrinfo() call.
+        
+        Returns:
+            List of (family, sockaddr), alternating address families
+        
+        Raises:
+            socket.gaierror: If the host does not resolve (possibly cached)
+        """
+        literal = address_literal(host, port)
+        if literal is not None:
+            return literal
+        
+        name = host.lower()
+        while True:
+            with self.lock:
+                entry = self._cached(name)
+                if entry is not None:
+                    self.stats['dns_cache_hits'] += 1
+                    break
+                lookup = self.lookups.get(name)
+                if lookup is None:
+                    lookup = self.lookups[name] = threading.Event()
+                    self.stats['dns_cache_misses'] += 1
+                    owner = True
+                else:
+                    owner = False
+            
+            if not owner:
+                lookup.wait()
+                continue
+            
+            entry = None
+            try:
+                entry = self._lookup(name)
+            finally:
+                with self.lock:
+                    self._store(name, entry)
+                    del self.lookups[name]
+                lookup.set()
+            break
+        
+        addresses = entry[1]
+        if isinstance(addresses, Exception):
+            raise addresses
+        return [(family, with_port(sockaddr, port)) for family, sockaddr in addresses]
+    
+    def cached(self, host, port):
+        """Return resolve()'s answer if it needs no lookup, otherwise None"""
+        literal = address_literal(host, port)
+        if literal is not None:
+            return literal
+        with self.lock:
+            entry = self._cached(host.lower())
+            if entry is None or isinstance(entry[1], Exception):
+                return None
+            self.stats['dns_cache_hits'] += 1
+        return [(family, with_port(sockaddr, port)) for family, sockaddr in entry[1]]
+    
+    def connect(self, host, port, prepare=None) -> socket.socket:
+        """
+        Resolve and connect to a target, racing its addresses
+        
+        Args:
+            prepare: Called with each new socket before it connects (optional)
+        """
+        return happy_eyeballs_connect(self.resolve(host, port), self.connect_timeout,
+                                      self.happy_eyeballs_delay, prepare)
+    
+    def get_stats(self) -> dict:
+        """Return a snapshot of the cache counters"""
+        with self.lock:
+            stats = dict(self.stats)
+            stats['dns_cache_entries'] = len(self.cache)
+        return stats
+    
+    def clear(self):
+        """Forget all cached answers"""
+        with self.lock:
+            self.cache.clear()
+    
+    def _lookup(self, name):
+        """Run getaddrinfo() and build a cache entry (expiry, addresses or error)"""
+        try:
+            infos = socket.getaddrinfo(name, None, socket.AF_UNSPEC, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            with self.lock:
+                self.stats['dns_failures'] += 1
+            return time.monotonic() + self.negative_ttl, e
+        return time.monotonic() + self.ttl, interleave(
+            [(family, sockaddr) for family, _, _, _, sockaddr in infos])
+    
+    def _cached(self, name):
+        """Return the live cache entry for name (lock held)"""
+        entry = self.cache.get(name)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self.cache[name]
+            return None
+        self.cache.move_to_end(name)
+        return entry
+    
+    def _store(self, name, entry):
+        """Insert an entry, evicting the least recently used ones (lock held)"""
+        if entry is None or self.cache_size <= 0:
+            return
+        self.cache[name] = entry
+        self.cache.move_to_end(name)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+
+def address_literal(host, port):
+    """Return the candidate list for an IP address literal, or None for a hostname"""
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return None
+    if address.version == 6:
+        return [(socket.AF_INET6, (host, port, 0, 0))]
+    return [(socket.AF_INET, (host, port))]
+
+
+def with_port(sockaddr, port):
+    """Return sockaddr with its port replaced"""
+    return (sockaddr[0], port) + tuple(sockaddr[2:])
+
+
+def interleave(addresses) -> list:
+    """
+    Order addresses for Happy Eyeballs: alternate families, starting with the
+    family getaddrinfo() preferred, keeping the order within each family
+    """
+    addresses = list(OrderedDict.fromkeys(addresses))
+    if not addresses:
+        return addresses
+    first_family = addresses[0][0]
+    preferred = deque(a for a in addresses if a[0] == first_family)
+    others = deque(a for a in addresses if a[0] != first_family)
+    
+    ordered = []
+    while preferred or others:
+        if preferred:
+            ordered.append(preferred.popleft())
+        if others:
+            ordered.append(others.popleft())
+    return ordered
+
+
+def connect_error(errors) -> OSError:
+    """Build the exception raised when every connection attempt failed"""
+    if len(errors) == 1:
+        return errors[0]
+    message = f"Multiple exceptions: {', '.join(str(e) for e in errors)}"
+    # Keep the errno when every address failed the same way (e.g. refused)
+    codes = {e.errno for e in errors}
+    if len(codes) == 1 and None not in codes:
+        return OSError(codes.pop(), message)
+    return OSError(message)
+
+
+def happy_eyeballs_connect(addresses, timeout=CONNECT_TIMEOUT, delay=HAPPY_EYEBALLS_DELAY,
+                           prepare=None):
+    """
+    Connect to the first address that answers, racing them RFC 8305 style
+    
+    A new attempt starts every delay seconds, or as soon as an attempt
+    fails, while earlier attempts keep running. The first established
+    connection wins and the others are closed.
+    
+    Args:
+        addresses: List of (family, sockaddr) in preference order
+        timeout: Deadline for the whole connect in seconds
+        delay: Seconds between starting attempts
+        prepare: Called with each new socket before it connects, e.g. to
+                 set socket options (optional)
+    
+    Returns:
+        A connected blocking socket
+    """
+    candidates = deque(addresses)
+    deadline = time.monotonic() + timeout
+    next_attempt = time.monotonic()
+    errors = []
+    selector = selectors.DefaultSelector()
+    
+    try:
+        while candidates or selector.get_map():
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            
+            if candidates and (now >= next_attempt or not selector.get_map()):
+                family, sockaddr = candidates.popleft()
+                sock = socket.socket(family, socket.SOCK_STREAM)
+                if prepare is not None:
+                    prepare(sock)
+                sock.setblocking(False)
+                result = sock.connect_ex(sockaddr)
+                if result == 0:
+                    sock.setblocking(True)
+                    return sock
+                if result not in CONNECT_IN_PROGRESS:
+                    sock.close()
+                    errors.append(OSError(result, os.strerror(result), sockaddr))
+                    continue
+                selector.register(sock, selectors.EVENT_WRITE, sockaddr)
+                next_attempt = now + delay
+            
+            wait = deadline - now
+            if candidates:
+                wait = min(wait, max(next_attempt - now, 0))
+            for key, _ in selector.select(wait):
+                sock = key.fileobj
+                selector.unregister(sock)
+                result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if result == 0:
+                    sock.setblocking(True)
+                    return sock
+                sock.close()
+                errors.append(OSError(result, os.strerror(result), key.data))
+                # A failed attempt lets the next one start right away
+                next_attempt = time.monotonic()
+        
+        if candidates or selector.get_map() or not errors:
+            raise socket.timeout("timed out")
+        raise connect_error(errors)
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
@@ -0,0 +1,160 @@
+"""
+Server Probe - Concurrent latency probing of configured VPN servers
+"""
+import json
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from vpn_client import recv_exact
+
+
+# Seconds allowed for connect plus handshake of one server
+PROBE_TIMEOUT = 3
+
+# Seconds a probe result is reused before the server is probed again;
+# failures are retried sooner
+PROBE_CACHE_TTL = 300
+PROBE_FAILURE_TTL = 30
+PROBE_CACHE_FILE = '.probe_cache.json'
+
+# Upper bound on probes in flight; all servers are usually probed at once
+PROBE_WORKERS = 32
+
+# The handshake starts with the server's key; anything longer is not our server
+MAX_KEY_LENGTH = 1024
+
+
+def probe_server(host, port, timeout=PROBE_TIMEOUT) -> dict:
+    """
+    Measure TCP connect and handshake time to one VPN server
+    
+    The handshake is timed until the server's key has arrived, which is
+    what every tunnel waits for before it can send its request.
+    
+    Returns:
+        dict with healthy, connect_ms, handshake_ms, rtt_ms (their sum)
+        and error (None when healthy)
+    """
+    result = {'healthy': False, 'connect_ms': None, 'handshake_ms': None, 'rtt_ms': None,
+              'error': None}
+    deadline = time.monotonic() + timeout
+    started = time.perf_counter()
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            connected = time.perf_counter()
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+            header = recv_exact(sock, 4)
+            key_length = int.from_bytes(header, 'big')
+            if not 0 < key_length <= MAX_KEY_LENGTH:
+                raise ConnectionError("Unexpected handshake, not a VPN server")
+            recv_exact(sock, key_length)
+            finished = time.perf_counter()
+    except (OSError, ConnectionError) as e:
+        result['error'] = str(e) or type(e).__name__
+        return result
+    
+    result['healthy'] = True
+    result['connect_ms'] = round((connected - started) * 1000, 2)
+    result['handshake_ms'] = round((finished - connected) * 1000, 2)
+    result['rtt_ms'] = round((finished - started) * 1000, 2)
+    return result
+
+
+class ProbeCache:
+    """Probe results persisted to a JSON file and reused for ttl seconds"""
+    
+    def __init__(self, path=PROBE_CACHE_FILE, ttl=PROBE_CACHE_TTL, failure_ttl=PROBE_FAILURE_TTL):
+        """
+        Initialize cache
+        
+        Args:
+            path: JSON file holding the results, None keeps them in memory only
+            ttl: Seconds a healthy result stays valid
+            failure_ttl: Seconds a failed probe stays valid
+        """
+        self.path = path
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.entries = {}
+        self.load()
+    
+    def load(self):
+        """Read the cache file; a missing or broken file is an empty cache"""
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+    
+    def save(self):
+        """Write the cache file"""
+        if not self.path:
+            return
+        try:
+            with open(self.path, 'w') as f:
+                json.dump(self.entries, f, indent=2)
+        except OSError as e:
+            print(f"[MANAGER] Could not save probe cache: {e}")
+    
+    def get(self, server_id, host, port):
+        """Return the cached result for a server, or None if missing or stale"""
+        entry = self.entries.get(server_id)
+        if entry is None or entry.get('host') != host or entry.get('port') != port:
+            return None
+        ttl = self.ttl if entry.get('healthy') else self.failure_ttl
+        if time.time() - entry.get('probed_at', 0) > ttl:
+            return None
+        return entry
+    
+    def put(self, server_id, host, port, result):
+        """Store a fresh result"""
+        self.entries[server_id] = dict(result, host=host, port=port, probed_at=time.time())
+
+
+def probe_servers(targets, timeout=PROBE_TIMEOUT, cache=None, refresh=False,
+                  max_workers=PROBE_WORKERS) -> dict:
+    """
+    Probe servers concurrently, reusing cached results
+    
+    Args:
+        targets: {server_id: (host, port)}
+        timeout: Per-server deadline in seconds
+        cache: ProbeCache to read and update (optional)
+        refresh: Ignore cached results
+    
+    Returns:
+        {server_id: result} as returned by probe_server(), plus a cached flag
+    """
+    results = {}
+    pending = {}
+    for server_id, (host, port) in targets.items():
+        entry = None if cache is None or refresh else cache.get(server_id, host, port)
+        if entry is not None:
+            results[server_id] = dict(entry, cached=True)
+        else:
+            pending[server_id] = (host, port)
+    
+    if pending:
+        # All probes run at once so the total time is that of the slowest
+        # server, not the sum of all of them
+        with ThreadPoolExecutor(min(max_workers, len(pending))) as executor:
+            futures = {server_id: executor.submit(probe_server, host, port, timeout)
+                       for server_id, (host, port) in pending.items()}
+        for server_id, future in futures.items():
+            host, port = pending[server_id]
+            result = future.result()
+            if cache is not None:
+                cache.put(server_id, host, port, result)
+            results[server_id] = dict(result, cached=False)
+        if cache is not None:
+            cache.save()
+    
+    return results
+
+
+def rank_servers(results) -> list:
+    """Return the ids of healthy servers, fastest first"""
+    healthy = [server_id for server_id, result in results.items() if result.get('healthy')]
+    return sorted(healthy, key=lambda server_id: results[server_id]['rtt_ms'])
@@ -0,0 +1,165 @@
+"""
+Server Supervisor - Runs several VPN server worker processes on one port
+"""
+import multiprocessing
+import queue
+import threading
+import time
+
+
+# Seconds between stats reports from each worker
+STATS_INTERVAL = 5
+
+# Seconds between aggregated stats lines printed by the supervisor
+REPORT_INTERVAL = 60
+
+# Restart delay grows from MIN to MAX while a worker keeps crashing
+MIN_RESTART_DELAY = 1
+MAX_RESTART_DELAY = 30
+
+
+def worker_main(index, engine, server_kwargs, stats_queue):
+    """Entry point of one worker process"""
+    from vpn_server import create_server
+    
+    if server_kwargs.get('metrics_port'):
+        # Each worker has its own registry, so each gets its own port
+        server_kwargs = dict(server_kwargs, metrics_port=server_kwargs['metrics_port'] + index)
+    server = create_server(engine, reuse_port=True, **server_kwargs)
+    
+    def report_stats():
+        while True:
+            time.sleep(STATS_INTERVAL)
+            try:
+                stats_queue.put_nowait((index, server.get_stats()))
+            except queue.Full:
+                pass
+    
+    threading.Thread(target=report_stats, daemon=True).start()
+    
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+class WorkerSupervisor:
+    """Starts, restarts and aggregates stats of SO_REUSEPORT worker processes"""
+    
+    def __init__(self, engine, server_kwargs, workers):
+        """
+        Initialize supervisor
+        
+        Args:
+            engine: Server engine for every worker ('threads' or 'asyncio')
+            server_kwargs: Keyword arguments for the VPNServer constructor
+            workers: Number of worker processes
+        """
+        self.engine = engine
+        self.server_kwargs = server_kwargs
+        self.workers = workers
+        self.processes = {}
+        self.restart_delays = {}
+        self.restart_at = {}
+        self.started_at = {}
+        self.restarts = 0
+        self.worker_stats = {}
+        self.stats_queue = multiprocessing.Queue(maxsize=workers * 16)
+        self.running = False
+    
+    def run(self):
+        """Start all workers and supervise them until interrupted"""
+        self.running = True
+        print(f"[SUPERVISOR] Starting {self.workers} {self.engine} workers on "
+              f"{self.server_kwargs.get('host')}:{self.server_kwargs.get('port')}")
+        
+        for index in range(self.workers):
+            self.spawn(index)
+        
+        last_report = time.monotonic()
+        try:
+            while self.running:
+                self.collect_stats(timeout=1)
+                self.check_workers()
+                if time.monotonic() - last_report >= REPORT_INTERVAL:
+                    self.report()
+                    last_report = time.monotonic()
+        except KeyboardInterrupt:
+            print("\n[SUPERVISOR] Shutting down...")
+        finally:
+            self.stop()
+    
+    def spawn(self, index):
+        """Start (or restart) worker number index"""
+        process = multiprocessing.Process(
+            target=worker_main,
+            args=(index, self.engine, self.server_kwargs, self.stats_queue),
+            name=f"vpn-worker-{index}",
+            daemon=True
+        )
+        process.start()
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        print(f"[SUPERVISOR] Worker {index} started (pid {process.pid})")
+    
+    def check_workers(self):
+        """Restart workers that exited, backing off if they keep crashing"""
+        now = time.monotonic()
+        for index, process in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            
+            if index not in self.restart_at:
+                delay = self.restart_delays.get(index, MIN_RESTART_DELAY)
+                print(f"[SUPERVISOR] Worker {index} exited with code {process.exitcode}, "
+                      f"restarting in {delay}s")
+                self.restart_at[index] = now + delay
+                self.restart_delays[index] = min(delay * 2, MAX_RESTART_DELAY)
+                # The dead worker's counters are no longer live
+                self.worker_stats.pop(index, None)
+            elif now >= self.restart_at[index]:
+                del self.restart_at[index]
+                self.restarts += 1
+                self.spawn(index)
+        
+        # A worker that stayed up for a full report interval earns a fresh backoff
+        for index, started in self.started_at.items():
+            if index not in self.restart_at and now - started > REPORT_INTERVAL:
+                self.restart_delays.pop(index, None)
+    
+    def collect_stats(self, timeout):
+        """Drain stats reports sent by the workers"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            try:
+                index, stats = self.stats_queue.get(timeout=remaining)
+            except queue.Empty:
+                return
+            self.worker_stats[index] = stats
+    
+    def get_stats(self) -> dict:
+        """Return stats summed over all live workers"""
+        totals = {}
+        for stats in self.worker_stats.values():
+            for name, value in stats.items():
+                totals[name] = totals.get(name, 0) + value
+        totals['workers_alive'] = sum(1 for p in self.processes.values() if p.is_alive())
+        totals['worker_restarts'] = self.restarts
+        return totals
+    
+    def report(self):
+        """Print the aggregated stats"""
+        print(f"[SUPERVISOR] Stats: {self.get_stats()}")
+    
+    def stop(self):
+        """Terminate all workers"""
+        self.running = False
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join(timeout=5)
+        print("[SUPERVISOR] All workers stopped")
@@ -0,0 +1,303 @@
+"""
+Socket Tuning - Named TCP option profiles for tunnel connections
+"""
+import functools
+import socket
+import sys
+import threading
+from vpn_logging import get_logger
+
+
+log = get_logger('tuning')
+
+# Linux reports twice the buffer size it granted, the rest is for its own
+# bookkeeping (see socket(7))
+BUFFER_READBACK_FACTOR = 2 if sys.platform.startswith('linux') else 1
+
+# Settings read_settings() reports, in log order
+SETTINGS = ('nodelay', 'sndbuf', 'rcvbuf', 'notsent_lowat', 'congestion')
+
+# Linux limits of each buffer: the size autotuning grows it to (third field
+# of tcp_wmem/tcp_rmem) and the most SO_SNDBUF/SO_RCVBUF may set
+BUFFER_SYSCTLS = {
+    'sndbuf': ('/proc/sys/net/ipv4/tcp_wmem', 'net.core.wmem_max', '/proc/sys/net/core/wmem_max'),
+    'rcvbuf': ('/proc/sys/net/ipv4/tcp_rmem', 'net.core.rmem_max', '/proc/sys/net/core/rmem_max'),
+}
+
+MiB = 1024 * 1024
+
+
+class SocketProfile:
+    """TCP options for one kind of link; None leaves the kernel default"""
+    
+    def __init__(self, name, nodelay=None, sndbuf=None, rcvbuf=None, notsent_lowat=None,
+                 congestion=None):
+        """
+        Initialize profile
+        
+        Args:
+            name: Name used on the command line, in servers.json and in logs
+            nodelay: Send small writes at once instead of coalescing them
+                     (TCP_NODELAY, disables Nagle's algorithm)
+            sndbuf: Send buffer bytes (SO_SNDBUF)
+            rcvbuf: Receive buffer bytes (SO_RCVBUF)
+            notsent_lowat: Unsent bytes the kernel queues before the socket
+                           stops being writable (TCP_NOTSENT_LOWAT), so
+                           relayed data waits in the tunnel, not behind a
+                           deep send buffer
+            congestion: Congestion control algorithm (TCP_CONGESTION), e.g. 'bbr'
+        
+        A fixed buffer size turns off the kernel's buffer autotuning for the
+        socket, so it is only set where it exceeds what autotuning would
+        reach, see fixed_buffer_size().
+        
+        TCP Fast Open is deliberately not offered: the server speaks first
+        (the key message), so a client connect() with a cached cookie would
+        send no SYN until the client's first write and the handshake would
+        never finish.
+        """
+        self.name = name
+        self.nodelay = nodelay
+        self.sndbuf = sndbuf
+        self.rcvbuf = rcvbuf
+        self.notsent_lowat = notsent_lowat
+        self.congestion = congestion
+    
+    def is_default(self) -> bool:
+        """Whether the profile changes nothing"""
+        return (self.nodelay is None and not self.sndbuf and not self.rcvbuf
+                and not self.notsent_lowat and not self.congestion)
+
+
+PROFILES = {
+    # Kernel defaults
+    'default': SocketProfile('default'),
+    # Keystrokes, requests and small responses go out at once
+    'interactive': SocketProfile('interactive', nodelay=True, notsent_lowat=16 * 1024),
+    # Downloads and uploads over fast, nearby links
+    'bulk': SocketProfile('bulk', nodelay=True, sndbuf=4 * MiB, rcvbuf=4 * MiB),
+    # Long international links: buffers for a large bandwidth-delay
+    # product and a congestion control that tolerates random loss
+    'high-latency': SocketProfile('high-latency', nodelay=True, sndbuf=16 * MiB, rcvbuf=16 * MiB,
+                                  notsent_lowat=128 * 1024, congestion='bbr'),
+}
+SOCKET_PROFILES = tuple(PROFILES)
+
+
+class SocketTuner:
+    """Applies a profile to sockets and reports the settings that actually took effect"""
+    
+    def __init__(self, profile='default'):
+        """
+        Initialize tuner
+        
+        Args:
+            profile: Name of one of the PROFILES
+        
+        Raises:
+            ValueError: if the profile is unknown
+        """
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown socket profile {profile}")
+        self.profile = PROFILES[profile]
+        # role -> settings last logged, so a change is logged again
+        self.reported = {}
+        self.warned = set()
+        self.lock = threading.Lock()
+        self.counters = {
+            'sockets_tuned': 0,
+            'sockets_tuned_partially': 0,
+        }
+    
+    def tune_listener(self, sock) -> dict:
+        """
+        Tune a listening socket
+        
+        Accepted connections inherit its buffer sizes, which must be set
+        before the handshake to get a matching TCP window scale.
+        
+        Returns:
+            The settings in effect, see read_settings()
+        """
+        return self._apply(sock, 'listener')
+    
+    def tune(self, sock, role='connection') -> dict:
+        """
+        Tune an accepted connection, or an outgoing one before connect()
+        
+        Args:
+            role: Kind of connection for the report, e.g. 'client' or 'target'
+        
+        Returns:
+            The settings in effect, see read_settings()
+        """
+        return self._apply(sock, role)
+    
+    def get_stats(self) -> dict:
+        """Return tuning counters"""
+        with self.lock:
+            return dict(self.counters)
+    
+    def _apply(self, sock, role) -> dict:
+        """Set the profile's options on sock, then read back and report them"""
+        profile = self.profile
+        if profile.is_default():
+            return {}
+        
+        failed = {}
+        
+        def set_option(name, level, option, value):
+            if option is None:
+                failed[name] = "not supported on this platform"
+                return
+            try:
+                sock.setsockopt(level, option, value)
+            except OSError as e:
+                failed[name] = e.strerror or str(e)
+        
+        if profile.nodelay is not None:
+            set_option('nodelay', socket.IPPROTO_TCP, socket.TCP_NODELAY, int(profile.nodelay))
+        # name -> size to set, None where autotuning grows the buffer as far
+        buffers = {name: fixed_buffer_size(name, getattr(profile, name))
+                   for name in ('sndbuf', 'rcvbuf') if getattr(profile, name)}
+        if buffers.get('sndbuf'):
+            set_option('sndbuf', socket.SOL_SOCKET, socket.SO_SNDBUF, buffers['sndbuf'])
+        if buffers.get('rcvbuf'):
+            set_option('rcvbuf', socket.SOL_SOCKET, socket.SO_RCVBUF, buffers['rcvbuf'])
+        if profile.notsent_lowat:
+            set_option('notsent_lowat', socket.IPPROTO_TCP,
+                       getattr(socket, 'TCP_NOTSENT_LOWAT', None), profile.notsent_lowat)
+        if profile.congestion:
+            set_option('congestion', socket.IPPROTO_TCP, getattr(socket, 'TCP_CONGESTION', None),
+                       profile.congestion.encode())
+        
+        # Report only what the profile asked for, buffers left to autotuning as 'auto'
+        requested = {
+            'nodelay': profile.nodelay is not None,
+            'sndbuf': buffers.get('sndbuf'),
+            'rcvbuf': buffers.get('rcvbuf'),
+            'notsent_lowat': profile.notsent_lowat,
+            'congestion': profile.congestion,
+        }
+        settings = read_settings(sock, [name for name in SETTINGS if requested[name]])
+        for name, size in buffers.items():
+            if size is None:
+                settings[name] = 'auto'
+            elif name not in failed and settings.get(name, size) < size:
+                failed[name] = f"capped at {settings[name]} bytes by {BUFFER_SYSCTLS[name][1]}"
+        settings = {name: settings[name] for name in SETTINGS if name in settings}
+        self._report(role, settings, failed)
+        return settings
+    
+    def _report(self, role, settings, failed):
+        """Count a tuned socket and log settings and failures the first time they are seen"""
+        with self.lock:
+            self.counters['sockets_tuned'] += 1
+            if failed:
+                self.counters['sockets_tuned_partially'] += 1
+            changed = self.reported.get(role) != settings
+            if changed:
+                self.reported[role] = settings
+            new_failures = [(name, reason) for name, reason in failed.items()
+                            if name not in self.warned]
+            self.warned.update(failed)
+        
+        if changed:
+            log.info("Profile %s on %s sockets: %s", self.profile.name, role,
+                     format_settings(settings))
+        else:
+            log.debug("Profile %s on %s socket: %s", self.profile.name, role,
+                      format_settings(settings))
+        for name, reason in new_failures:
+            log.warning("Socket option %s of profile %s not applied: %s",
+                        name, self.profile.name, reason)
+
+
+def read_settings(sock, options=SETTINGS) -> dict:
+    """
+    Read TCP options back from the kernel
+    
+    Args:
+        sock: The socket
+        options: Names from SETTINGS to read
+    
+    Returns:
+        e.g. {'nodelay': True, 'sndbuf': 4194304, 'congestion': 'bbr'}, with
+        buffer sizes as granted; options the platform does not have are
+        left out
+    """
+    settings = {}
+    for name in options:
+        try:
+            if name == 'nodelay':
+                settings[name] = bool(sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY))
+            elif name == 'sndbuf':
+                settings[name] = (sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+                                  // BUFFER_READBACK_FACTOR)
+            elif name == 'rcvbuf':
+                settings[name] = (sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+                                  // BUFFER_READBACK_FACTOR)
+            elif name == 'notsent_lowat' and hasattr(socket, 'TCP_NOTSENT_LOWAT'):
+                settings[name] = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT)
+            elif name == 'congestion' and hasattr(socket, 'TCP_CONGESTION'):
+                value = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_CONGESTION, 16)
+                settings[name] = value.split(b'\x00', 1)[0].decode()
+        except OSError:
+            continue
+    return settings
+
+
+def fixed_buffer_size(name, size):
+    """
+    Decide whether a profile's buffer size is worth turning autotuning off for
+    
+    Args:
+        name: 'sndbuf' or 'rcvbuf'
+        size: Bytes the profile asks for
+    
+    Returns:
+        size, or None to leave the buffer to autotuning because it grows
+        at least as far as size, capped by wmem_max/rmem_max, would
+    """
+    autotune_max, set_max = buffer_limits(name)
+    if autotune_max is None:
+        # Not Linux, or no way to tell
+        return size
+    if set_max is not None:
+        size = min(size, set_max)
+    return size if size > autotune_max else None
+
+
+@functools.lru_cache(maxsize=None)
+def buffer_limits(name) -> tuple:
+    """
+    Read (autotuning maximum, SO_SNDBUF/SO_RCVBUF maximum) of a buffer once
+    
+    Returns:
+        Byte counts, None for limits the system does not expose
+    """
+    autotune_path, _, max_path = BUFFER_SYSCTLS[name]
+    return _read_sysctl(autotune_path, -1), _read_sysctl(max_path, 0)
+
+
+def _read_sysctl(path, field):
+    """Return one whitespace-separated number of a /proc/sys file, None if unreadable"""
+    try:
+        with open(path, 'r') as f:
+            return int(f.read().split()[field])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def format_settings(settings) -> str:
+    """One-line form of read_settings() for logs, e.g. "nodelay=on sndbuf=8M congestion=bbr\""""
+    parts = []
+    for name, value in settings.items():
+        if isinstance(value, bool):
+            value = 'on' if value else 'off'
+        elif isinstance(value, int) and value >= MiB:
+            value = f"{value / MiB:g}M"
+        elif isinstance(value, int) and value >= 1024:
+            value = f"{value / 1024:g}K"
+        parts.append(f"{name}={value}")
+    return ' '.join(parts) or 'kernel defaults'
@@ -5,13 +5,48 @@ This creates a local SOCKS5 proxy that applications can use
 import socket
 import struct
 import threading
+from functools import partial
+from relay_buffers import AdaptiveBuffer, send_buffers, wait_readable
 from vpn_client import VPNClient
+from tunnel_mux import MuxSession, splice
+from tunnel_pool import TunnelPool
+from compression import DEFAULT_LEVEL, compression_summary
+from relay_core import RelayLoop
+from connect_status import STATUS_FAILURE, STATUS_SUCCEEDED, socks_reply, status_message
+from udp_relay import UDP_HELLO, UDP_IDLE_TIMEOUT, UDPClientAssociation
+from load_balancer import BALANCE_POLICIES, MAX_CONNECT_ATTEMPTS, Endpoint, LoadBalancer, parse_endpoints
+from metrics import count_error, export_stats, start_metrics_server
+from admission import (
+    DEFAULT_BACKLOG, DEFAULT_IDLE_TIMEOUT, DEFAULT_KEEPALIVE, DEFAULT_MAX_TUNNELS, OVERLOAD_POLICIES,
+    AdmissionControl, WorkerPool, create_reaper, half_close, reset_connection, set_keepalive,
+    shutdown_connection
+)
+from socket_tuning import SOCKET_PROFILES, SocketTuner
+from vpn_logging import add_logging_arguments, configure_from_args, get_log_stats, get_logger
+from profiling import add_profiling_arguments, profile_from_args
+
+
+log = get_logger('proxy')
+
+CONNECT_MODES = ('optimistic', 'early-data', 'confirmed')
+
+# early-data mode: how long to wait for the application's first bytes once
+# the server connection is up, and how many of them ride with the request
+EARLY_DATA_WAIT = 0.02
+MAX_EARLY_DATA = 64 * 1024
 
 
 class SOCKS5Proxy:
     """SOCKS5 proxy server that routes traffic through VPN"""
     
-    def __init__(self, vpn_server_host, vpn_server_port, local_port=1080, password=None):
+    def __init__(self, vpn_server_host, vpn_server_port, local_port=1080, password=None,
+                 multiplex=False, pool_min_idle=0, pool_max_size=16, relay='threads',
+                 compression=None, compression_level=DEFAULT_LEVEL, metrics_port=None,
+                 endpoints=None, balance='least_conn', udp_idle_timeout=UDP_IDLE_TIMEOUT,
+                 connect_mode='optimistic', backlog=DEFAULT_BACKLOG,
+                 max_tunnels=DEFAULT_MAX_TUNNELS, overload='queue',
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, keepalive=DEFAULT_KEEPALIVE,
+                 socket_profile='default'):
         """
         Initialize SOCKS5 Proxy
         
@@ -20,13 +55,89 @@ class SOCKS5Proxy:
             vpn_server_port: VPN server port
             local_port: Local SOCKS5 proxy port (default: 1080)
             password: VPN encryption password
+            multiplex: Carry all SOCKS connections as streams over one
+                       persistent server connection (default: False)
+            pool_min_idle: Pre-connected server connections to keep ready,
+                           0 disables the pool (default: 0)
+            pool_max_size: Maximum idle pooled connections (default: 16)
+            relay: 'threads' relays each connection in its own thread,
+                   'selectors' relays all of them in one non-blocking
+                   RelayLoop (default: 'threads')
+            compression: Compression to offer the server ('zlib'), or None
+            compression_level: Compression level to offer (default: 6)
+            metrics_port: Serve Prometheus metrics on 127.0.0.1:metrics_port
+                          (default: None, disabled)
+            endpoints: List of load_balancer.Endpoint to spread tunnels
+                       over instead of the single vpn_server_host/port
+            balance: Load balancing policy across endpoints, 'least_conn'
+                     or 'round_robin' (default: 'least_conn')
+            udp_idle_timeout: Seconds a UDP association may stay silent
+                              before it is closed (default: 120)
+            connect_mode: 'optimistic' reports success before the server
+                          has reached the target; 'confirmed' waits for the
+                          server's connect status and passes its SOCKS
+                          reply code on; 'early-data' replies at once and
+                          sends the application's first bytes together
+                          with the request (default: 'optimistic')
+            backlog: Listen backlog, also the number of connections that may
+                     wait for a slot with the 'queue' policy (default: 1024)
+            max_tunnels: SOCKS connections served at once; the threads
+                         engine uses at most this many handler threads
+                         (default: 1024)
+            overload: Policy for connections beyond max_tunnels: 'queue',
+                      'reject' or 'shed-idle' (default: 'queue')
+            idle_timeout: Seconds a tunnel may move no data before it is
+                          closed, 0 keeps idle tunnels forever (default: 900)
+            keepalive: Seconds of silence before TCP keepalive probes a
+                       client or server connection, 0 disables (default: 60)
+            socket_profile: socket_tuning profile for the connections to
+                            the VPN server, e.g. 'high-latency' (default:
+                            'default', kernel settings)
         """
         self.vpn_server_host = vpn_server_host
         self.vpn_server_port = vpn_server_port
         self.local_port = local_port
         self.password = password
+        self.multiplex = multiplex
+        self.mux_session = None
+        self.mux_endpoint = None
+        self.mux_lock = threading.Lock()
+        self.relay = relay
+        self.relay_loop = None
+        self.compression = compression
+        self.compression_level = compression_level
+        self.udp_idle_timeout = udp_idle_timeout
+        self.connect_mode = connect_mode
+        self.backlog = backlog
+        self.admission = AdmissionControl(max_tunnels, overload, queue_size=backlog)
+        self.workers = WorkerPool(max_tunnels)
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.reaper = None
+        self.tuner = SocketTuner(socket_profile)
+        self.balancer = LoadBalancer(endpoints or [Endpoint(vpn_server_host, vpn_server_port)],
+                                     balance)
+        # One pool per endpoint, so a warm connection always matches the
+        # endpoint the balancer picked
+        self.pools = {}
+        if pool_min_idle > 0 and not multiplex:
+            for endpoint in self.balancer.endpoints:
+                self.pools[endpoint] = TunnelPool(
+                    endpoint.host, endpoint.port, password,
+                    min_idle=pool_min_idle, max_size=pool_max_size,
+                    compression=compression, compression_level=compression_level,
+                    tuner=self.tuner)
+        self.metrics_port = metrics_port
+        self.stats = {
+            'connections_total': 0,
+            'connections_active': 0,
+            'server_connect_failures': 0,
+            'server_failovers': 0,
+            'target_failures': 0,
+        }
+        self.stats_lock = threading.Lock()
         self.running = False
-        
+    
     def start(self):
         """Start the SOCKS5 proxy server"""
         self.proxy_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -34,38 +145,73 @@ class SOCKS5Proxy:
         
         try:
             self.proxy_socket.bind(('127.0.0.1', self.local_port))
-            self.proxy_socket.listen(10)
+            self.proxy_socket.listen(self.backlog)
             self.running = True
+            self.start_metrics()
+            self.start_reaper()
+            for pool in self.pools.values():
+                pool.start()
+            if self.relay == 'selectors' and not self.multiplex:
+                self.relay_loop = RelayLoop()
+                self.relay_loop.start()
             
-            print(f"[PROXY] SOCKS5 proxy listening on 127.0.0.1:{self.local_port}")
-            print(f"[PROXY] Configure your applications to use this proxy")
-            print(f"[PROXY] Server: 127.0.0.1, Port: {self.local_port}")
-            print(f"[PROXY] Routing all traffic through VPN server: {self.vpn_server_host}:{self.vpn_server_port}")
+            log.info("SOCKS5 proxy listening on 127.0.0.1:%s", self.local_port)
+            log.info("Configure your applications to use this proxy")
+            log.info("Server: 127.0.0.1, Port: %s", self.local_port)
+            log.info("Routing all traffic through VPN server: %s", self.describe_servers())
             
             while self.running:
                 try:
                     client_socket, client_address = self.proxy_socket.accept()
-                    print(f"[PROXY] New client connection from {client_address}")
+                    log.info("New client connection from %s", client_address)
+                    set_keepalive(client_socket, self.keepalive)
                     
-                    # Handle client in separate thread
-                    client_thread = threading.Thread(
-                        target=self.handle_client,
-                        args=(client_socket,),
-                        daemon=True
+                    # Handle client on a worker thread once it has a slot
+                    self.admission.admit(
+                        partial(self.workers.submit, self.handle_client, client_socket),
+                        partial(self.reject_client, client_socket, client_address),
+                        partial(shutdown_connection, client_socket)
                     )
-                    client_thread.start()
-                    
+                
                 except OSError:
                     if self.running:
                         break
-                        
+        
         except Exception as e:
-            print(f"[PROXY] Error: {e}")
+            log.error("Error: %s", e)
         finally:
             self.stop()
     
-    def handle_client(self, client_socket):
+    def start_reaper(self):
+        """Start closing idle tunnels if an idle timeout is set"""
+        self.reaper = create_reaper(self.admission, self.idle_timeout)
+    
+    def reject_client(self, client_socket, client_address):
+        """Turn a connection away while the proxy is overloaded"""
+        log.warning("Overloaded, rejecting %s", client_address)
+        reset_connection(client_socket)
+    
+    def handle_client(self, client_socket, slot=None):
         """Handle SOCKS5 client connection"""
+        self.count('connections_total')
+        self.count('connections_active')
+        handed_off = False
+        try:
+            handed_off = self.serve_client(client_socket, slot)
+        finally:
+            if not handed_off:
+                self.count('connections_active', -1)
+                if slot is not None:
+                    self.admission.release(slot)
+    
+    def serve_client(self, client_socket, slot=None):
+        """
+        Run the SOCKS5 handshake and tunnel one client
+        
+        Returns:
+            True if the tunnel was handed to the relay loop, which then
+            owns the connection
+        """
         try:
             # SOCKS5 handshake
             # Read authentication methods
@@ -87,7 +233,7 @@ class SOCKS5Proxy:
                 return
             
             cmd = request[1]
-            if cmd != 1:  # Only support CONNECT
+            if cmd not in (1, 3):  # Only support CONNECT and UDP ASSOCIATE
                 client_socket.sendall(b'\x05\x07\x00\x01\x00\x00\x00\x00\x00\x00')
                 client_socket.close()
                 return
@@ -109,69 +255,323 @@ class SOCKS5Proxy:
             # Read port
             port = struct.unpack('>H', client_socket.recv(2))[0]
             
-            print(f"[PROXY] Client wants to connect to {addr}:{port}")
+            if cmd == 3:
+                if slot is not None:
+                    slot.sheddable = False
+                self.handle_udp_associate(client_socket)
+                return
             
-            # Create VPN client for this connection
-            vpn_client = VPNClient(self.vpn_server_host, self.vpn_server_port, self.password)
+            log.info("Client wants to connect to %s:%s", addr, port)
             
-            if not vpn_client.connect_to_server():
-                client_socket.sendall(b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00')
-                client_socket.close()
+            if self.multiplex:
+                if slot is not None:
+                    slot.sheddable = False
+                self.handle_mux_client(client_socket, addr, port)
                 return
             
-            # Send target info to VPN server
-            target_info = f"{addr}:{port}"
-            encrypted_info = vpn_client.crypto.encrypt(target_info.encode())
-            vpn_client.server_socket.sendall(encrypted_info)
-            
-            # Send success response
-            client_socket.sendall(b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00')
+            early_data = self.connect_mode == 'early-data'
+            if early_data:
+                # Let the application start sending while the server connection is set up
+                client_socket.sendall(socks_reply(STATUS_SUCCEEDED))
             
-            # Tunnel traffic
-            self.tunnel_traffic(client_socket, vpn_client.server_socket, vpn_client.crypto)
+            vpn_client, endpoint = self.connect_server(early=self.connect_mode != 'optimistic')
+            if vpn_client is None:
+                self.count('server_connect_failures')
+                if early_data:
+                    reset_connection(client_socket)
+                    return
+                client_socket.sendall(b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00')
+                client_socket.close()
+                return
             
+            relayed = False
+            try:
+                if not self.start_tunnel(client_socket, vpn_client, addr, port):
+                    vpn_client.server_socket.close()
+                    client_socket.close()
+                    return
+                
+                # Tunnel traffic
+                encoder, decoder = vpn_client.encoder, vpn_client.decoder
+                if slot is not None:
+                    # A half-closed tunnel only ends once the server side ends too
+                    slot.add_closer(partial(shutdown_connection, vpn_client.server_socket))
+                if self.relay_loop is not None:
+                    def on_close():
+                        self.report_compression(addr, port, encoder, decoder)
+                        self.balancer.release(endpoint)
+                        self.count('connections_active', -1)
+                        if slot is not None:
+                            self.admission.release(slot)
+                    
+                    self.relay_loop.add_tunnel(vpn_client.server_socket, client_socket,
+                                               encoder, decoder, on_close=on_close, slot=slot)
+                    relayed = True
+                    return True
+                
+                self.tunnel_traffic(client_socket, vpn_client.server_socket, encoder, decoder, slot)
+                self.report_compression(addr, port, encoder, decoder)
+            finally:
+                if not relayed:
+                    self.balancer.release(endpoint)
+        
         except Exception as e:
-            print(f"[PROXY] Error handling client: {e}")
+            log.warning("Error handling client: %s", e)
+            count_error('client')
             try:
                 client_socket.close()
             except:
                 pass
+        return False
+    
+    def start_metrics(self):
+        """Start the metrics endpoint if one was configured"""
+        if self.metrics_port:
+            start_metrics_server(self.metrics_port)
+            export_stats(self.get_stats, 'vpn_proxy',
+                         gauges=('connections_active', 'pool_idle', 'endpoints_ejected',
+                                 'admission_active', 'admission_queued', 'workers', 'workers_busy'))
+    
+    def count(self, name, delta=1):
+        """Adjust one of the proxy's stats counters"""
+        with self.stats_lock:
+            self.stats[name] += delta
+    
+    def get_stats(self) -> dict:
+        """Return a snapshot of the proxy's stats counters"""
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats.update(self.admission.get_stats())
+        stats.update(self.workers.get_stats())
+        stats.update(get_log_stats())
+        stats.update(self.tuner.get_stats())
+        stats['endpoints_ejected'] = sum(
+            1 for endpoint in self.balancer.stats().values() if endpoint['ejected'])
+        for pool in self.pools.values():
+            for name, value in pool.stats().items():
+                stats[f"pool_{name}"] = stats.get(f"pool_{name}", 0) + value
+        return stats
     
-    def tunnel_traffic(self, client_socket, server_socket, crypto):
-        """Tunnel traffic between client and VPN server"""
+    def describe_servers(self) -> str:
+        """Return the VPN server endpoints for log messages"""
+        return ', '.join(repr(endpoint) for endpoint in self.balancer.endpoints)
+    
+    def new_vpn_client(self, endpoint=None):
+        """Create an unconnected VPNClient for an endpoint (default: the configured server)"""
+        if endpoint is None:
+            endpoint = self.balancer.endpoints[0]
+        return VPNClient(endpoint.host, endpoint.port, self.password,
+                         self.compression, self.compression_level, self.tuner)
+    
+    def connect_server(self, early=False):
+        """
+        Connect to the endpoint picked by the load balancer, failing over to
+        other endpoints while they cannot be reached
+        
+        Args:
+            early: Connect for a status request sent without waiting for
+                   the server's key, see VPNClient.connect_to_server()
+        
+        Returns:
+            (vpn_client, endpoint), or (None, None) if every attempt failed;
+            the endpoint must be released once the tunnel ends
+        """
+        tried = []
+        attempts = min(MAX_CONNECT_ATTEMPTS, len(self.balancer.endpoints))
+        while len(tried) < attempts:
+            endpoint = self.balancer.choose(exclude=tried)
+            if endpoint is None:
+                break
+            if tried:
+                self.count('server_failovers')
+            tried.append(endpoint)
+            
+            # Take a warm connection from the pool, or create one for this connection
+            if self.pools:
+                vpn_client = self.pools[endpoint].acquire()
+            else:
+                vpn_client = self.new_vpn_client(endpoint)
+                if not vpn_client.connect_to_server(early):
+                    vpn_client = None
+            
+            if vpn_client is not None:
+                self.balancer.report_success(endpoint)
+                set_keepalive(vpn_client.server_socket, self.keepalive)
+                return vpn_client, endpoint
+            self.balancer.report_failure(endpoint)
+            self.balancer.release(endpoint)
+        return None, None
+    
+    def start_tunnel(self, client_socket, vpn_client, addr, port):
+        """
+        Send the target request and answer the SOCKS client per connect_mode
+        
+        Returns:
+            True if the tunnel is ready for relaying
+        """
+        if self.connect_mode == 'optimistic':
+            # Report success at once; a failed target shows up as a closed connection
+            vpn_client.request_target(addr, port)
+            client_socket.sendall(socks_reply(STATUS_SUCCEEDED))
+            return True
+        
+        early_data = b''
+        if self.connect_mode == 'early-data':
+            # The success reply already went out, so whatever the application
+            # sent since then travels in the same flight as the request
+            if wait_readable([client_socket], EARLY_DATA_WAIT):
+                early_data = client_socket.recv(MAX_EARLY_DATA)
+        
+        vpn_client.request_target(addr, port, early_data, status=True)
+        try:
+            code, payloads = vpn_client.read_status()
+        except Exception as e:
+            log.warning("No connect status from VPN server: %s", e)
+            code, payloads = STATUS_FAILURE, []
+        if code != STATUS_SUCCEEDED:
+            log.warning("VPN server could not connect to %s:%s: %s", addr, port, status_message(code))
+            self.count('target_failures')
+            if self.connect_mode == 'confirmed':
+                client_socket.sendall(socks_reply(code))
+            else:
+                reset_connection(client_socket)
+            return False
+        
+        if self.connect_mode == 'confirmed':
+            client_socket.sendall(socks_reply(STATUS_SUCCEEDED))
+        send_buffers(client_socket, payloads)
+        return True
+    
+    def report_compression(self, addr, port, encoder, decoder):
+        """Print the compression ratios of a finished tunnel"""
+        summary = compression_summary(encoder, decoder)
+        if summary is not None:
+            log.info("Compression for %s:%s: %s", addr, port, summary)
+    
+    def get_mux_session(self):
+        """Return the shared mux session, reconnecting if it was lost"""
+        with self.mux_lock:
+            if self.mux_session is None or self.mux_session.closed:
+                self.mux_session = None
+                if self.mux_endpoint is not None:
+                    self.balancer.release(self.mux_endpoint)
+                    self.mux_endpoint = None
+                vpn_client, endpoint = self.connect_server()
+                if vpn_client is None:
+                    return None
+                self.mux_session = MuxSession.connect(vpn_client)
+                self.mux_endpoint = endpoint
+                log.info("Multiplexed session established with %s", endpoint)
+            return self.mux_session
+    
+    def handle_mux_client(self, client_socket, addr, port):
+        """Carry one SOCKS connection as a stream of the shared mux session"""
+        session = self.get_mux_session()
+        try:
+            if session is None:
+                raise ConnectionError("VPN server unreachable")
+            stream = session.open_stream(addr, port)
+        except Exception as e:
+            log.warning("Failed to open stream: %s", e)
+            count_error('stream_open')
+            client_socket.sendall(b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00')
+            client_socket.close()
+            return
+        
+        client_socket.sendall(b'\x05\x00\x00\x01\x00\x00\x00\x00\x00\x00')
+        splice(stream, client_socket)
+    
+    def handle_udp_associate(self, client_socket):
+        """Relay one SOCKS5 UDP association through its own VPN server connection"""
+        # Datagrams get a dedicated connection even when multiplexing, so
+        # they never queue behind stream data
+        vpn_client, endpoint = self.connect_server()
+        if vpn_client is None:
+            self.count('server_connect_failures')
+            client_socket.sendall(b'\x05\x01\x00\x01\x00\x00\x00\x00\x00\x00')
+            client_socket.close()
+            return
+        
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            udp_socket.bind(('127.0.0.1', 0))
+            udp_port = udp_socket.getsockname()[1]
+            vpn_client.send_request(UDP_HELLO)
+            
+            # Tell the client where to send its datagrams
+            client_socket.sendall(b'\x05\x00\x00\x01' + socket.inet_aton('127.0.0.1') +
+                                  struct.pack('>H', udp_port))
+            log.info("UDP association relaying on 127.0.0.1:%s", udp_port)
+            
+            association = UDPClientAssociation(client_socket, udp_socket, vpn_client.server_socket,
+                                               vpn_client.encoder, vpn_client.decoder,
+                                               self.udp_idle_timeout)
+            association.run()
+            self.report_compression('UDP', udp_port, vpn_client.encoder, vpn_client.decoder)
+        finally:
+            udp_socket.close()
+            vpn_client.server_socket.close()
+            client_socket.close()
+            self.balancer.release(endpoint)
+    
+    def tunnel_traffic(self, client_socket, server_socket, encoder, decoder, slot=None):
+        """
+        Tunnel traffic between client and VPN server
+        
+        When one side stops sending, the other is half-closed and the
+        tunnel keeps relaying the opposite direction until it ends too.
+        
+        Args:
+            client_socket: Socket to the local SOCKS client (plain data)
+            server_socket: Socket to the VPN server (carries records)
+            encoder: Record encoder for the proxy -> server direction
+            decoder: Record decoder for the server -> proxy direction
+            slot: The connection's admission.Slot, touched on traffic (optional)
+        """
         sockets = [client_socket, server_socket]
+        client_buffer = AdaptiveBuffer()
         
         try:
-            while True:
-                readable, _, exceptional = select.select(sockets, [], sockets, 1)
-                
-                if exceptional:
-                    break
-                
-                for sock in readable:
+            while sockets:
+                if slot is not None and slot.closed:
+                    return
+                for sock in wait_readable(sockets, 1):
                     try:
-                        data = sock.recv(4096)
-                        if not data:
-                            return
-                        
                         if sock is client_socket:
                             # Data from client -> encrypt -> send to VPN server
-                            encrypted = crypto.encrypt(data)
-                            server_socket.sendall(encrypted)
+                            data = client_buffer.recv_into(client_socket)
+                            if not data:
+                                # The application is done sending; the
+                                # target may still answer
+                                half_close(server_socket)
+                                sockets.remove(client_socket)
+                                continue
+                            send_buffers(server_socket, encoder.encode_parts(data))
                         else:
                             # Data from VPN server -> decrypt -> send to client
                             try:
-                                decrypted = crypto.decrypt(data)
-                                client_socket.sendall(decrypted)
+                                payloads = decoder.recv_from(server_socket)
+                            except socket.error:
+                                return
                             except Exception as e:
-                                print(f"[PROXY] Decryption error: {e}")
+                                log.warning("Decryption error: %s", e)
+                                count_error('decrypt')
                                 return
-                                
+                            if payloads is None:
+                                half_close(client_socket)
+                                sockets.remove(server_socket)
+                                continue
+                            send_buffers(client_socket, payloads)
+                        
+                        if slot is not None:
+                            slot.touch()
+                    
                     except socket.error:
                         return
-                        
+        
         except Exception as e:
-            print(f"[PROXY] Tunneling error: {e}")
+            log.warning("Tunneling error: %s", e)
+            count_error('tunnel')
         finally:
             client_socket.close()
             server_socket.close()
@@ -181,32 +581,110 @@ class SOCKS5Proxy:
         self.running = False
         if hasattr(self, 'proxy_socket'):
             self.proxy_socket.close()
-        print("[PROXY] Proxy stopped")
+        if self.mux_session is not None:
+            self.mux_session.close()
+        if self.relay_loop is not None:
+            self.relay_loop.stop()
+        if self.reaper is not None:
+            self.reaper.stop()
+        for endpoint, pool in self.pools.items():
+            pool.stop()
+            log.info("Pool stats for %s: %s", endpoint, pool.stats())
+        log.info("Proxy stopped")
 
 
 def main():
     """Main function to run SOCKS5 proxy"""
     import argparse
-    import select
     
     parser = argparse.ArgumentParser(description='SOCKS5 Proxy through VPN')
-    parser.add_argument('--server', required=True, help='VPN server address (host:port)')
+    parser.add_argument('--server', required=True,
+                        help='VPN server address (host:port, [IPv6]:port), or several as '
+                             'host:port[:weight],...')
+    parser.add_argument('--balance', choices=BALANCE_POLICIES, default='least_conn',
+                        help='How tunnels are spread over several servers (default: least_conn)')
     parser.add_argument('--port', type=int, default=1080, help='Local proxy port (default: 1080)')
     parser.add_argument('--password', help='VPN encryption password')
+    parser.add_argument('--mux', action='store_true',
+                        help='Multiplex all connections over one VPN server connection')
+    parser.add_argument('--pool-min-idle', type=int, default=0,
+                        help='Pre-connected VPN server connections to keep ready (default: 0, disabled)')
+    parser.add_argument('--pool-max-size', type=int, default=16,
+                        help='Maximum idle pooled connections (default: 16)')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='Connection handling engine (default: threads)')
+    parser.add_argument('--relay', choices=['threads', 'selectors'], default='threads',
+                        help='Threads engine only: relay each connection in its own thread, or all '
+                             'connections in one non-blocking selectors loop (default: threads)')
+    parser.add_argument('--compression', choices=['none', 'zlib'], default='none',
+                        help='Compress tunnel traffic before encryption (default: none)')
+    parser.add_argument('--compression-level', type=int, choices=range(1, 10), default=DEFAULT_LEVEL,
+                        metavar='1-9', help=f'Compression level (default: {DEFAULT_LEVEL})')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve Prometheus metrics on 127.0.0.1:PORT')
+    parser.add_argument('--connect-mode', choices=CONNECT_MODES, default='optimistic',
+                        help='optimistic: report success before the target is reached; '
+                             'confirmed: wait for the server and pass real errors on; '
+                             'early-data: send the first application bytes with the '
+                             'request (default: optimistic)')
+    parser.add_argument('--udp-idle-timeout', type=float, default=UDP_IDLE_TIMEOUT,
+                        help=f'Seconds before a silent UDP association is closed (default: {UDP_IDLE_TIMEOUT})')
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG,
+                        help=f'Listen backlog and overload queue length (default: {DEFAULT_BACKLOG})')
+    parser.add_argument('--max-tunnels', type=int, default=DEFAULT_MAX_TUNNELS,
+                        help='SOCKS connections served at once, and handler threads at most '
+                             f'(default: {DEFAULT_MAX_TUNNELS})')
+    parser.add_argument('--overload', choices=OVERLOAD_POLICIES, default='queue',
+                        help='Connections beyond --max-tunnels wait for a slot (queue), are reset '
+                             'at once (reject), or replace the longest idle tunnel (shed-idle) '
+                             '(default: queue)')
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help='Close tunnels that moved no data for this many seconds, 0 never '
+                             f'(default: {DEFAULT_IDLE_TIMEOUT:g})')
+    parser.add_argument('--keepalive', type=int, default=DEFAULT_KEEPALIVE,
+                        help='Seconds of silence before TCP keepalive probes local and server '
+                             f'connections, 0 disables (default: {DEFAULT_KEEPALIVE})')
+    parser.add_argument('--socket-profile', choices=SOCKET_PROFILES, default='default',
+                        help='TCP tuning of VPN server connections: interactive, bulk or '
+                             'high-latency (default: kernel settings)')
+    add_logging_arguments(parser)
+    add_profiling_arguments(parser)
     
     args = parser.parse_args()
+    configure_from_args(parser, args)
+    profile_from_args(parser, args, 'proxy')
+    
+    if args.engine == 'asyncio' and (args.mux or args.pool_min_idle or args.relay != 'threads'):
+        parser.error('--mux, --pool-min-idle and --relay are only supported by the threads engine')
+    
+    # Parse server address(es)
+    try:
+        endpoints = parse_endpoints(args.server)
+    except ValueError as e:
+        parser.error(f'--server: {e}')
+    server_host, server_port = endpoints[0].host, endpoints[0].port
     
-    # Parse server address
-    server_parts = args.server.split(':')
-    server_host = server_parts[0]
-    server_port = int(server_parts[1]) if len(server_parts) > 1 else 8888
+    if args.engine == 'asyncio':
+        from async_proxy import AsyncSOCKS5Proxy
+        proxy_class = AsyncSOCKS5Proxy
+    else:
+        proxy_class = SOCKS5Proxy
     
-    proxy = SOCKS5Proxy(server_host, server_port, args.port, args.password)
+    proxy = proxy_class(server_host, server_port, args.port, args.password,
+                        multiplex=args.mux, pool_min_idle=args.pool_min_idle,
+                        pool_max_size=args.pool_max_size, relay=args.relay,
+                        compression=None if args.compression == 'none' else args.compression,
+                        compression_level=args.compression_level, metrics_port=args.metrics_port,
+                        endpoints=endpoints, balance=args.balance,
+                        udp_idle_timeout=args.udp_idle_timeout, connect_mode=args.connect_mode,
+                        backlog=args.backlog, max_tunnels=args.max_tunnels, overload=args.overload,
+                        idle_timeout=args.idle_timeout, keepalive=args.keepalive,
+                        socket_profile=args.socket_profile)
     
     try:
         proxy.start()
     except KeyboardInterrupt:
-        print("\n[PROXY] Shutting down...")
+        log.info("Shutting down...")
         proxy.stop()
 
 
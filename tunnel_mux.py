@@ -0,0 +1,397 @@
+"""
+Stream multiplexing - Carries many logical tunnels over one server connection
+"""
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from admission import half_close
+from compression import MAX_CHUNK
+from relay_buffers import AdaptiveBuffer
+from vpn_logging import get_logger
+
+
+log = get_logger('mux')
+
+# First record a client sends instead of "host:port" to enter mux mode.
+# Legacy target requests are text and never start with a NUL byte.
+MUX_HELLO = b'\x00MUX/1'
+
+# Frame wire format (one frame per record):
+#   frame := type(1) stream_id(4, big endian) payload
+FRAME_HEADER = struct.Struct('>BI')
+FRAME_OPEN = 1      # payload: b"host:port"
+FRAME_DATA = 2      # payload: stream bytes
+FRAME_CLOSE = 3     # payload: empty, or CLOSE_WRITE
+FRAME_WINDOW = 4    # payload: window increment (4 bytes, big endian)
+
+# CLOSE payload of a half-close: the sender has no more data but still reads
+# the stream, so the peer passes the EOF on and keeps relaying the answer.
+# Peers that predate it read any CLOSE as a full close.
+CLOSE_WRITE = b'\x01'
+
+# Sized so a frame still fits one record when the tunnel is compressed
+MAX_FRAME_PAYLOAD = MAX_CHUNK - FRAME_HEADER.size
+WINDOW_INCREMENT = struct.Struct('>I')
+
+# Bytes a sender may have in flight per stream before it needs credit
+STREAM_WINDOW = 256 * 1024
+
+# Streams a peer may have open in one session; OPENs beyond it are answered
+# with a CLOSE. Each stream on the server holds a target socket.
+MAX_SESSION_STREAMS = 256
+
+
+class MuxStream:
+    """One logical tunnel inside a MuxSession, with a socket-like API"""
+    
+    def __init__(self, session, stream_id):
+        """
+        Initialize stream
+        
+        Args:
+            session: Owning MuxSession
+            stream_id: Stream identifier, unique within the session
+        """
+        self.session = session
+        self.stream_id = stream_id
+        self.cond = threading.Condition()
+        self.buffer = deque()
+        self.send_window = STREAM_WINDOW
+        self.recv_window = STREAM_WINDOW
+        self.unacked = 0
+        self.local_closed = False
+        self.remote_closed = False
+        # Half-closes: this side or the peer sends no more data
+        self.local_shut = False
+        self.remote_shut = False
+    
+    def send(self, data: bytes):
+        """Send data, blocking while the peer's window is exhausted"""
+        view = memoryview(data)
+        while view:
+            with self.cond:
+                while self.send_window <= 0 and not self._dead():
+                    self.cond.wait()
+                if self._dead():
+                    raise ConnectionError("Stream closed")
+                size = min(len(view), self.send_window, MAX_FRAME_PAYLOAD)
+                self.send_window -= size
+            self.session.send_frame(FRAME_DATA, self.stream_id, view[:size])
+            view = view[size:]
+    
+    def recv(self) -> bytes:
+        """Return the next chunk of data, or b'' once the peer closed or half-closed the stream"""
+        with self.cond:
+            while not self.buffer and not self._drained():
+                self.cond.wait()
+            if not self.buffer:
+                return b''
+            data = self.buffer.popleft()
+            self.recv_window += len(data)
+            self.unacked += len(data)
+            credit = 0
+            if self.unacked >= STREAM_WINDOW // 2:
+                credit, self.unacked = self.unacked, 0
+        
+        if credit and not self.remote_closed and not self.remote_shut:
+            self.session.send_frame(FRAME_WINDOW, self.stream_id,
+                                    WINDOW_INCREMENT.pack(credit))
+        return data
+    
+    def close(self):
+        """Close the stream in both directions"""
+        with self.cond:
+            if self.local_closed:
+                return
+            self.local_closed = True
+            self.cond.notify_all()
+        try:
+            self.session.send_frame(FRAME_CLOSE, self.stream_id, b'')
+        except Exception:
+            pass
+        self.session.release_stream(self)
+    
+    def shutdown_write(self):
+        """Tell the peer no more data follows, keeping the receive side open"""
+        with self.cond:
+            if self.local_closed or self.local_shut:
+                return
+            self.local_shut = True
+            self.cond.notify_all()
+        self.session.send_frame(FRAME_CLOSE, self.stream_id, CLOSE_WRITE)
+    
+    def _dead(self):
+        """Whether data can no longer be sent on this stream"""
+        return self.local_closed or self.local_shut or self.remote_closed or self.session.closed
+    
+    def _drained(self):
+        """Whether no more data will arrive once the buffer is empty"""
+        return self.local_closed or self.remote_closed or self.remote_shut or self.session.closed
+    
+    def _on_data(self, data):
+        """Queue data received from the peer"""
+        with self.cond:
+            if self.local_closed:
+                return
+            if len(data) > self.recv_window:
+                raise ValueError(f"Stream {self.stream_id} exceeded its flow-control window")
+            self.recv_window -= len(data)
+            self.buffer.append(bytes(data))
+            self.cond.notify_all()
+    
+    def _on_window(self, increment):
+        """Grant more send credit"""
+        with self.cond:
+            self.send_window += increment
+            self.cond.notify_all()
+    
+    def _on_shutdown(self):
+        """Mark the peer's sending side closed"""
+        with self.cond:
+            self.remote_shut = True
+            self.cond.notify_all()
+    
+    def _on_close(self):
+        """Mark the stream closed by the peer"""
+        with self.cond:
+            self.remote_closed = True
+            self.cond.notify_all()
+        self.session.release_stream(self)
+
+
+class MuxSession:
+    """Multiplexes MuxStreams over one record-encrypted connection"""
+    
+    def __init__(self, sock, encoder, decoder, on_open=None, max_streams=MAX_SESSION_STREAMS):
+        """
+        Initialize session
+        
+        Args:
+            sock: Connected socket to the peer
+            encoder: Record encoder for outgoing frames
+            decoder: Record decoder for incoming frames
+            on_open: Called as on_open(stream, host, port) on the frame
+                     reader thread when the peer opens a stream; it must
+                     hand the stream off rather than block. Only set on
+                     the server.
+            max_streams: Streams the peer may have open at once
+        """
+        self.sock = sock
+        self.encoder = encoder
+        self.decoder = decoder
+        self.on_open = on_open
+        self.max_streams = max_streams
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.next_stream_id = 1
+        self.closed = False
+    
+    @classmethod
+    def connect(cls, vpn_client):
+        """
+        Switch an already keyed VPNClient connection into mux mode
+        
+        Returns:
+            A started MuxSession
+        """
+        vpn_client.send_request(MUX_HELLO)
+        session = cls(vpn_client.server_socket, vpn_client.encoder, vpn_client.decoder)
+        session.start()
+        return session
+    
+    def start(self):
+        """Run the frame reader in a background thread"""
+        threading.Thread(target=self.run, daemon=True).start()
+    
+    def open_stream(self, target_host, target_port) -> MuxStream:
+        """Open a new stream to target_host:target_port through the server"""
+        with self.lock:
+            if self.closed:
+                raise ConnectionError("Mux session closed")
+            stream = MuxStream(self, self.next_stream_id)
+            self.next_stream_id += 2
+            self.streams[stream.stream_id] = stream
+        
+        target_info = f"{target_host}:{target_port}"
+        self.send_frame(FRAME_OPEN, stream.stream_id, target_info.encode())
+        return stream
+    
+    def send_frame(self, frame_type, stream_id, payload):
+        """Encrypt and send one frame"""
+        header = FRAME_HEADER.pack(frame_type, stream_id)
+        with self.send_lock:
+            if self.closed:
+                raise ConnectionError("Mux session closed")
+            try:
+                self.sock.sendall(self.encoder.encode(header + payload))
+            except OSError:
+                self.close()
+                raise
+    
+    def release_stream(self, stream):
+        """Forget a stream once both sides have closed it"""
+        if stream.local_closed and stream.remote_closed:
+            with self.lock:
+                self.streams.pop(stream.stream_id, None)
+    
+    def run(self, initial_records=()):
+        """
+        Read frames until the connection closes
+        
+        Args:
+            initial_records: Records already decoded by the caller
+        """
+        try:
+            for record in initial_records:
+                self._dispatch(record)
+            while not self.closed:
+                records = self.decoder.recv_from(self.sock)
+                if records is None:
+                    break
+                for record in records:
+                    self._dispatch(record)
+        except Exception as e:
+            if not self.closed:
+                log.warning("Session error: %s", e)
+        finally:
+            self.close()
+    
+    def _dispatch(self, record):
+        """Handle one received frame"""
+        frame_type, stream_id = FRAME_HEADER.unpack_from(record)
+        payload = memoryview(record)[FRAME_HEADER.size:]
+        
+        if frame_type == FRAME_OPEN:
+            self._accept_stream(stream_id, bytes(payload))
+            return
+        
+        with self.lock:
+            stream = self.streams.get(stream_id)
+        if stream is None:
+            return
+        
+        if frame_type == FRAME_DATA:
+            stream._on_data(payload)
+        elif frame_type == FRAME_WINDOW:
+            stream._on_window(WINDOW_INCREMENT.unpack(payload)[0])
+        elif frame_type == FRAME_CLOSE:
+            if payload == CLOSE_WRITE:
+                stream._on_shutdown()
+            else:
+                stream._on_close()
+        else:
+            raise ValueError(f"Unknown frame type {frame_type}")
+    
+    def _accept_stream(self, stream_id, target_info):
+        """Handle an OPEN frame from the peer"""
+        if self.on_open is None:
+            raise ValueError("Peer tried to open a stream")
+        
+        try:
+            target_host, target_port = target_info.decode().rsplit(':', 1)
+            target_port = int(target_port)
+        except ValueError:
+            # Only this stream is refused, the others keep going
+            log.warning("Invalid target for stream %s: %r", stream_id, target_info[:100])
+            self.send_frame(FRAME_CLOSE, stream_id, b'')
+            return
+        
+        stream = MuxStream(self, stream_id)
+        with self.lock:
+            if stream_id in self.streams:
+                raise ValueError(f"Duplicate stream id {stream_id}")
+            full = len(self.streams) >= self.max_streams
+            if not full:
+                self.streams[stream_id] = stream
+        if full:
+            log.warning("Session has %s streams open, refusing stream %s",
+                        self.max_streams, stream_id)
+            self.send_frame(FRAME_CLOSE, stream_id, b'')
+            return
+        
+        self.on_open(stream, target_host, target_port)
+    
+    def close(self):
+        """Close the connection and every stream on it"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            streams = list(self.streams.values())
+            self.streams.clear()
+        
+        for stream in streams:
+            with stream.cond:
+                stream.cond.notify_all()
+        _shutdown(self.sock)
+
+
+def splice(stream, sock, limits=None, slot=None):
+    """
+    Relay between a MuxStream and a plain socket until either side closes
+    
+    Runs the socket -> stream direction in a helper thread and the
+    stream -> socket direction in the calling thread. An EOF on either side
+    is passed on as a half-close and the other direction keeps going until
+    it ends too. On the server, limits (a rate_limit.ClientLimits) pauses
+    either thread while the client is over its rate, and slot (the
+    stream's admission.Slot) counts the traffic.
+    """
+    def upstream():
+        buffer = AdaptiveBuffer()
+        try:
+            while True:
+                data = buffer.recv_into(sock)
+                if not data:
+                    stream.shutdown_write()
+                    return
+                stream.send(data)
+                if slot is not None:
+                    slot.count('download', len(data))
+                if limits is not None:
+                    delay = limits.consume('download', len(data))
+                    if delay:
+                        time.sleep(delay)
+        except (OSError, ConnectionError):
+            stream.close()
+            _shutdown(sock)
+    
+    reader = threading.Thread(target=upstream, daemon=True)
+    reader.start()
+    
+    try:
+        while True:
+            data = stream.recv()
+            if not data:
+                break
+            sock.sendall(data)
+            if slot is not None:
+                slot.count('upload', len(data))
+            if limits is not None:
+                delay = limits.consume('upload', len(data))
+                if delay:
+                    time.sleep(delay)
+        if stream.remote_shut and not stream.remote_closed:
+            # The peer is done sending; relay the answer until it ends too
+            half_close(sock)
+            reader.join()
+    except OSError:
+        pass
+    finally:
+        stream.close()
+        _shutdown(sock)
+
+
+def _shutdown(sock):
+    """Shut down and close a socket, ignoring errors"""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+    try:
+        sock.close()
+    except OSError:
+        pass
@@ -0,0 +1,166 @@
+"""
+Tunnel Pool - Keeps pre-connected, pre-keyed VPN client connections ready
+"""
+import threading
+import time
+from collections import deque
+from compression import DEFAULT_LEVEL
+from relay_buffers import wait_readable
+from vpn_client import VPNClient
+from vpn_logging import get_logger
+
+
+log = get_logger('pool')
+
+
+class TunnelPool:
+    """Pool of idle VPNClient connections to one VPN server"""
+    
+    def __init__(self, server_host, server_port, password=None, min_idle=2, max_size=16,
+                 max_idle_time=60, refill_interval=1.0, compression=None,
+                 compression_level=DEFAULT_LEVEL, tuner=None):
+        """
+        Initialize Tunnel Pool
+        
+        Args:
+            server_host: VPN server host
+            server_port: VPN server port
+            password: VPN encryption password
+            min_idle: Idle connections to keep ready (default: 2)
+            max_size: Maximum idle connections held at once (default: 16)
+            max_idle_time: Seconds after which an idle connection is evicted (default: 60)
+            refill_interval: Seconds between background health checks (default: 1.0)
+            compression: Compression offered by pooled connections, or None
+            compression_level: Compression level to offer (default: 6)
+            tuner: socket_tuning.SocketTuner for pooled connections (optional)
+        """
+        self.server_host = server_host
+        self.server_port = server_port
+        self.password = password
+        self.min_idle = min_idle
+        self.max_size = max(max_size, min_idle)
+        self.max_idle_time = max_idle_time
+        self.refill_interval = refill_interval
+        self.compression = compression
+        self.compression_level = compression_level
+        self.tuner = tuner
+        
+        self.idle = deque()
+        self.cond = threading.Condition()
+        self.running = False
+        
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connect_failures = 0
+    
+    def start(self):
+        """Start the background refill thread"""
+        self.running = True
+        threading.Thread(target=self._refill_loop, daemon=True).start()
+        log.info("Keeping %s idle connection(s) to %s:%s (max %s)",
+                 self.min_idle, self.server_host, self.server_port, self.max_size)
+    
+    def stop(self):
+        """Stop refilling and close all idle connections"""
+        with self.cond:
+            self.running = False
+            idle = list(self.idle)
+            self.idle.clear()
+            self.cond.notify_all()
+        for vpn_client, _ in idle:
+            self._discard(vpn_client)
+    
+    def acquire(self):
+        """
+        Take a connected VPNClient, connecting inline if none is ready
+        
+        Returns:
+            A connected VPNClient, or None if the server is unreachable
+        """
+        with self.cond:
+            while self.idle:
+                vpn_client, idle_since = self.idle.popleft()
+                if self._is_healthy(vpn_client, idle_since):
+                    self.hits += 1
+                    self.cond.notify_all()
+                    return vpn_client
+                self.evictions += 1
+                self._discard(vpn_client)
+            self.misses += 1
+            self.cond.notify_all()
+        
+        return self._connect()
+    
+    def stats(self) -> dict:
+        """Return pool counters"""
+        with self.cond:
+            return {
+                'idle': len(self.idle),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'connect_failures': self.connect_failures,
+            }
+    
+    def _refill_loop(self):
+        """Evict stale connections and top the pool up to min_idle"""
+        while True:
+            with self.cond:
+                if not self.running:
+                    return
+                self._evict_stale()
+                missing = min(self.min_idle, self.max_size) - len(self.idle)
+            
+            for _ in range(max(missing, 0)):
+                vpn_client = self._connect()
+                if vpn_client is None:
+                    break
+                with self.cond:
+                    if not self.running or len(self.idle) >= self.max_size:
+                        self._discard(vpn_client)
+                        break
+                    self.idle.append((vpn_client, time.monotonic()))
+            
+            with self.cond:
+                if self.running:
+                    # Woken early by acquire() when a connection is taken
+                    self.cond.wait(self.refill_interval)
+    
+    def _evict_stale(self):
+        """Drop idle connections that are too old or no longer usable"""
+        healthy = deque()
+        for vpn_client, idle_since in self.idle:
+            if self._is_healthy(vpn_client, idle_since):
+                healthy.append((vpn_client, idle_since))
+            else:
+                self.evictions += 1
+                self._discard(vpn_client)
+        self.idle = healthy
+    
+    def _is_healthy(self, vpn_client, idle_since):
+        """Whether an idle connection is fresh and still open"""
+        if time.monotonic() - idle_since > self.max_idle_time:
+            return False
+        try:
+            # An idle tunnel must not be readable: that means EOF or junk
+            return not wait_readable([vpn_client.server_socket], 0)
+        except (OSError, ValueError):
+            return False
+    
+    def _connect(self):
+        """Open and key a new connection"""
+        vpn_client = VPNClient(self.server_host, self.server_port, self.password,
+                               self.compression, self.compression_level, self.tuner)
+        if vpn_client.connect_to_server():
+            return vpn_client
+        with self.cond:
+            self.connect_failures += 1
+        return None
+    
+    def _discard(self, vpn_client):
+        """Close a pooled connection"""
+        try:
+            vpn_client.server_socket.close()
+        except OSError:
+            pass
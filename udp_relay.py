@@ -0,0 +1,343 @@
+"""
+UDP Relay - SOCKS5 UDP ASSOCIATE carried through the tunnel as datagram records
+"""
+import ipaddress
+import socket
+import struct
+import threading
+import time
+from collections import deque
+from compression import MAX_CHUNK
+from metrics import count_error
+from relay_buffers import wait_readable
+from vpn_logging import get_logger
+
+
+server_log = get_logger('server')
+proxy_log = get_logger('proxy')
+
+# First record a client sends instead of "host:port" to carry datagrams.
+# Legacy target requests are text and never start with a NUL byte.
+UDP_HELLO = b'\x00UDP/1'
+
+# After the hello every record in both directions is exactly one datagram,
+# framed like a SOCKS5 UDP request:
+#   datagram := RSV(2)=0 FRAG(1)=0 ATYP(1) ADDR PORT(2, big endian) DATA
+# Towards the server ADDR is the destination, from the server it is the
+# source, so the proxy forwards datagrams without re-framing them. Each
+# association has its own server connection and records are independent,
+# so a datagram never waits behind stream data or a lost earlier datagram's
+# retransmission on another tunnel.
+ATYP_IPV4 = 1
+ATYP_DOMAIN = 3
+ATYP_IPV6 = 4
+
+# Seconds without a datagram in either direction before an association ends
+UDP_IDLE_TIMEOUT = 120
+
+# Largest datagram read from a UDP socket
+MAX_DATAGRAM = 65535
+
+# A framed datagram must fit one record, compressed or not; larger ones
+# (rare outside of fragmented UDP) are dropped
+MAX_FRAMED_DATAGRAM = MAX_CHUNK
+
+# Datagrams held for one destination while its hostname is being resolved;
+# more are dropped, as a full socket buffer would
+MAX_PENDING_DATAGRAMS = 16
+
+# Hostnames one association resolves at once, each in a thread of its own;
+# datagrams to further uncached destinations are dropped until one finishes
+MAX_PENDING_LOOKUPS = 8
+
+
+def parse_datagram(datagram):
+    """
+    Split a framed datagram
+    
+    Returns:
+        (host, port, data)
+    
+    Raises:
+        ValueError: if the header is malformed or the datagram is a fragment
+    """
+    if len(datagram) < 4:
+        raise ValueError("Datagram too short")
+    if datagram[2] != 0:
+        raise ValueError("Fragmented datagrams are not supported")
+    
+    addr_type = datagram[3]
+    if addr_type == ATYP_IPV4:
+        host = socket.inet_ntoa(datagram[4:8])
+        offset = 8
+    elif addr_type == ATYP_DOMAIN:
+        length = datagram[4] if len(datagram) > 4 else 0
+        host = bytes(datagram[5:5 + length]).decode()
+        offset = 5 + length
+    elif addr_type == ATYP_IPV6:
+        host = socket.inet_ntop(socket.AF_INET6, datagram[4:20])
+        offset = 20
+    else:
+        raise ValueError(f"Unknown address type {addr_type}")
+    
+    if len(datagram) < offset + 2:
+        raise ValueError("Datagram too short")
+    port = struct.unpack('>H', datagram[offset:offset + 2])[0]
+    return host, port, datagram[offset + 2:]
+
+
+def build_datagram(host, port, data) -> bytes:
+    """Frame data received from an address literal (host, port)"""
+    address = ipaddress.ip_address(host.split('%', 1)[0])
+    addr_type = ATYP_IPV4 if address.version == 4 else ATYP_IPV6
+    return bytes((0, 0, 0, addr_type)) + address.packed + struct.pack('>H', port) + data
+
+
+class UDPAssociation:
+    """Server side of an association: sends datagram records to their targets and back"""
+    
+    def __init__(self, tunnel_socket, encoder, decoder, resolver, idle_timeout=UDP_IDLE_TIMEOUT,
+                 limits=None):
+        """
+        Initialize association
+        
+        Args:
+            tunnel_socket: Connection to the VPN client (carries records)
+            encoder: Record encoder for the server -> client direction
+            decoder: Record decoder for the client -> server direction
+            resolver: Resolver for destination hostnames
+            idle_timeout: Seconds without traffic before the association ends
+            limits: Client's rate_limit.ClientLimits, charged 'upload' for
+                    datagrams to destinations and 'download' for datagrams
+                    back (optional)
+        """
+        self.tunnel_socket = tunnel_socket
+        self.encoder = encoder
+        self.decoder = decoder
+        self.resolver = resolver
+        self.idle_timeout = idle_timeout
+        self.limits = limits
+        # Direction over its rate -> time it is read again; meanwhile
+        # datagrams wait in the socket buffers, or are dropped by the kernel
+        self.paused = {}
+        # One unconnected UDP socket per address family, created on first use
+        self.sockets = {}
+        # (host, port) -> datagrams waiting for that hostname's lookup thread
+        self.pending = {}
+        # (host, port, addresses or exception) finished by lookup threads
+        self.resolved = deque()
+        # Socket pair the lookup threads wake the relay loop with, created
+        # by the first lookup
+        self.wakeup = None
+        self.datagrams_sent = 0
+        self.datagrams_received = 0
+        self.datagrams_dropped = 0
+    
+    def run(self, initial_records=()):
+        """Relay until the client closes the tunnel or the association is idle"""
+        last_activity = time.monotonic()
+        try:
+            for record in initial_records:
+                self.forward(record)
+            
+            while True:
+                now = time.monotonic()
+                timeout = self.idle_timeout - (now - last_activity)
+                if timeout <= 0:
+                    server_log.info("UDP association idle, closing")
+                    return
+                for direction, until in list(self.paused.items()):
+                    if until <= now:
+                        del self.paused[direction]
+                    else:
+                        timeout = min(timeout, until - now)
+                sockets = []
+                if 'upload' not in self.paused:
+                    sockets.append(self.tunnel_socket)
+                if 'download' not in self.paused:
+                    sockets.extend(self.sockets.values())
+                if self.wakeup is not None:
+                    sockets.append(self.wakeup[0])
+                for sock in wait_readable(sockets, timeout):
+                    last_activity = time.monotonic()
+                    if self.wakeup is not None and sock is self.wakeup[0]:
+                        self.send_resolved()
+                    elif sock is self.tunnel_socket:
+                        try:
+                            payloads = self.decoder.recv_from(sock)
+                        except socket.error:
+                            return
+                        except Exception as e:
+                            server_log.warning("Decryption error: %s", e)
+                            count_error('decrypt')
+                            return
+                        if payloads is None:
+                            return
+                        for payload in payloads:
+                            self.forward(payload)
+                        self.charge('upload', sum(len(payload) for payload in payloads))
+                    else:
+                        try:
+                            data, source = sock.recvfrom(MAX_DATAGRAM)
+                        except OSError:
+                            continue
+                        framed = build_datagram(source[0], source[1], data)
+                        if len(framed) > MAX_FRAMED_DATAGRAM:
+                            self.datagrams_dropped += 1
+                            continue
+                        self.datagrams_received += 1
+                        self.tunnel_socket.sendall(self.encoder.encode(framed))
+                        self.charge('download', len(framed))
+        except socket.error:
+            pass
+        finally:
+            for sock in self.sockets.values():
+                sock.close()
+            if self.wakeup is not None:
+                for sock in self.wakeup:
+                    sock.close()
+            self.tunnel_socket.close()
+            server_log.info("UDP association closed: %s sent, %s received, %s dropped",
+                            self.datagrams_sent, self.datagrams_received, self.datagrams_dropped)
+    
+    def charge(self, direction, amount):
+        """Charge the client's rate limits, pausing direction while it is over them"""
+        if self.limits is None:
+            return
+        delay = self.limits.consume(direction, amount)
+        if delay:
+            self.paused[direction] = time.monotonic() + delay
+    
+    def forward(self, record):
+        """Send one datagram record to its destination, dropping it on any error"""
+        try:
+            host, port, data = parse_datagram(record)
+            addresses = self.resolver.cached(host, port)
+            if addresses is None:
+                self.resolve_later(host, port, data)
+                return
+            self.send(addresses, data)
+        except (ValueError, OSError, IndexError):
+            self.datagrams_dropped += 1
+    
+    def send(self, addresses, data):
+        """Send data to the first of resolved addresses"""
+        family, sockaddr = addresses[0]
+        sock = self.sockets.get(family)
+        if sock is None:
+            sock = self.sockets[family] = socket.socket(family, socket.SOCK_DGRAM)
+        sock.sendto(data, sockaddr)
+        self.datagrams_sent += 1
+    
+    def resolve_later(self, host, port, data):
+        """
+        Hold a datagram while a thread looks up its destination, so a slow
+        DNS server does not stall the other destinations of the association
+        """
+        waiting = self.pending.get((host, port))
+        if waiting is not None:
+            if len(waiting) < MAX_PENDING_DATAGRAMS:
+                waiting.append(data)
+            else:
+                self.datagrams_dropped += 1
+            return
+        if len(self.pending) >= MAX_PENDING_LOOKUPS:
+            self.datagrams_dropped += 1
+            return
+        if self.wakeup is None:
+            self.wakeup = socket.socketpair()
+        self.pending[(host, port)] = [data]
+        threading.Thread(target=self.lookup, args=(host, port), daemon=True).start()
+    
+    def lookup(self, host, port):
+        """Resolve a destination and wake the relay loop (runs in its own thread)"""
+        try:
+            result = self.resolver.resolve(host, port)
+        except (ValueError, OSError) as e:
+            result = e
+        self.resolved.append((host, port, result))
+        try:
+            self.wakeup[1].send(b'\0')
+        except OSError:
+            # The association has ended
+            pass
+    
+    def send_resolved(self):
+        """Send the datagrams whose destinations lookup threads have resolved"""
+        self.wakeup[0].recv(MAX_DATAGRAM)
+        while self.resolved:
+            host, port, result = self.resolved.popleft()
+            for data in self.pending.pop((host, port), ()):
+                try:
+                    if isinstance(result, Exception):
+                        raise result
+                    self.send(result, data)
+                except (ValueError, OSError, IndexError):
+                    self.datagrams_dropped += 1
+
+
+class UDPClientAssociation:
+    """Proxy side of an association: relays a SOCKS client's UDP socket over the tunnel"""
+    
+    def __init__(self, control_socket, udp_socket, server_socket, encoder, decoder,
+                 idle_timeout=UDP_IDLE_TIMEOUT):
+        """
+        Initialize association
+        
+        Args:
+            control_socket: The SOCKS client's TCP connection; the
+                            association ends when it closes (RFC 1928)
+            udp_socket: Local UDP socket the SOCKS client sends to
+            server_socket: Connection to the VPN server (carries records)
+            encoder: Record encoder for the proxy -> server direction
+            decoder: Record decoder for the server -> proxy direction
+            idle_timeout: Seconds without traffic before the association ends
+        """
+        self.control_socket = control_socket
+        self.udp_socket = udp_socket
+        self.server_socket = server_socket
+        self.encoder = encoder
+        self.decoder = decoder
+        self.idle_timeout = idle_timeout
+        self.client_address = None
+    
+    def run(self):
+        """Relay until the control connection or the tunnel closes, or traffic stops"""
+        sockets = [self.control_socket, self.udp_socket, self.server_socket]
+        last_activity = time.monotonic()
+        while True:
+            timeout = self.idle_timeout - (time.monotonic() - last_activity)
+            if timeout <= 0:
+                proxy_log.info("UDP association idle, closing")
+                return
+            for sock in wait_readable(sockets, timeout):
+                if sock is self.control_socket:
+                    # Nothing is expected on the control connection but EOF
+                    if not self.control_socket.recv(1):
+                        return
+                elif sock is self.udp_socket:
+                    last_activity = time.monotonic()
+                    data, source = self.udp_socket.recvfrom(MAX_DATAGRAM)
+                    # The first sender owns the association; datagrams from
+                    # anyone else, fragments and oversized datagrams are dropped
+                    if self.client_address is None:
+                        self.client_address = source
+                    if (source != self.client_address or len(data) < 4 or data[2] != 0
+                            or len(data) > MAX_FRAMED_DATAGRAM):
+                        continue
+                    self.server_socket.sendall(self.encoder.encode(data))
+                else:
+                    last_activity = time.monotonic()
+                    try:
+                        payloads = self.decoder.recv_from(self.server_socket)
+                    except socket.error:
+                        return
+                    except Exception as e:
+                        proxy_log.warning("Decryption error: %s", e)
+                        count_error('decrypt')
+                        return
+                    if payloads is None:
+                        return
+                    if self.client_address is not None:
+                        for payload in payloads:
+                            self.udp_socket.sendto(payload, self.client_address)
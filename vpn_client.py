@@ -5,13 +5,35 @@ import socket
 import threading
 import select
 import sys
-from crypto_utils import VPNCrypto
+import time
+from compression import DEFAULT_LEVEL, client_handshake
+from connect_status import CONNECT_REQUEST, parse_status
+from crypto_utils import VPNCrypto, derive_password_key
+from metrics import CONNECT_SECONDS, HANDSHAKE_SECONDS, count_error
+from relay_buffers import AdaptiveBuffer, send_buffers
+from socket_tuning import SOCKET_PROFILES, SocketTuner
+from vpn_logging import add_logging_arguments, configure_from_args, get_logger
+
+
+log = get_logger('client')
+
+
+def recv_exact(sock, length):
+    """Receive exactly length bytes, raising ConnectionError on EOF"""
+    data = bytearray()
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        data += chunk
+    return bytes(data)
 
 
 class VPNClient:
     """VPN Client that connects to server and tunnels traffic"""
     
-    def __init__(self, server_host, server_port, password=None):
+    def __init__(self, server_host, server_port, password=None, compression=None,
+                 compression_level=DEFAULT_LEVEL, tuner=None):
         """
         Initialize VPN Client
         
@@ -19,35 +41,127 @@ class VPNClient:
             server_host: VPN server host address
             server_port: VPN server port
             password: Encryption password (optional, must match server)
+            compression: Compression algorithm to offer ('zlib'), or None
+            compression_level: Compression level to offer (default: 6)
+            tuner: socket_tuning.SocketTuner for the server connection
+                   (default: kernel settings)
         """
         self.server_host = server_host
         self.server_port = server_port
-        self.crypto = VPNCrypto(password)
+        self.password = password
+        self.compression = compression
+        self.compression_level = compression_level
+        self.tuner = tuner
+        # The session key comes from the server's handshake; with early
+        # connects it is derived locally and the handshake only checked
+        self.crypto = VPNCrypto(password, deferred=True)
+        self.expected_key = None
         self.running = False
         
-        print(f"[CLIENT] Connecting to server at {server_host}:{server_port}")
+        log.info("Connecting to server at %s:%s", server_host, server_port)
     
-    def connect_to_server(self):
-        """Connect to VPN server"""
+    def connect_to_server(self, early=False):
+        """
+        Connect to VPN server
+        
+        Args:
+            early: With a password, derive the session key locally instead of
+                   waiting for the server's key message, so the request can
+                   go out right away; read_status() checks the key later
+        """
         try:
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.connect((self.server_host, self.server_port))
+            started = time.perf_counter()
+            # getaddrinfo() so IPv6 servers work as well
+            family, _, _, _, address = socket.getaddrinfo(self.server_host, self.server_port,
+                                                          type=socket.SOCK_STREAM)[0]
+            self.server_socket = socket.socket(family, socket.SOCK_STREAM)
+            if self.tuner is not None:
+                self.tuner.tune(self.server_socket, 'server')
+            self.server_socket.connect(address)
             self.running = True
+            connected = time.perf_counter()
+            CONNECT_SECONDS.observe(connected - started)
             
-            print("[CLIENT] Connected to VPN server")
+            log.info("Connected to VPN server")
             
-            # Receive encryption key from server
-            key_length = int.from_bytes(self.server_socket.recv(4), 'big')
-            key = self.server_socket.recv(key_length)
+            if early and self.password:
+                key = self.expected_key = derive_password_key(self.password)
+            else:
+                # Receive encryption key from server
+                key = self.receive_key()
+                HANDSHAKE_SECONDS.observe(time.perf_counter() - connected)
             self.crypto.set_key(key)
+            self.encoder = self.crypto.new_record_encoder()
+            self.decoder = self.crypto.new_record_decoder()
             
-            print("[CLIENT] Encryption established")
+            log.info("Encryption established")
             return True
-            
+        
         except Exception as e:
-            print(f"[CLIENT] Failed to connect: {e}")
+            log.warning("Failed to connect: %s", e)
+            count_error('server_connect')
             return False
     
+    def receive_key(self) -> bytes:
+        """Read the key message the server sends on every new connection"""
+        key_length = int.from_bytes(recv_exact(self.server_socket, 4), 'big')
+        return recv_exact(self.server_socket, key_length)
+    
+    def request_target(self, target_host, target_port, early_data=b'', status=False):
+        """
+        Ask the server to open a connection to the target
+        
+        Args:
+            early_data: Application bytes sent in the same write as the request
+            status: Ask for a connect status, to be read with read_status()
+        """
+        target_info = f"{target_host}:{target_port}".encode()
+        if status:
+            target_info = CONNECT_REQUEST + target_info
+        self.send_request(target_info, early_data)
+    
+    def send_request(self, request: bytes, early_data=b''):
+        """
+        Send the first record of the tunnel (target or mux hello)
+        
+        With compression enabled the offer goes out in the same write and
+        encoder/decoder are replaced by their compressing wrappers.
+        """
+        offer = b''
+        if self.compression:
+            offer, self.encoder, self.decoder = client_handshake(
+                self.encoder, self.decoder, self.compression, self.compression_level)
+        data = offer + self.encoder.encode(request)
+        if early_data:
+            data += self.encoder.encode(early_data)
+        self.server_socket.sendall(data)
+    
+    def read_status(self):
+        """
+        Wait for the connect status requested by request_target(status=True)
+        
+        Returns:
+            (code, payloads): SOCKS5 reply code and any target data that
+            arrived along with the status
+        
+        Raises:
+            ConnectionError: if the server closed, or its key does not match
+                             the locally derived one (wrong password)
+            ValueError: if the first record is not a status
+        """
+        if self.expected_key is not None:
+            key = self.receive_key()
+            if key != self.expected_key:
+                raise ConnectionError("Server key does not match the password")
+            self.expected_key = None
+        
+        payloads = []
+        while not payloads:
+            payloads = self.decoder.recv_from(self.server_socket)
+            if payloads is None:
+                raise ConnectionError("Connection closed by server")
+        return parse_status(payloads[0]), payloads[1:]
+    
     def tunnel_to_target(self, target_host, target_port):
         """
         Tunnel traffic to target through VPN server
@@ -62,11 +176,9 @@ class VPNClient:
         
         try:
             # Send target info to server (encrypted)
-            target_info = f"{target_host}:{target_port}"
-            encrypted_info = self.crypto.encrypt(target_info.encode())
-            self.server_socket.sendall(encrypted_info)
+            self.request_target(target_host, target_port)
             
-            print(f"[CLIENT] Requesting tunnel to {target_host}:{target_port}")
+            log.info("Requesting tunnel to %s:%s", target_host, target_port)
             
             # Create local socket for client application
             local_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -75,25 +187,26 @@ class VPNClient:
             local_port = local_socket.getsockname()[1]
             local_socket.listen(1)
             
-            print(f"[CLIENT] Local proxy listening on 127.0.0.1:{local_port}")
-            print(f"[CLIENT] Connect your application to 127.0.0.1:{local_port} to use VPN")
+            log.info("Local proxy listening on 127.0.0.1:%s", local_port)
+            log.info("Connect your application to 127.0.0.1:%s to use VPN", local_port)
             
             # Accept local connection
             client_socket, client_address = local_socket.accept()
-            print(f"[CLIENT] Local client connected from {client_address}")
+            log.info("Local client connected from %s", client_address)
             
             # Start bidirectional tunneling
             self.tunnel_traffic(client_socket, self.server_socket)
             
             return True
-            
+        
         except Exception as e:
-            print(f"[CLIENT] Tunneling error: {e}")
+            log.warning("Tunneling error: %s", e)
             return False
     
     def tunnel_traffic(self, client_socket, server_socket):
         """Tunnel traffic between local client and VPN server"""
         sockets = [client_socket, server_socket]
+        client_buffer = AdaptiveBuffer()
         
         try:
             while True:
@@ -104,28 +217,30 @@ class VPNClient:
                 
                 for sock in readable:
                     try:
-                        data = sock.recv(4096)
-                        if not data:
-                            return
-                        
                         if sock is client_socket:
                             # Data from local client -> encrypt -> send to server
-                            encrypted = self.crypto.encrypt(data)
-                            server_socket.sendall(encrypted)
+                            data = client_buffer.recv_into(client_socket)
+                            if not data:
+                                return
+                            send_buffers(server_socket, self.encoder.encode_parts(data))
                         else:
                             # Data from server -> decrypt -> send to local client
                             try:
-                                decrypted = self.crypto.decrypt(data)
-                                client_socket.sendall(decrypted)
+                                payloads = self.decoder.recv_from(server_socket)
+                            except socket.error:
+                                return
                             except Exception as e:
-                                print(f"[CLIENT] Decryption error: {e}")
+                                log.warning("Decryption error: %s", e)
                                 return
-                                
+                            if payloads is None:
+                                return
+                            send_buffers(client_socket, payloads)
+                    
                     except socket.error:
                         return
-                        
+        
         except Exception as e:
-            print(f"[CLIENT] Tunneling error: {e}")
+            log.warning("Tunneling error: %s", e)
         finally:
             client_socket.close()
     
@@ -134,7 +249,7 @@ class VPNClient:
         self.running = False
         if hasattr(self, 'server_socket'):
             self.server_socket.close()
-        print("[CLIENT] Client stopped")
+        log.info("Client stopped")
 
 
 def main():
@@ -145,8 +260,17 @@ def main():
     parser.add_argument('--server', required=True, help='VPN server address (host:port)')
     parser.add_argument('--target', required=True, help='Target address (host:port)')
     parser.add_argument('--password', help='Encryption password (optional, must match server)')
+    parser.add_argument('--compression', choices=['none', 'zlib'], default='none',
+                        help='Compress tunnel traffic before encryption (default: none)')
+    parser.add_argument('--compression-level', type=int, choices=range(1, 10), default=DEFAULT_LEVEL,
+                        metavar='1-9', help=f'Compression level (default: {DEFAULT_LEVEL})')
+    parser.add_argument('--socket-profile', choices=SOCKET_PROFILES, default='default',
+                        help='TCP tuning of the server connection: interactive, bulk or '
+                             'high-latency (default: kernel settings)')
+    add_logging_arguments(parser)
     
     args = parser.parse_args()
+    configure_from_args(parser, args)
     
     # Parse server address
     server_parts = args.server.split(':')
@@ -158,12 +282,15 @@ def main():
     target_host = target_parts[0]
     target_port = int(target_parts[1]) if len(target_parts) > 1 else 80
     
-    client = VPNClient(server_host, server_port, password=args.password)
+    client = VPNClient(server_host, server_port, password=args.password,
+                       compression=None if args.compression == 'none' else args.compression,
+                       compression_level=args.compression_level,
+                       tuner=SocketTuner(args.socket_profile))
     
     try:
         client.tunnel_to_target(target_host, target_port)
     except KeyboardInterrupt:
-        print("\n[CLIENT] Shutting down...")
+        log.info("Shutting down...")
         client.stop()
 
 
@@ -0,0 +1,349 @@
+"""
+VPN Logging - Leveled, rate limited logging written to stdout by a background thread
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from functools import partial
+
+
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+LOG_FORMATS = ('text', 'json')
+
+# Records waiting for the writer thread; when stdout cannot keep up the
+# newest records are dropped instead of blocking relay threads
+LOG_QUEUE_SIZE = 10000
+
+# Records per second one event (a message template of one component) may
+# log, with bursts up to EVENT_BURST; the rest are counted and dropped
+EVENT_RATE = 10.0
+EVENT_BURST = 50
+
+# Distinct events tracked for rate limiting before the table is reset
+MAX_TRACKED_EVENTS = 4096
+
+# Seconds the writer gets to drain the queue when the process exits
+FLUSH_TIMEOUT = 2.0
+
+# Loggers of all components live under this name
+ROOT_LOGGER = 'vpn'
+
+
+def get_logger(component) -> logging.Logger:
+    """
+    Return the logger of a component, e.g. get_logger('server')
+    
+    Messages should use %-style arguments rather than f-strings: the
+    template identifies the event for rate limiting and sampling, and the
+    message is only formatted by the writer thread if it is logged at all.
+    """
+    return logging.getLogger(f"{ROOT_LOGGER}.{component}")
+
+
+class EventFilter(logging.Filter):
+    """Rate limits each event and samples routine (below warning) events"""
+    
+    def __init__(self, rate=EVENT_RATE, burst=EVENT_BURST, sample=1.0):
+        """
+        Initialize filter
+        
+        Args:
+            rate: Records per second per event, None for no limit
+            burst: Records an event may log at once after being quiet
+            sample: Fraction of debug/info records kept, e.g. 0.1 logs every
+                    tenth record of each event; warnings are never sampled
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sample_every = max(1, round(1 / sample)) if sample > 0 else 0
+        # (logger, template) -> [tokens, updated, seen, suppressed]
+        self.events = {}
+        self.suppressed = 0
+        self.lock = threading.Lock()
+    
+    def filter(self, record) -> bool:
+        """Decide in the logging thread, before the record is queued"""
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            state = self.events.get(key)
+            if state is None:
+                if len(self.events) >= MAX_TRACKED_EVENTS:
+                    self.events.clear()
+                state = self.events[key] = [self.burst, now, 0, 0]
+            
+            state[2] += 1
+            if record.levelno < logging.WARNING and (
+                    not self.sample_every or (state[2] - 1) % self.sample_every):
+                return False
+            
+            if self.rate:
+                state[0] = min(state[0] + (now - state[1]) * self.rate, self.burst)
+                state[1] = now
+                if state[0] < 1:
+                    state[3] += 1
+                    self.suppressed += 1
+                    return False
+                state[0] -= 1
+            
+            # Tell the reader how many records of this event were skipped
+            record.suppressed = state[3]
+            state[3] = 0
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the writer thread without ever blocking the caller"""
+    
+    def __init__(self, log_queue, start_writer=None):
+        """
+        Initialize handler
+        
+        Args:
+            log_queue: Bounded queue the writer thread reads
+            start_writer: Called once, with the first record, to start a
+                          writer thread that is not running yet (optional)
+        """
+        super().__init__(log_queue)
+        self.start_writer = start_writer
+        self.dropped = 0
+        self.unreported = 0
+    
+    def prepare(self, record):
+        """Keep the record as is; the writer thread formats it"""
+        return record
+    
+    def enqueue(self, record):
+        """Queue the record, or count it as dropped if the queue is full"""
+        if self.start_writer is not None:
+            with self.lock:
+                start_writer, self.start_writer = self.start_writer, None
+            if start_writer is not None:
+                start_writer()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+                self.unreported += 1
+            return
+        
+        if self.unreported:
+            with self.lock:
+                count, self.unreported = self.unreported, 0
+            notice = logging.LogRecord('vpn.log', logging.WARNING, __file__, 0,
+                                       "%d log records dropped, output too slow", (count,), None)
+            try:
+                self.queue.put_nowait(notice)
+            except queue.Full:
+                with self.lock:
+                    self.unreported += count
+
+
+class LogWriter(logging.handlers.QueueListener):
+    """Background thread writing queued records to stdout"""
+    
+    def stop(self):
+        """Write out what is queued, giving up after FLUSH_TIMEOUT if stdout is stuck"""
+        if self._thread is None:
+            return
+        try:
+            self.queue.put(self._sentinel, timeout=FLUSH_TIMEOUT)
+        except queue.Full:
+            return
+        self._thread.join(FLUSH_TIMEOUT)
+        self._thread = None
+
+
+class TextFormatter(logging.Formatter):
+    """[COMPONENT] message, the format the tools have always printed"""
+    
+    def format(self, record) -> str:
+        component = record.name.rsplit('.', 1)[-1].upper()
+        line = f"[{component}] {record.getMessage()}"
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            line += f" (+{suppressed} similar suppressed)"
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line for log shippers"""
+    
+    def format(self, record) -> str:
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
+                    + f".{int(record.msecs):03d}Z",
+            'level': record.levelname.lower(),
+            'component': record.name.rsplit('.', 1)[-1],
+            'event': str(record.msg),
+            'message': record.getMessage(),
+        }
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class LogSettings:
+    """Active logging configuration, kept so a forked worker can restart the writer"""
+    
+    def __init__(self, level='info', log_format='text', sample=1.0, rate=EVENT_RATE,
+                 queue_size=LOG_QUEUE_SIZE):
+        """
+        Initialize settings, see configure_logging() for the arguments
+        
+        Raises:
+            ValueError: if an argument is out of range
+        """
+        if level not in LOG_LEVELS:
+            raise ValueError(f"Unknown log level {level}")
+        if log_format not in LOG_FORMATS:
+            raise ValueError(f"Unknown log format {log_format}")
+        if not 0 <= sample <= 1:
+            raise ValueError("Log sample must be between 0 and 1")
+        if rate is not None and rate < 0:
+            raise ValueError("Log rate cannot be negative")
+        self.level = level
+        self.log_format = log_format
+        self.sample = sample
+        self.rate = rate or None
+        self.queue_size = queue_size
+
+
+_settings = None
+_handler = None
+_filter = None
+_listener = None
+_lock = threading.Lock()
+
+
+def configure_logging(level='info', log_format='text', sample=1.0, rate=EVENT_RATE,
+                      queue_size=LOG_QUEUE_SIZE):
+    """
+    Route all component loggers through a bounded queue to a writer thread
+    
+    Args:
+        level: Lowest level logged ('debug', 'info', 'warning', 'error')
+        log_format: 'text' for "[COMPONENT] message" lines, 'json' for one
+                    JSON object per line
+        sample: Fraction of debug/info records of each event kept
+        rate: Records per second per event, 0 for no limit
+        queue_size: Records buffered for the writer before new ones are dropped
+    
+    Raises:
+        ValueError: if an argument is out of range
+    """
+    _install(LogSettings(level, log_format, sample, rate, queue_size), start=True)
+
+
+def _install(settings, start=False):
+    """
+    (Re)build the handler, filter and writer thread for settings
+    
+    Args:
+        settings: LogSettings to apply
+        start: Start the writer thread now rather than with the first record
+    """
+    global _settings, _handler, _filter, _listener
+    with _lock:
+        logger = logging.getLogger(ROOT_LOGGER)
+        if _listener is not None:
+            _listener.stop()
+        if _handler is not None:
+            logger.removeHandler(_handler)
+        
+        stream = logging.StreamHandler(sys.stdout)
+        stream.setFormatter(JSONFormatter() if settings.log_format == 'json' else TextFormatter())
+        log_queue = queue.Queue(settings.queue_size)
+        _listener = LogWriter(log_queue, stream)
+        if start:
+            _listener.start()
+            _handler = DroppingQueueHandler(log_queue)
+        else:
+            _handler = DroppingQueueHandler(log_queue, partial(_start_writer, _listener))
+        _filter = EventFilter(settings.rate, EVENT_BURST, settings.sample)
+        _handler.addFilter(_filter)
+        _settings = settings
+        
+        logger.addHandler(_handler)
+        logger.setLevel(settings.level.upper())
+        logger.propagate = False
+
+
+def _start_writer(listener):
+    """Start a writer thread _install() left idle, unless it was replaced since"""
+    with _lock:
+        if listener is _listener:
+            listener.start()
+
+
+def get_log_stats() -> dict:
+    """Return records suppressed by rate limiting and dropped by a full queue"""
+    with _lock:
+        return {
+            'log_suppressed': _filter.suppressed if _filter is not None else 0,
+            'log_dropped': _handler.dropped if _handler is not None else 0,
+        }
+
+
+def add_logging_arguments(parser):
+    """Add the --log-* options to an argparse parser"""
+    parser.add_argument('--log-level', choices=LOG_LEVELS, default='info',
+                        help='Lowest level logged (default: info)')
+    parser.add_argument('--log-format', choices=LOG_FORMATS, default='text',
+                        help='text lines or one JSON object per line (default: text)')
+    parser.add_argument('--log-sample', type=float, default=1.0,
+                        help='Fraction of routine per-connection messages logged, '
+                             'e.g. 0.01 (default: 1, all)')
+    parser.add_argument('--log-rate', type=float, default=EVENT_RATE,
+                        help='Messages per second of each kind before the rest are '
+                             f'suppressed, 0 for no limit (default: {EVENT_RATE:g})')
+
+
+def configure_from_args(parser, args):
+    """Apply the options added by add_logging_arguments(), exiting on bad values"""
+    try:
+        configure_logging(args.log_level, args.log_format, args.log_sample, args.log_rate)
+    except ValueError as e:
+        parser.error(str(e))
+
+
+def _flush():
+    """Write out queued records at exit"""
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+
+
+def _restart_in_child():
+    """A forked worker inherits the queue but not the writer thread"""
+    global _listener, _handler, _lock
+    # The parent's objects may hold locks taken by threads that do not exist
+    # here, so start over instead of reusing them
+    _lock = threading.Lock()
+    _listener = None
+    _handler = None
+    logging.getLogger(ROOT_LOGGER).handlers.clear()
+    if _settings is not None:
+        _install(_settings)
+
+
+# Log at info level as text until a tool configures something else, so
+# modules used as a library still show their messages; the writer thread
+# starts with the first message, not on import
+_install(LogSettings())
+atexit.register(_flush)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_in_child)
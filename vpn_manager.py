@@ -5,7 +5,11 @@ import json
 import sys
 import subprocess
 import os
-from socks5_proxy import SOCKS5Proxy
+from socks5_proxy import CONNECT_MODES, SOCKS5Proxy
+from load_balancer import BALANCE_POLICIES, Endpoint
+from server_probe import PROBE_CACHE_FILE, PROBE_TIMEOUT, ProbeCache, probe_servers, rank_servers
+from socket_tuning import SOCKET_PROFILES
+from profiling import add_profiling_arguments, profile_from_args
 import threading
 
 
@@ -17,6 +21,7 @@ class VPNManager:
         self.config_file = config_file
         self.servers = {}
         self.current_proxy = None
+        self.probe_cache = ProbeCache(os.path.join(os.path.dirname(config_file), PROBE_CACHE_FILE))
         self.load_servers()
     
     def load_servers(self):
@@ -38,12 +43,93 @@ class VPNManager:
         for server_id, server_info in self.servers.items():
             print(f"\n{server_id.upper()}:")
             print(f"  Country: {server_info.get('country', 'Unknown')}")
-            print(f"  Host: {server_info.get('host', 'Not configured')}")
-            print(f"  Port: {server_info.get('port', 8888)}")
+            if 'endpoints' in server_info:
+                for endpoint in server_info['endpoints']:
+                    print(f"  Endpoint: {endpoint.get('host')}:{endpoint.get('port', 8888)} "
+                          f"(weight {endpoint.get('weight', 1)})")
+            else:
+                print(f"  Host: {server_info.get('host', 'Not configured')}")
+                print(f"  Port: {server_info.get('port', 8888)}")
+            print(f"  Region: {server_info.get('region', 'Unknown')}")
+            if 'socket_profile' in server_info:
+                print(f"  Socket profile: {server_info['socket_profile']}")
             print(f"  Description: {server_info.get('description', '')}")
         print()
     
-    def connect(self, country, password=None, proxy_port=1080):
+    def server_endpoints(self, server_id) -> list:
+        """
+        Return the configured endpoints of a country
+        
+        An entry either has a single host/port, or an "endpoints" list of
+        {"host", "port", "weight"} objects. Placeholder hosts are skipped.
+        """
+        server_info = self.servers.get(server_id, {})
+        entries = server_info.get('endpoints') or [server_info]
+        endpoints = []
+        for entry in entries:
+            host = entry.get('host')
+            if not host or host.startswith('your_'):
+                continue
+            endpoints.append(Endpoint(host, entry.get('port', 8888), entry.get('weight', 1)))
+        return endpoints
+    
+    def probe(self, region=None, timeout=PROBE_TIMEOUT, refresh=False) -> dict:
+        """
+        Measure connect and handshake latency of all configured servers in parallel
+        
+        Args:
+            region: Only probe servers whose 'region' matches (optional)
+            timeout: Per-server deadline in seconds
+            refresh: Probe again even if a cached result is still fresh
+        
+        Returns:
+            {server_id: result}, see server_probe.probe_server(); countries
+            with several endpoints are probed as server_id#1, server_id#2, ...
+        """
+        targets = {}
+        for server_id, server_info in self.servers.items():
+            if region and server_info.get('region', '').lower() != region.lower():
+                continue
+            endpoints = self.server_endpoints(server_id)
+            for number, endpoint in enumerate(endpoints, 1):
+                key = f"{server_id}#{number}" if len(endpoints) > 1 else server_id
+                targets[key] = (endpoint.host, endpoint.port)
+        
+        if not targets:
+            print(f"[MANAGER] No configured servers{' in region ' + region if region else ''} to probe")
+            return {}
+        
+        print(f"[MANAGER] Probing {len(targets)} server(s)...")
+        return probe_servers(targets, timeout, self.probe_cache, refresh)
+    
+    def print_probe_results(self, results):
+        """Print probe results, fastest healthy server first"""
+        print("\n=== Server Latency ===")
+        ranked = rank_servers(results)
+        for server_id in ranked:
+            result = results[server_id]
+            cached = ' (cached)' if result.get('cached') else ''
+            print(f"  {server_id:<12} {result['rtt_ms']:>8.1f} ms  "
+                  f"(connect {result['connect_ms']:.1f} ms, handshake {result['handshake_ms']:.1f} ms){cached}")
+        for server_id, result in results.items():
+            if server_id not in ranked:
+                print(f"  {server_id:<12} {'down':>8}     {result.get('error')}")
+        print()
+    
+    def fastest_server(self, region=None, timeout=PROBE_TIMEOUT, refresh=False):
+        """Return the id of the fastest healthy server, or None if none answered"""
+        results = self.probe(region, timeout, refresh)
+        ranked = rank_servers(results)
+        if not ranked:
+            if results:
+                print("[MANAGER] No server answered the probe")
+            return None
+        print(f"[MANAGER] Fastest server: {ranked[0]} ({results[ranked[0]]['rtt_ms']:.1f} ms)")
+        return ranked[0].split('#', 1)[0]
+    
+    def connect(self, country, password=None, proxy_port=1080, multiplex=False, pool_min_idle=0,
+                compression=None, metrics_port=None, balance='least_conn', connect_mode='optimistic',
+                socket_profile=None):
         """
         Connect to a VPN server in a specific country
         
@@ -51,6 +137,15 @@ class VPNManager:
             country: Country name (e.g., 'israel', 'italy')
             password: VPN encryption password (optional)
             proxy_port: Local SOCKS5 proxy port (default: 1080)
+            multiplex: Share one server connection between all proxied connections
+            pool_min_idle: Pre-connected server connections to keep ready (0 disables)
+            compression: Compress tunnel traffic with this algorithm ('zlib'), or None
+            metrics_port: Serve proxy metrics on 127.0.0.1:metrics_port (optional)
+            balance: How tunnels are spread over a country's endpoints
+            connect_mode: When the SOCKS reply is sent, see SOCKS5Proxy
+            socket_profile: TCP tuning of the server connections, overriding
+                            the entry's "socket_profile" (default: the
+                            entry's, else kernel settings)
         """
         country_lower = country.lower()
         
@@ -62,17 +157,22 @@ class VPNManager:
             return False
         
         server_info = self.servers[country_lower]
-        server_host = server_info.get('host')
-        server_port = server_info.get('port', 8888)
+        endpoints = self.server_endpoints(country_lower)
         
-        if server_host == f"your_{country_lower}_server_ip" or not server_host:
+        if not endpoints:
             print(f"[MANAGER] Server for {country} is not configured!")
             print(f"[MANAGER] Please edit {self.config_file} and set the 'host' field")
             print(f"[MANAGER] You need to deploy a VPN server in {server_info.get('country')} first")
             return False
+        server_host, server_port = endpoints[0].host, endpoints[0].port
+        socket_profile = socket_profile or server_info.get('socket_profile', 'default')
+        if socket_profile not in SOCKET_PROFILES:
+            print(f"[MANAGER] Unknown socket profile '{socket_profile}' for {country}, "
+                  f"use one of: {', '.join(SOCKET_PROFILES)}")
+            return False
         
         print(f"[MANAGER] Connecting to {server_info.get('country')} VPN server...")
-        print(f"[MANAGER] Server: {server_host}:{server_port}")
+        print(f"[MANAGER] Server: {', '.join(repr(endpoint) for endpoint in endpoints)}")
         
         # Stop existing proxy if running
         if self.current_proxy:
@@ -83,7 +183,15 @@ class VPNManager:
             server_host,
             server_port,
             proxy_port,
-            password
+            password,
+            multiplex=multiplex,
+            pool_min_idle=pool_min_idle,
+            compression=compression,
+            metrics_port=metrics_port,
+            endpoints=endpoints,
+            balance=balance,
+            connect_mode=connect_mode,
+            socket_profile=socket_profile
         )
         
         # Run proxy in a thread
@@ -141,23 +249,60 @@ def main():
     import argparse
     
     parser = argparse.ArgumentParser(description='VPN Manager - Connect to VPN servers in different countries')
-    parser.add_argument('command', choices=['list', 'connect', 'check'], help='Command to execute')
+    parser.add_argument('command', choices=['list', 'connect', 'check', 'probe'], help='Command to execute')
     parser.add_argument('--country', help='Country to connect to (for connect command)')
+    parser.add_argument('--auto', action='store_true',
+                        help='Connect to the server with the lowest measured latency instead of --country')
+    parser.add_argument('--region', help='Limit probe and --auto to servers in this region (e.g. europe)')
+    parser.add_argument('--probe-timeout', type=float, default=PROBE_TIMEOUT,
+                        help=f'Seconds to wait for each server when probing (default: {PROBE_TIMEOUT})')
+    parser.add_argument('--refresh', action='store_true',
+                        help='Ignore cached probe results')
     parser.add_argument('--password', help='VPN encryption password')
     parser.add_argument('--port', type=int, default=1080, help='Local proxy port (default: 1080)')
+    parser.add_argument('--mux', action='store_true',
+                        help='Multiplex all connections over one VPN server connection')
+    parser.add_argument('--pool-min-idle', type=int, default=0,
+                        help='Pre-connected VPN server connections to keep ready (default: 0, disabled)')
+    parser.add_argument('--compression', choices=['none', 'zlib'], default='none',
+                        help='Compress tunnel traffic before encryption (default: none)')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve Prometheus metrics on 127.0.0.1:PORT')
+    parser.add_argument('--balance', choices=BALANCE_POLICIES, default='least_conn',
+                        help='How tunnels are spread over a country\'s endpoints (default: least_conn)')
+    parser.add_argument('--connect-mode', choices=CONNECT_MODES, default='optimistic',
+                        help='optimistic: reply before the target is connected, early-data: '
+                             'send the request and first data in one flight, confirmed: '
+                             'reply with the server\'s connect result (default: optimistic)')
+    parser.add_argument('--socket-profile', choices=SOCKET_PROFILES,
+                        help='TCP tuning of VPN server connections, overriding the server\'s '
+                             '"socket_profile" in servers.json')
+    add_profiling_arguments(parser)
     
     args = parser.parse_args()
+    profile_from_args(parser, args, 'proxy')
     
     manager = VPNManager()
     
     if args.command == 'list':
         manager.list_servers()
+    elif args.command == 'probe':
+        manager.print_probe_results(manager.probe(args.region, args.probe_timeout, args.refresh))
     elif args.command == 'connect':
-        if not args.country:
-            print("[MANAGER] Error: --country is required for connect command")
+        country = args.country
+        if args.auto:
+            country = manager.fastest_server(args.region, args.probe_timeout, args.refresh)
+            if country is None:
+                sys.exit(1)
+        if not country:
+            print("[MANAGER] Error: --country or --auto is required for connect command")
             print("[MANAGER] Use 'list' command to see available countries")
             sys.exit(1)
-        manager.connect(args.country, args.password, args.port)
+        manager.connect(country, args.password, args.port, multiplex=args.mux,
+                        pool_min_idle=args.pool_min_idle,
+                        compression=None if args.compression == 'none' else args.compression,
+                        metrics_port=args.metrics_port, balance=args.balance,
+                        connect_mode=args.connect_mode, socket_profile=args.socket_profile)
     elif args.command == 'check':
         manager.check_ip()
 
@@ -3,15 +3,51 @@ VPN Server - Accepts client connections and tunnels traffic
 """
 import socket
 import threading
-import select
 import sys
+import time
+from functools import partial
+from compression import compression_summary, is_offer, server_handshake, state_size
 from crypto_utils import VPNCrypto
+from crypto_pool import DEFAULT_CRYPTO_THREADS, create_crypto_pool
+from metrics import (
+    CONNECT_SECONDS, HANDSHAKE_SECONDS, count_error, export_page, export_stats, start_metrics_server
+)
+from relay_buffers import AdaptiveBuffer, send_buffers, wait_readable
+from relay_core import RelayLoop
+from resolver import (
+    Resolver, CONNECT_TIMEOUT, HAPPY_EYEBALLS_DELAY, DNS_CACHE_SIZE, DNS_TTL, DNS_NEGATIVE_TTL
+)
+from tunnel_mux import MUX_HELLO, MuxSession, splice
+from connect_status import (
+    CONNECT_REQUEST, STATUS_SUCCEEDED, is_connect_request, make_status, status_for_error
+)
+from udp_relay import UDP_HELLO, UDP_IDLE_TIMEOUT, UDPAssociation
+from rate_limit import RateLimiter, load_rate_config, parse_rate
+from admission import (
+    OVERLOAD_POLICIES, DEFAULT_BACKLOG, DEFAULT_IDLE_TIMEOUT, DEFAULT_KEEPALIVE, DEFAULT_MAX_TUNNELS,
+    DEFAULT_MEMORY_BUDGET, DEFAULT_THREAD_STACK_SIZE, AdmissionControl, WorkerPool, create_reaper,
+    half_close, reset_connection, set_keepalive, set_thread_stack_size, shutdown_connection
+)
+from socket_tuning import SOCKET_PROFILES, SocketTuner
+from vpn_logging import add_logging_arguments, configure_from_args, get_log_stats, get_logger
+from profiling import add_profiling_arguments, profile_from_args
+
+
+log = get_logger('server')
 
 
 class VPNServer:
     """VPN Server that handles client connections and traffic tunneling"""
     
-    def __init__(self, host='0.0.0.0', port=8888, password=None):
+    def __init__(self, host='0.0.0.0', port=8888, password=None, reuse_port=False,
+                 relay='threads', connect_timeout=CONNECT_TIMEOUT,
+                 happy_eyeballs_delay=HAPPY_EYEBALLS_DELAY, dns_cache_size=DNS_CACHE_SIZE,
+                 dns_ttl=DNS_TTL, dns_negative_ttl=DNS_NEGATIVE_TTL, compression=True,
+                 metrics_port=None, udp_idle_timeout=UDP_IDLE_TIMEOUT, rate_limits=None,
+                 backlog=DEFAULT_BACKLOG, max_tunnels=DEFAULT_MAX_TUNNELS, overload='queue',
+                 crypto_threads=DEFAULT_CRYPTO_THREADS, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 keepalive=DEFAULT_KEEPALIVE, socket_profile='default',
+                 memory_budget=DEFAULT_MEMORY_BUDGET):
         """
         Initialize VPN Server
         
@@ -19,57 +55,206 @@ class VPNServer:
             host: Server host address
             port: Server port
             password: Encryption password (optional)
+            reuse_port: Bind with SO_REUSEPORT so several worker processes
+                        can share the port (default: False)
+            relay: 'threads' relays each tunnel in its client thread,
+                   'selectors' hands established tunnels to one shared
+                   non-blocking RelayLoop (default: 'threads')
+            connect_timeout: Seconds allowed for connecting to a target
+            happy_eyeballs_delay: Seconds before racing a target's next address
+            dns_cache_size: Target hostnames kept in the DNS cache
+            dns_ttl: Seconds a resolved hostname is reused
+            dns_negative_ttl: Seconds a failed lookup is reused
+            compression: Compress server -> client traffic of clients that
+                         offer compression (default: True)
+            metrics_port: Serve Prometheus metrics on 127.0.0.1:metrics_port
+                          (default: None, disabled)
+            udp_idle_timeout: Seconds a UDP association may stay silent
+                              before it is closed (default: 120)
+            rate_limits: Per-client and total bandwidth limits, a config dict
+                         for rate_limit.RateLimiter.from_config() (default:
+                         None, unlimited)
+            backlog: Listen backlog, also the number of connections that may
+                     wait for a slot with the 'queue' policy (default: 1024)
+            max_tunnels: Client connections served at once; the threads
+                         engine uses at most this many handler threads
+                         (default: 1024)
+            overload: Policy for connections beyond max_tunnels: 'queue',
+                      'reject' or 'shed-idle', see admission.AdmissionControl
+                      (default: 'queue')
+            crypto_threads: Threads that help encrypt and decrypt tunnels in
+                            bulk-transfer mode, 0 keeps all crypto on the
+                            relay threads (default: one less than the CPUs,
+                            at most 8)
+            idle_timeout: Seconds a tunnel may move no data before it is
+                          closed, 0 keeps idle tunnels forever (default: 900)
+            keepalive: Seconds of silence before TCP keepalive probes a
+                       client or target connection, 0 disables (default: 60)
+            socket_profile: socket_tuning profile for client and target
+                            connections, e.g. 'high-latency' (default:
+                            'default', kernel settings)
+            memory_budget: Bytes of buffers all tunnels may hold together;
+                           beyond it buffers stop growing, relays pause
+                           reading and new connections are handled by the
+                           overload policy (default: 0, no limit)
         """
         self.host = host
         self.port = port
+        self.reuse_port = reuse_port
+        self.relay = relay
+        self.relay_loop = None
+        self.compression = compression
+        self.metrics_port = metrics_port
+        self.udp_idle_timeout = udp_idle_timeout
+        self.rate_limiter = RateLimiter.from_config(rate_limits) if rate_limits else None
+        self.backlog = backlog
+        self.admission = AdmissionControl(max_tunnels, overload, queue_size=backlog,
+                                          memory_budget=memory_budget)
+        self.workers = WorkerPool(max_tunnels)
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.reaper = None
+        self.tuner = SocketTuner(socket_profile)
         self.crypto = VPNCrypto(password)
-        self.clients = {}
+        self.crypto_pool = create_crypto_pool(crypto_threads)
+        self.resolver = Resolver(dns_cache_size, dns_ttl, dns_negative_ttl,
+                                 connect_timeout, happy_eyeballs_delay)
         self.running = False
+        self.stats = {
+            'connections_total': 0,
+            'connections_active': 0,
+            'target_failures': 0,
+            'compression_raw_bytes': 0,
+            'compression_wire_bytes': 0,
+            'udp_associations_total': 0,
+        }
+        self.stats_lock = threading.Lock()
         
-        print(f"[SERVER] Initialized on {host}:{port}")
+        log.info("Initialized on %s:%s", host, port)
         if password:
-            print(f"[SERVER] Using password-based encryption")
+            log.info("Using password-based encryption")
         else:
-            print(f"[SERVER] Encryption key: {self.crypto.get_key().decode()[:20]}...")
+            log.info("Encryption key: %s...", self.crypto.get_key().decode()[:20])
+        if self.rate_limiter is not None:
+            log.info("Rate limits: %s", self.rate_limiter.describe())
+        if self.crypto_pool is not None:
+            log.info("Bulk transfers encrypted on %s extra thread(s)", crypto_threads)
+        if memory_budget:
+            log.info("Tunnel buffers limited to %s bytes", memory_budget)
     
     def start(self):
         """Start the VPN server"""
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.tuner.tune_listener(self.server_socket)
         
         try:
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)
+            self.server_socket.listen(self.backlog)
             self.running = True
+            self.start_metrics()
+            self.start_reaper()
+            if self.relay == 'selectors':
+                self.relay_loop = RelayLoop()
+                self.relay_loop.start()
             
-            print(f"[SERVER] Listening on {self.host}:{self.port}")
-            print("[SERVER] Waiting for client connections...")
+            log.info("Listening on %s:%s", self.host, self.port)
+            log.info("Waiting for client connections...")
             
             while self.running:
                 try:
                     client_socket, client_address = self.server_socket.accept()
-                    print(f"[SERVER] New client connected from {client_address}")
+                    log.info("New client connected from %s", client_address)
+                    set_keepalive(client_socket, self.keepalive)
+                    self.tuner.tune(client_socket, 'client')
                     
-                    # Handle client in separate thread
-                    client_thread = threading.Thread(
-                        target=self.handle_client,
-                        args=(client_socket, client_address),
-                        daemon=True
+                    # Handle client on a worker thread once it has a slot
+                    self.admission.admit(
+                        partial(self.workers.submit, self.handle_client, client_socket, client_address),
+                        partial(self.reject_client, client_socket, client_address),
+                        partial(shutdown_connection, client_socket),
+                        client_address
                     )
-                    client_thread.start()
-                    
+                
                 except OSError:
                     if self.running:
-                        print("[SERVER] Server socket closed")
+                        log.info("Server socket closed")
                     break
-                    
+        
         except Exception as e:
-            print(f"[SERVER] Error: {e}")
+            log.error("Error: %s", e)
         finally:
             self.stop()
     
-    def handle_client(self, client_socket, client_address):
+    def start_metrics(self):
+        """Start the metrics endpoint if one was configured"""
+        if self.metrics_port:
+            start_metrics_server(self.metrics_port)
+            export_stats(self.get_stats, 'vpn_server',
+                         gauges=('connections_active', 'dns_cache_entries', 'admission_active',
+                                 'admission_queued', 'workers', 'workers_busy',
+                                 'memory_buffered_bytes', 'memory_budget_bytes'))
+            export_page('/tunnels', self.get_tunnels)
+    
+    def start_reaper(self):
+        """Start closing idle tunnels if an idle timeout is set"""
+        self.reaper = create_reaper(self.admission, self.idle_timeout)
+    
+    def count(self, name, delta=1):
+        """Adjust one of the server's stats counters"""
+        with self.stats_lock:
+            self.stats[name] += delta
+    
+    def get_stats(self) -> dict:
+        """Return a snapshot of the server's stats counters"""
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats.update(self.resolver.get_stats())
+        stats.update(self.admission.get_stats())
+        stats.update(self.workers.get_stats())
+        stats.update(get_log_stats())
+        stats.update(self.tuner.get_stats())
+        if self.rate_limiter is not None:
+            stats.update(self.rate_limiter.get_stats())
+        if self.crypto_pool is not None:
+            stats.update(self.crypto_pool.get_stats())
+        return stats
+    
+    def get_tunnels(self) -> list:
+        """
+        Return the active tunnels, largest buffers first
+        
+        Returns:
+            List of {'peer', 'target', 'age', 'idle', 'bytes_up',
+            'bytes_down', 'buffered_bytes'}, see admission.Slot.describe()
+        """
+        return self.admission.get_tunnels()
+    
+    def client_limits(self, client_address):
+        """Return the rate limits of a client address, None if there are none"""
+        if self.rate_limiter is None:
+            return None
+        return self.rate_limiter.client(client_address[0])
+    
+    def release_limits(self, limits):
+        """Release limits returned by client_limits()"""
+        if limits is not None:
+            self.rate_limiter.release(limits)
+    
+    def reject_client(self, client_socket, client_address):
+        """Turn a connection away while the server is overloaded"""
+        log.warning("Overloaded, rejecting %s", client_address)
+        reset_connection(client_socket)
+    
+    def handle_client(self, client_socket, client_address, slot=None):
         """Handle a client connection"""
+        self.count('connections_total')
+        self.count('connections_active')
+        handed_off = False
+        started = time.perf_counter()
+        limits = self.client_limits(client_address)
         try:
             # Send encryption key to client
             key = self.crypto.get_key()
@@ -77,79 +262,304 @@ class VPNServer:
             client_socket.sendall(key_length + key)
             
             # Receive target connection info from client
-            encrypted_data = client_socket.recv(4096)
-            if not encrypted_data:
+            encoder = self.crypto.new_record_encoder(self.crypto_pool)
+            decoder = self.crypto.new_record_decoder(self.crypto_pool)
+            if slot is not None:
+                decoder.set_account(slot)
+            records = self.receive_records(client_socket, decoder)
+            if records is None:
+                return
+            
+            if is_offer(records[0]):
+                # Compression offer, the actual request follows
+                try:
+                    reply, encoder, decoder = server_handshake(
+                        records[0], encoder, decoder, self.compression)
+                    if slot is not None:
+                        slot.charge(state_size(encoder, decoder))
+                    client_socket.sendall(reply)
+                    records = decoder.unwrap(records[1:]) or self.receive_records(client_socket, decoder)
+                except ValueError as e:
+                    log.warning("Invalid compression offer: %s", e)
+                    count_error('handshake')
+                    client_socket.close()
+                    return
+                if records is None:
+                    return
+            
+            HANDSHAKE_SECONDS.observe(time.perf_counter() - started)
+            if records[0] == MUX_HELLO:
+                # Many streams over this one connection
+                log.info("Client %s switched to multiplexed mode", client_address)
+                if slot is not None:
+                    slot.sheddable = False
+                    slot.target = 'mux'
+                session = MuxSession(client_socket, encoder, decoder,
+                                     on_open=partial(self.admit_mux_stream,
+                                                     client_address=client_address, limits=limits))
+                try:
+                    session.run(records[1:])
+                finally:
+                    self.report_compression(client_address, encoder, decoder)
                 return
             
+            if records[0] == UDP_HELLO:
+                # Datagrams to any destination, one per record
+                log.info("Client %s opened a UDP association", client_address)
+                self.count('udp_associations_total')
+                if slot is not None:
+                    slot.sheddable = False
+                    slot.target = 'udp'
+                association = UDPAssociation(client_socket, encoder, decoder, self.resolver,
+                                             self.udp_idle_timeout, limits)
+                try:
+                    association.run(records[1:])
+                finally:
+                    self.report_compression(client_address, encoder, decoder)
+                return
+            
+            # Clients asking for a connect status get one before any data
+            request = records[0]
+            want_status = is_connect_request(request)
+            if want_status:
+                request = request[len(CONNECT_REQUEST):]
+            
             try:
-                decrypted_data = self.crypto.decrypt(encrypted_data)
-                target_info = decrypted_data.decode().split(':')
+                target_info = bytes(request).decode().rsplit(':', 1)
                 target_host = target_info[0]
                 target_port = int(target_info[1])
-                
-                print(f"[SERVER] Client wants to connect to {target_host}:{target_port}")
-                
-                # Create connection to target
-                target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                target_socket.settimeout(10)
-                
-                try:
-                    target_socket.connect((target_host, target_port))
-                    print(f"[SERVER] Connected to target {target_host}:{target_port}")
-                    
-                    # Start bidirectional tunneling
-                    self.tunnel_traffic(client_socket, target_socket, client_address)
-                    
-                except Exception as e:
-                    print(f"[SERVER] Failed to connect to target: {e}")
-                    client_socket.close()
-                    
             except Exception as e:
-                print(f"[SERVER] Error decrypting client data: {e}")
+                log.warning("Invalid target request: %s", e)
+                count_error('handshake')
                 client_socket.close()
+                return
+            
+            log.info("Client wants to connect to %s:%s", target_host, target_port)
+            if slot is not None:
+                slot.target = f"{target_host}:{target_port}"
+            
+            try:
+                target_socket = self.connect_target(target_host, target_port)
+            except Exception as e:
+                log.warning("Failed to connect to target: %s", e)
+                if want_status:
+                    client_socket.sendall(encoder.encode(make_status(status_for_error(e))))
+                client_socket.close()
+                return
+            
+            if want_status:
+                client_socket.sendall(encoder.encode(make_status(STATUS_SUCCEEDED)))
+            if slot is not None:
+                # A half-closed tunnel only ends once the target side ends too
+                slot.add_closer(partial(shutdown_connection, target_socket))
+            
+            # Forward any data the client sent along with the request
+            send_buffers(target_socket, records[1:])
+            
+            # Start bidirectional tunneling
+            if self.relay_loop is not None:
+                def on_close():
+                    self.report_compression(client_address, encoder, decoder)
+                    self.release_limits(limits)
+                    self.client_finished(client_socket, client_address, slot)
                 
+                self.relay_loop.add_tunnel(client_socket, target_socket, encoder, decoder,
+                                           on_close=on_close, limits=limits, slot=slot)
+                handed_off = True
+            else:
+                self.tunnel_traffic(client_socket, target_socket, client_address, encoder, decoder,
+                                    limits, slot)
+                self.report_compression(client_address, encoder, decoder)
+        
         except Exception as e:
-            print(f"[SERVER] Error handling client: {e}")
+            log.warning("Error handling client: %s", e)
+            count_error('client')
         finally:
-            if client_socket in self.clients:
-                del self.clients[client_socket]
-            print(f"[SERVER] Client {client_address} disconnected")
+            if not handed_off:
+                self.release_limits(limits)
+                self.client_finished(client_socket, client_address, slot)
     
-    def tunnel_traffic(self, client_socket, target_socket, client_address):
-        """Tunnel traffic between client and target"""
+    def receive_records(self, client_socket, decoder):
+        """
+        Read until at least one record has arrived
+        
+        Returns:
+            List of payloads, or None if the client closed or sent garbage
+        """
+        records = []
+        while not records:
+            try:
+                records = decoder.recv_from(client_socket)
+                if records is None:
+                    return None
+            except socket.error:
+                # Reset or dropped, e.g. a port check: not a decryption failure
+                client_socket.close()
+                return None
+            except Exception as e:
+                log.warning("Error decrypting client data: %s", e)
+                count_error('decrypt')
+                client_socket.close()
+                return None
+        return records
+    
+    def report_compression(self, client_address, encoder, decoder):
+        """Print and count the compression ratios of a finished tunnel"""
+        summary = compression_summary(encoder, decoder)
+        if summary is None:
+            return
+        log.info("Compression for %s: %s", client_address, summary)
+        self.count('compression_raw_bytes', encoder.raw_bytes + decoder.raw_bytes)
+        self.count('compression_wire_bytes', encoder.wire_bytes + decoder.wire_bytes)
+    
+    def client_finished(self, client_socket, client_address, slot=None):
+        """Bookkeeping once a client connection is done"""
+        if slot is not None:
+            self.admission.release(slot)
+        self.count('connections_active', -1)
+        log.info("Client %s disconnected", client_address)
+    
+    def connect_target(self, target_host, target_port):
+        """Open a plain TCP connection to the target over IPv6 or IPv4"""
+        started = time.perf_counter()
+        try:
+            target_socket = self.resolver.connect(target_host, target_port,
+                                                  partial(self.tuner.tune, role='target'))
+        except Exception:
+            self.count('target_failures')
+            count_error('target_connect')
+            raise
+        CONNECT_SECONDS.observe(time.perf_counter() - started)
+        set_keepalive(target_socket, self.keepalive)
+        log.info("Connected to target %s:%s", target_host, target_port)
+        return target_socket
+    
+    def admit_mux_stream(self, stream, target_host, target_port, client_address=None, limits=None):
+        """
+        Admit a multiplexed stream like a tunnel of its own
+        
+        Each stream takes a slot and a worker thread, so --max-tunnels and
+        the overload policy bound streams as well, however many a session
+        opens. Called on the session's frame reader thread.
+        """
+        self.admission.admit(
+            partial(self.workers.submit, self.handle_mux_stream, stream, target_host, target_port,
+                    limits),
+            partial(self.reject_mux_stream, stream, client_address),
+            stream.close,
+            client_address
+        )
+    
+    def reject_mux_stream(self, stream, client_address):
+        """Turn a multiplexed stream away while the server is overloaded"""
+        log.warning("Overloaded, rejecting stream %s of %s", stream.stream_id, client_address)
+        stream.close()
+    
+    def handle_mux_stream(self, stream, target_host, target_port, limits=None, slot=None):
+        """Connect one multiplexed stream to its target and relay it"""
+        try:
+            if stream.local_closed or stream.session.closed:
+                # Gone while it waited for a slot
+                return
+            log.info("Stream %s wants to connect to %s:%s", stream.stream_id, target_host, target_port)
+            if slot is not None:
+                slot.target = f"{target_host}:{target_port}"
+            try:
+                target_socket = self.connect_target(target_host, target_port)
+            except Exception as e:
+                log.warning("Failed to connect to target: %s", e)
+                stream.close()
+                return
+            
+            if slot is not None:
+                slot.add_closer(partial(shutdown_connection, target_socket))
+            splice(stream, target_socket, limits, slot)
+        finally:
+            if slot is not None:
+                self.admission.release(slot)
+    
+    def tunnel_traffic(self, client_socket, target_socket, client_address, encoder, decoder,
+                       limits=None, slot=None):
+        """
+        Tunnel traffic between client and target
+        
+        When one side stops sending, the other is half-closed and the
+        tunnel keeps relaying the opposite direction until it ends too.
+        
+        Args:
+            client_socket: Socket to the VPN client (carries records)
+            target_socket: Socket to the target (carries plain data)
+            client_address: Address of the VPN client
+            encoder: Record encoder for the server -> client direction
+            decoder: Record decoder for the client -> server direction
+            limits: Client's rate_limit.ClientLimits (optional)
+            slot: Client's admission.Slot, counts the traffic and is charged
+                  for the receive buffer (optional)
+        """
         sockets = [client_socket, target_socket]
+        target_buffer = AdaptiveBuffer(account=slot)
+        # A socket over its rate is not read again until its deadline
+        paused = {}
         
         try:
-            while True:
-                readable, _, exceptional = select.select(sockets, [], sockets, 1)
-                
-                if exceptional:
-                    break
+            while sockets:
+                if slot is not None and slot.closed:
+                    return
+                timeout = 1
+                if paused:
+                    now = time.monotonic()
+                    for sock, until in list(paused.items()):
+                        if until <= now:
+                            del paused[sock]
+                    timeout = min([until - now for until in paused.values()] + [timeout])
+                watched = [sock for sock in sockets if sock not in paused]
+                readable = wait_readable(watched, timeout)
                 
                 for sock in readable:
                     try:
-                        data = sock.recv(4096)
-                        if not data:
-                            return
-                        
                         if sock is client_socket:
                             # Data from client -> decrypt -> send to target
                             try:
-                                decrypted = self.crypto.decrypt(data)
-                                target_socket.sendall(decrypted)
+                                payloads = decoder.recv_from(client_socket)
+                            except socket.error:
+                                return
                             except Exception as e:
-                                print(f"[SERVER] Decryption error: {e}")
+                                log.warning("Decryption error: %s", e)
+                                count_error('decrypt')
                                 return
+                            if payloads is None:
+                                # The client is done sending; the target may
+                                # still answer
+                                half_close(target_socket)
+                                sockets.remove(client_socket)
+                                paused.pop(client_socket, None)
+                                continue
+                            send_buffers(target_socket, payloads)
+                            direction, amount = 'upload', sum(len(payload) for payload in payloads)
                         else:
                             # Data from target -> encrypt -> send to client
-                            encrypted = self.crypto.encrypt(data)
-                            client_socket.sendall(encrypted)
-                            
+                            data = target_buffer.recv_into(target_socket)
+                            if not data:
+                                half_close(client_socket)
+                                sockets.remove(target_socket)
+                                paused.pop(target_socket, None)
+                                continue
+                            send_buffers(client_socket, encoder.encode_parts(data))
+                            direction, amount = 'download', len(data)
+                        
+                        if slot is not None:
+                            slot.count(direction, amount)
+                        if limits is not None:
+                            delay = limits.consume(direction, amount)
+                            if delay:
+                                paused[sock] = time.monotonic() + delay
+                    
                     except socket.error:
                         return
-                        
+        
         except Exception as e:
-            print(f"[SERVER] Tunneling error: {e}")
+            log.warning("Tunneling error: %s", e)
+            count_error('tunnel')
         finally:
             client_socket.close()
             target_socket.close()
@@ -159,7 +569,21 @@ class VPNServer:
         self.running = False
         if hasattr(self, 'server_socket'):
             self.server_socket.close()
-        print("[SERVER] Server stopped")
+        if self.relay_loop is not None:
+            self.relay_loop.stop()
+        if self.crypto_pool is not None:
+            self.crypto_pool.shutdown()
+        if self.reaper is not None:
+            self.reaper.stop()
+        log.info("Server stopped")
+
+
+def create_server(engine='threads', **server_kwargs):
+    """Create a VPNServer for the named engine ('threads' or 'asyncio')"""
+    if engine == 'asyncio':
+        from async_server import AsyncVPNServer
+        return AsyncVPNServer(**server_kwargs)
+    return VPNServer(**server_kwargs)
 
 
 def main():
@@ -170,15 +594,135 @@ def main():
     parser.add_argument('--host', default='0.0.0.0', help='Server host (default: 0.0.0.0)')
     parser.add_argument('--port', type=int, default=8888, help='Server port (default: 8888)')
     parser.add_argument('--password', help='Encryption password (optional)')
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads',
+                        help='Connection handling engine (default: threads)')
+    parser.add_argument('--relay', choices=['threads', 'selectors'], default='threads',
+                        help='Threads engine only: relay each tunnel in its own thread, or all '
+                             'tunnels in one non-blocking selectors loop (default: threads)')
+    parser.add_argument('--connect-timeout', type=float, default=CONNECT_TIMEOUT,
+                        help=f'Seconds allowed for connecting to a target (default: {CONNECT_TIMEOUT})')
+    parser.add_argument('--happy-eyeballs-delay', type=float, default=HAPPY_EYEBALLS_DELAY,
+                        help='Seconds before racing the next IPv6/IPv4 address of a target '
+                             f'(default: {HAPPY_EYEBALLS_DELAY})')
+    parser.add_argument('--dns-cache-size', type=int, default=DNS_CACHE_SIZE,
+                        help=f'Target hostnames kept in the DNS cache, 0 disables it (default: {DNS_CACHE_SIZE})')
+    parser.add_argument('--dns-ttl', type=float, default=DNS_TTL,
+                        help=f'Seconds a resolved hostname is cached (default: {DNS_TTL})')
+    parser.add_argument('--dns-negative-ttl', type=float, default=DNS_NEGATIVE_TTL,
+                        help=f'Seconds a failed lookup is cached (default: {DNS_NEGATIVE_TTL})')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='Accept compressing clients but never compress server -> client traffic')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve Prometheus metrics on 127.0.0.1:PORT (with --workers, '
+                             'worker N uses PORT+N)')
+    parser.add_argument('--udp-idle-timeout', type=float, default=UDP_IDLE_TIMEOUT,
+                        help=f'Seconds before a silent UDP association is closed (default: {UDP_IDLE_TIMEOUT})')
+    parser.add_argument('--rate-config',
+                        help='JSON file with total, per-client and per-network (CIDR) bandwidth limits')
+    parser.add_argument('--client-rate',
+                        help='Bandwidth limit per client address and direction in bytes/s, '
+                             'e.g. 2M (overrides the config file default)')
+    parser.add_argument('--total-rate',
+                        help='Server bandwidth per direction in bytes/s, shared fairly between '
+                             'active clients, e.g. 100M (overrides the config file total)')
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG,
+                        help=f'Listen backlog and overload queue length (default: {DEFAULT_BACKLOG})')
+    parser.add_argument('--max-tunnels', type=int, default=DEFAULT_MAX_TUNNELS,
+                        help='Client connections served at once, and handler threads at most '
+                             f'(default: {DEFAULT_MAX_TUNNELS})')
+    parser.add_argument('--overload', choices=OVERLOAD_POLICIES, default='queue',
+                        help='Connections beyond --max-tunnels wait for a slot (queue), are reset '
+                             'at once (reject), or replace the longest idle tunnel (shed-idle) '
+                             '(default: queue)')
+    parser.add_argument('--crypto-threads', type=int, default=DEFAULT_CRYPTO_THREADS,
+                        help='Extra threads encrypting bulk transfers, 0 disables; each '
+                             f'--workers process has its own (default: {DEFAULT_CRYPTO_THREADS})')
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help='Close tunnels that moved no data for this many seconds, 0 never '
+                             f'(default: {DEFAULT_IDLE_TIMEOUT:g})')
+    parser.add_argument('--keepalive', type=int, default=DEFAULT_KEEPALIVE,
+                        help='Seconds of silence before TCP keepalive probes client and target '
+                             f'connections, 0 disables (default: {DEFAULT_KEEPALIVE})')
+    parser.add_argument('--socket-profile', choices=SOCKET_PROFILES, default='default',
+                        help='TCP tuning of client and target connections: interactive, bulk or '
+                             'high-latency (default: kernel settings)')
+    parser.add_argument('--memory-budget',
+                        help='Buffer memory all tunnels may use together, e.g. 64M; beyond it '
+                             'transfers slow down and new connections count as overload '
+                             '(default: no limit)')
+    parser.add_argument('--thread-stack-size', type=int, default=DEFAULT_THREAD_STACK_SIZE // 1024,
+                        help='Stack reserved per thread in KiB, at least 32, e.g. 256 for many '
+                             'tunnels on a small machine (default: 0, platform default)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes sharing the port via SO_REUSEPORT (default: 1)')
+    add_logging_arguments(parser)
+    add_profiling_arguments(parser)
     
     args = parser.parse_args()
+    configure_from_args(parser, args)
+    profile_from_args(parser, args, 'server')
+    
+    if args.engine == 'asyncio' and args.relay != 'threads':
+        parser.error('--relay is only supported by the threads engine')
+    
+    try:
+        rate_limits = load_rate_config(args.rate_config, args.client_rate, args.total_rate)
+        RateLimiter.from_config(rate_limits)
+    except ValueError as e:
+        parser.error(str(e))
+    try:
+        # Same K/M/G suffixes as rates
+        memory_budget = int(parse_rate(args.memory_budget) or 0)
+    except ValueError:
+        parser.error(f'Invalid --memory-budget {args.memory_budget!r}')
+    if args.crypto_threads < 0:
+        parser.error('--crypto-threads must be 0 or more')
+    if args.thread_stack_size and args.thread_stack_size < 32:
+        parser.error('--thread-stack-size must be 0 or at least 32 (KiB)')
+    if args.thread_stack_size:
+        # Process wide, so before any server, pool or worker process starts
+        try:
+            set_thread_stack_size(args.thread_stack_size * 1024)
+        except ValueError as e:
+            parser.error(str(e))
+    
+    server_kwargs = {
+        'host': args.host,
+        'port': args.port,
+        'password': args.password,
+        'relay': args.relay,
+        'connect_timeout': args.connect_timeout,
+        'happy_eyeballs_delay': args.happy_eyeballs_delay,
+        'dns_cache_size': args.dns_cache_size,
+        'dns_ttl': args.dns_ttl,
+        'dns_negative_ttl': args.dns_negative_ttl,
+        'compression': not args.no_compression,
+        'metrics_port': args.metrics_port,
+        'udp_idle_timeout': args.udp_idle_timeout,
+        'rate_limits': rate_limits,
+        'backlog': args.backlog,
+        'max_tunnels': args.max_tunnels,
+        'overload': args.overload,
+        'crypto_threads': args.crypto_threads,
+        'idle_timeout': args.idle_timeout,
+        'keepalive': args.keepalive,
+        'socket_profile': args.socket_profile,
+        'memory_budget': memory_budget,
+    }
+    
+    if args.workers > 1:
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            parser.error('--workers requires SO_REUSEPORT, which this platform lacks')
+        from server_supervisor import WorkerSupervisor
+        WorkerSupervisor(args.engine, server_kwargs, args.workers).run()
+        return
     
-    server = VPNServer(host=args.host, port=args.port, password=args.password)
+    server = create_server(args.engine, **server_kwargs)
     
     try:
         server.start()
     except KeyboardInterrupt:
-        print("\n[SERVER] Shutting down...")
+        log.info("Shutting down...")
         server.stop()
 
 